@@ -0,0 +1,64 @@
+"""Compares Icp2dRegistrationFunction with the open3d based IcpRegistrationFunction on
+synthetic peak sets.
+
+    python benchmarks/benchmark_point_registration.py --sizes 10000 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from situr.registration import IcpRegistrationFunction, Icp2dRegistrationFunction
+
+
+def make_peaks(size: int, seed: int = 0) -> tuple:
+    """Creates reference peaks on a 2048 x 2048 plane and data peaks that are rotated and
+        shifted against them.
+    """
+    rng = np.random.default_rng(seed)
+    reference = rng.uniform(0, 2048, (size, 2))
+    angle = np.deg2rad(0.05)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                         [np.sin(angle), np.cos(angle)]])
+    translation = np.array([1.5, -1.0])
+    data = (reference - translation) @ rotation + rng.normal(0, 0.1, reference.shape)
+    return data, reference, rotation, translation
+
+
+def run(registration_function, data, reference, rotation, translation, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        transformation = registration_function.do_registration(data, reference)
+        timings.append(time.perf_counter() - start)
+    moved = data @ transformation.transform_matrix.T * transformation.scale \
+        + transformation.offset[[1, 0]]
+    expected = data @ rotation.T + translation
+    error = np.sqrt(np.mean(np.sum((moved - expected) ** 2, axis=1)))
+    return min(timings), error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 30000, 100000])
+    parser.add_argument('--max-distance', type=float, default=5)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    functions = {'numpy': Icp2dRegistrationFunction(args.max_distance)}
+    try:
+        import open3d  # noqa: F401
+        functions['open3d'] = IcpRegistrationFunction(args.max_distance)
+    except ImportError as error:
+        print('open3d not available, only benchmarking the numpy implementation: {}'.format(error))
+
+    print('{:>8} {:>8} {:>10} {:>12}'.format('peaks', 'backend', 'seconds', 'rmse [px]'))
+    for size in args.sizes:
+        peaks = make_peaks(size)
+        for name, registration_function in functions.items():
+            seconds, error = run(registration_function, *peaks, args.repeats)
+            print('{:>8} {:>8} {:>10.4f} {:>12.4f}'.format(size, name, seconds, error))
+
+
+if __name__ == '__main__':
+    main()
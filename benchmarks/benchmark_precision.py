@@ -0,0 +1,77 @@
+"""Compares the float32 and float64 working precision for peak finding and transformations
+and checks that the registration result stays within tolerance.
+
+    python benchmarks/benchmark_precision.py --size 2048 --spots 20000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.ndimage
+
+from situr.registration import PeakFinderDifferenceOfGaussian, Icp2dRegistrationFunction
+from situr.transformation import RotateTranslateTransform, ScratchBuffers
+
+
+def make_plane(size: int, spots: int, offset=(0, 0), seed: int = 0) -> np.ndarray:
+    """Creates a 16 bit plane with gaussian spots, optionally shifted by offset (y, x).
+    """
+    rng = np.random.default_rng(seed)
+    coordinates = rng.uniform(10, size - 10, (spots, 2)) + np.asarray(offset)
+    img = np.zeros((size, size))
+    coordinates = np.round(coordinates).astype(int).clip(0, size - 1)
+    img[coordinates[:, 0], coordinates[:, 1]] = 1
+    img = scipy.ndimage.gaussian_filter(img, 1.5) * 60 * 65535
+    return img.clip(0, 65535).astype(np.uint16)
+
+
+def measure(function, *args, **kwargs):
+    """Returns the result, the time in seconds and the peak traced memory in bytes.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--spots', type=int, default=20000)
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='maximum allowed difference of the registered offsets in pixels')
+    args = parser.parse_args()
+
+    reference = make_plane(args.size, args.spots)
+    moved = make_plane(args.size, args.spots, offset=(3, -2))
+    transformation = RotateTranslateTransform(np.eye(2), offset=np.array([1.5, 0.5]))
+
+    offsets = {}
+    print('{:>8} {:>14} {:>10} {:>12}'.format('dtype', 'stage', 'seconds', 'peak MiB'))
+    for float_dtype in (np.float64, np.float32):
+        name = np.dtype(float_dtype).name
+        peak_finder = PeakFinderDifferenceOfGaussian(float_dtype=float_dtype, use_cache=False)
+        reference_peaks, seconds, memory = measure(peak_finder.find_peaks, reference)
+        print('{:>8} {:>14} {:>10.3f} {:>12.1f}'.format(name, 'find_peaks', seconds, memory / 2**20))
+        moved_peaks = peak_finder.find_peaks(moved)
+
+        _, seconds, memory = measure(transformation.apply_tranformation, reference,
+                                     dtype=float_dtype, buffers=ScratchBuffers(float_dtype))
+        print('{:>8} {:>14} {:>10.3f} {:>12.1f}'.format(name, 'transformation', seconds,
+                                                       memory / 2**20))
+
+        result = Icp2dRegistrationFunction(10).register(moved_peaks, reference_peaks)
+        offsets[name] = result.transformation.offset
+        print('{:>8} {:>14} offset (y, x) = {}'.format(name, 'registration', offsets[name]))
+
+    difference = np.abs(offsets['float32'] - offsets['float64']).max()
+    print('maximum offset difference: {:.4f} px ({})'.format(
+        difference, 'ok' if difference <= args.tolerance else 'above tolerance'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""Benchmarks the registration of synthetic tiles with known channel and round transformations.
+Each stage is timed separately and the registered transformations are compared against the
+ground truth. The results are written as json so that they can be compared between releases.
+
+    python benchmarks/benchmark_registration.py --rounds 4 --channels 4 --size 1024 \
+        --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import scipy
+import scipy.ndimage
+from PIL import Image
+
+from situr.image import Tile
+from situr.registration import ChannelRegistration, RoundRegistration
+from situr.registration import Icp2dRegistrationFunction, PeakFinderDifferenceOfGaussian
+from situr.registration import TrimmedIcpRegistrationFunction, RansacRegistrationFunction
+from situr.transformation import RotateTranslateTransform, Transform
+
+REGISTRATION_FUNCTIONS = {
+    'icp2d': Icp2dRegistrationFunction,
+    'trimmed-icp': TrimmedIcpRegistrationFunction,
+    'ransac': RansacRegistrationFunction,
+}
+STAGES = ['_load_image', 'get_channel_peaks', 'do_registration', 'apply_transformations']
+
+
+def random_transform(rng: np.random.Generator, max_angle: float, max_shift: float,
+                     center: float) -> RotateTranslateTransform:
+    """Creates a rotation about the image center (in degrees) followed by a shift (in pixels).
+    """
+    angle = np.deg2rad(rng.uniform(-max_angle, max_angle))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                         [np.sin(angle), np.cos(angle)]])
+    shift = rng.uniform(-max_shift, max_shift, 2)
+    # offset (y, x) so that the center moves by shift
+    translation = center - rotation @ np.array([center, center]) + shift
+    return RotateTranslateTransform(rotation, offset=translation[[1, 0]])
+
+
+def render(points: np.ndarray, size: int, sigma: float, rng: np.random.Generator) -> np.ndarray:
+    """Renders sub-pixel spots (x, y) as gaussians into a noisy 16 bit plane.
+    """
+    img = np.zeros((size, size))
+    base = np.floor(points).astype(int)
+    fraction = points - base
+    # bilinear splatting keeps the sub-pixel position of each spot
+    for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        weight = np.abs(1 - dx - fraction[:, 0]) * np.abs(1 - dy - fraction[:, 1])
+        x, y = base[:, 0] + dx, base[:, 1] + dy
+        inside = (x >= 0) & (x < size) & (y >= 0) & (y < size)
+        np.add.at(img, (y[inside], x[inside]), weight[inside])
+    img = scipy.ndimage.gaussian_filter(img, sigma) * 2 * np.pi * sigma**2 * 20000
+    img += rng.normal(500, 50, img.shape)
+    return img.clip(0, 65535).astype(np.uint16)
+
+
+def make_tile(directory: str, args) -> tuple:
+    """Writes a synthetic tile and returns its file list together with the ground truth
+        channel transformations of each round and the round transformations.
+    """
+    rng = np.random.default_rng(args.seed)
+    center = (args.size - 1) / 2
+    spot_count = int(args.density * args.size**2 / 10000)
+    points = rng.uniform(0, args.size, (spot_count, 2))
+
+    file_list = []
+    channel_truth = []
+    round_truth = []
+    for round in range(args.rounds):
+        round_transform = RotateTranslateTransform(np.eye(2)) if round == 0 else \
+            random_transform(rng, args.max_angle, args.max_shift, center)
+        round_truth.append(round_transform)
+        channel_truth.append([])
+        file_list.append([])
+        for channel in range(args.channels):
+            channel_transform = RotateTranslateTransform(np.eye(2)) if channel == 0 else \
+                random_transform(rng, args.max_angle / 2, args.max_shift / 2, center)
+            channel_truth[round].append(channel_transform)
+            # the ground truth maps the raw plane onto the reference, the plane shows the inverse
+            matrix = np.linalg.inv(round_transform.get_matrix() @ channel_transform.get_matrix())
+            raw_points = points @ matrix[0:2, 0:2].T + matrix[0:2, 2]
+            file_list[round].append([])
+            for focus_level in range(args.focus_levels):
+                path = os.path.join(directory, 'r{}_c{}_z{}.tif'.format(
+                    round, channel, focus_level))
+                Image.fromarray(render(raw_points, args.size, 1.2 + focus_level, rng)).save(path)
+                file_list[round][channel].append(path)
+    return file_list, channel_truth, round_truth
+
+
+def transform_error(estimated: Transform, truth: Transform, size: int) -> float:
+    """Returns the largest distance in pixels between the two transformations on a grid of
+        points covering the image.
+    """
+    grid = np.linspace(0, size - 1, 5)
+    points = np.stack(np.meshgrid(grid, grid), axis=-1).reshape(-1, 2)
+    points = np.concatenate([points, np.ones((len(points), 1))], axis=1)
+    difference = points @ (estimated.get_matrix() - truth.get_matrix()).T
+    return float(np.linalg.norm(difference[:, 0:2], axis=1).max())
+
+
+def timed(timings: dict, stage: str, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+    return result
+
+
+def run(file_list: list, args) -> tuple:
+    """Registers the tile once and returns the timings of each stage and the tile.
+    """
+    # channel 0 is the reference channel, the benchmark tiles have no nucleaus channel
+    tile = Tile(file_list, nucleaus_channel=args.channels)
+    peak_finder = PeakFinderDifferenceOfGaussian(threshold=args.threshold)
+    registration_function = REGISTRATION_FUNCTIONS[args.registration_function](
+        args.max_correspondence_distance)
+    channel_registration = ChannelRegistration(registration_function, peak_finder)
+    round_registration = RoundRegistration(registration_function, peak_finder)
+    timings = {}
+
+    for round in range(tile.get_round_count()):
+        timed(timings, '_load_image', tile.get_round(round)._load_image)
+    for round in range(tile.get_round_count()):
+        for channel in range(tile.get_channel_count()):
+            timed(timings, 'get_channel_peaks', peak_finder.get_channel_peaks,
+                  tile.get_round(round), channel)
+
+    timed(timings, 'do_registration', channel_registration.do_channel_registration, tile, 0)
+    if args.warp_peaks:
+        # the round registration uses the channel transformed peaks, the tile is resampled once
+        timed(timings, 'do_registration', round_registration.do_round_registration, tile, 0, 0,
+              warp_peaks=True)
+        timed(timings, 'apply_transformations', tile.apply_transformations, workers=args.workers)
+        return timings, tile
+
+    timed(timings, 'apply_transformations', tile.apply_channel_transformations, args.workers)
+
+    # the transformed reference channels need new peaks for the round registration
+    for round in range(tile.get_round_count()):
+        timed(timings, 'get_channel_peaks', peak_finder.get_channel_peaks,
+              tile.get_round(round), 0)
+    timed(timings, 'do_registration', round_registration.do_round_registration, tile, 0, 0)
+    timed(timings, 'apply_transformations', tile.apply_round_transformations, args.workers)
+    return timings, tile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--focus-levels', type=int, default=1)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--density', type=float, default=3,
+                        help='number of spots per 100 x 100 pixels')
+    parser.add_argument('--max-angle', type=float, default=0.2,
+                        help='largest rotation of a round in degrees')
+    parser.add_argument('--max-shift', type=float, default=5,
+                        help='largest shift of a round in pixels')
+    parser.add_argument('--threshold', type=float, default=0.05)
+    parser.add_argument('--max-correspondence-distance', type=float, default=15)
+    parser.add_argument('--registration-function', choices=sorted(REGISTRATION_FUNCTIONS),
+                        default='icp2d')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--warp-peaks', action='store_true',
+                        help='apply the channel transformations to the peaks instead of the images')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_registration.json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_list, channel_truth, round_truth = make_tile(directory, args)
+        runs = []
+        for _ in range(args.repeats):
+            timings, tile = run(file_list, args)
+            runs.append(timings)
+
+    channel_errors = [transform_error(image.channel_transformations[channel],
+                                      channel_truth[round][channel], args.size)
+                      for round, image in enumerate(tile.images)
+                      for channel in range(1, args.channels)]
+    round_errors = [transform_error(tile.round_transformations[round], round_truth[round],
+                                    args.size)
+                    for round in range(1, args.rounds)]
+
+    results = {
+        'parameters': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'seconds': {stage: min(timings[stage] for timings in runs) for stage in STAGES},
+        'runs': runs,
+        'error': {
+            'channel_max_px': max(channel_errors, default=0.0),
+            'channel_mean_px': float(np.mean(channel_errors)) if channel_errors else 0.0,
+            'round_max_px': max(round_errors, default=0.0),
+            'round_mean_px': float(np.mean(round_errors)) if round_errors else 0.0,
+        },
+    }
+
+    print('{:>22} {:>10}'.format('stage', 'seconds'))
+    for stage in STAGES:
+        print('{:>22} {:>10.3f}'.format(stage, results['seconds'][stage]))
+    for name, value in results['error'].items():
+        print('{:>22} {:>10.3f}'.format(name, value))
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('results written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+from .spot_decoding import Codebook, SpotDecoder, SPOT_DTYPE
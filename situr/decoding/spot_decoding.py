@@ -0,0 +1,228 @@
+from typing import List
+
+import numpy as np
+import scipy.ndimage
+
+from situr.image.situ_tile import Tile
+
+# One row of the spots table. gene is the index into the codebook, -1 if the spot could not be
+# decoded. intensity is the length of the intensity vector of the spot.
+SPOT_DTYPE = np.dtype([
+    ('x', np.float32),
+    ('y', np.float32),
+    ('gene', np.int32),
+    ('distance', np.float32),
+    ('intensity', np.float32),
+])
+
+# The number of spots whose similarities to all barcodes are computed at once
+_CHUNK_SIZE = 65536
+
+
+class Codebook:
+    """The barcodes of the genes. A barcode tells which channels light up in each round.
+
+    ...
+
+    Attributes
+    ----------
+    names : List[str]
+        the name of each gene
+    barcodes : np.ndarray
+        the barcodes of shape (genes, rounds, channels)
+    """
+
+    def __init__(self, names: List[str], barcodes: np.ndarray):
+        """Initializes a codebook.
+
+        Args:
+            names (List[str]): The name of each gene.
+            barcodes (np.ndarray): The expected intensities of each gene of shape
+                (genes, rounds, channels), usually 1 for channels that light up and 0 otherwise.
+        """
+        if len(names) != len(barcodes):
+            raise ValueError('Got {} names for {} barcodes'.format(len(names), len(barcodes)))
+        self.names = list(names)
+        self.barcodes = np.asarray(barcodes, dtype=np.float32)
+
+    @classmethod
+    def from_channel_indices(cls, names: List[str], channels: np.ndarray,
+                             channel_count: int) -> 'Codebook':
+        """Creates a codebook where exactly one channel lights up in each round.
+
+        Args:
+            names (List[str]): The name of each gene.
+            channels (np.ndarray): The channel of each gene in each round of shape
+                (genes, rounds).
+            channel_count (int): The number of channels.
+
+        Returns:
+            Codebook: the codebook
+        """
+        channels = np.asarray(channels)
+        barcodes = np.zeros(channels.shape + (channel_count,), dtype=np.float32)
+        np.put_along_axis(barcodes, channels[..., np.newaxis], 1, axis=-1)
+        return cls(names, barcodes)
+
+    def get_round_count(self) -> int:
+        """Returns the number of rounds of the barcodes.
+
+        Returns:
+            int: the number of rounds
+        """
+        return self.barcodes.shape[1]
+
+    def get_channel_count(self) -> int:
+        """Returns the number of channels of the barcodes.
+
+        Returns:
+            int: the number of channels
+        """
+        return self.barcodes.shape[2]
+
+
+def _normalize(vectors: np.ndarray) -> tuple:
+    """Scales vectors (n, dimensions) to unit length and returns them with their lengths.
+    """
+    lengths = np.linalg.norm(vectors, axis=1)
+    return vectors / np.where(lengths > 0, lengths, 1)[:, np.newaxis], lengths
+
+
+class SpotDecoder:
+    """Reads out the intensities of spots across all rounds and channels of a registered tile
+        and assigns each spot the gene with the nearest barcode. All spots are processed at
+        once, so a tile with millions of spots is decoded in a few array operations.
+
+    ...
+
+    Attributes
+    ----------
+    codebook : Codebook
+        the barcodes the spots are decoded against
+    channels : List[int]
+        the channels of the tile that correspond to the channels of the codebook
+    radius : int
+        the intensity of a spot is the mean of the (2 * radius + 1)^2 pixels around it
+    focus_level : int
+        the focus level the intensities are read from
+    max_distance : float
+        spots whose normalized intensities are further than this from every normalized barcode
+        are not assigned a gene. The distance between unit vectors is at most 2.
+    """
+
+    def __init__(self,
+                 codebook: Codebook,
+                 channels: List[int] = None,
+                 radius: int = 1,
+                 focus_level: int = 0,
+                 max_distance: float = None):
+        """Initializes the decoder.
+
+        Args:
+            codebook (Codebook): The barcodes the spots are decoded against.
+            channels (List[int], optional): The channels of the tile that correspond to the
+                channels of the codebook. Defaults to None (all channels except the nucleaus
+                channel).
+            radius (int, optional): The radius of the window the intensity of a spot is
+                averaged over, 0 uses the pixel of the spot only. Defaults to 1.
+            focus_level (int, optional): The focus level the intensities are read from.
+                Defaults to 0.
+            max_distance (float, optional): The largest distance of a decoded spot to its
+                barcode. Defaults to None (every spot is decoded).
+        """
+        self.codebook = codebook
+        self.channels = channels
+        self.radius = radius
+        self.focus_level = focus_level
+        self.max_distance = max_distance
+        self._barcodes, _ = _normalize(codebook.barcodes.reshape(len(codebook.barcodes), -1))
+
+    def get_channels(self, tile: Tile) -> List[int]:
+        """Returns the channels of the tile that are read out.
+
+        Args:
+            tile (Tile): the tile
+
+        Returns:
+            List[int]: the channels
+        """
+        if self.channels is not None:
+            return list(self.channels)
+        nucleaus_channel = tile.get_round(0).nucleaus_channel
+        return [channel for channel in range(tile.get_channel_count())
+                if channel != nucleaus_channel]
+
+    def extract_intensities(self, tile: Tile, peaks: np.ndarray) -> np.ndarray:
+        """Reads the intensity of every spot in every round and channel.
+
+        Args:
+            tile (Tile): The registered tile.
+            peaks (np.ndarray): The spots (x, y) of shape (n, 2).
+
+        Returns:
+            np.ndarray: The intensities of shape (n, rounds, channels).
+        """
+        channels = self.get_channels(tile)
+        intensities = np.empty((len(peaks), tile.get_round_count(), len(channels)),
+                               dtype=np.float32)
+        if len(peaks) == 0:
+            return intensities
+
+        # only the read out planes are loaded, lazily transformed rounds are resampled per plane
+        for round in range(tile.get_round_count()):
+            image = tile.get_round(round)
+            for i, channel in enumerate(channels):
+                plane = image.get_focus_level(channel, self.focus_level)
+                if self.radius > 0:
+                    plane = scipy.ndimage.uniform_filter(
+                        plane, 2 * self.radius + 1, output=np.float32)
+                x = np.clip(np.round(peaks[:, 0]).astype(np.intp), 0, plane.shape[-1] - 1)
+                y = np.clip(np.round(peaks[:, 1]).astype(np.intp), 0, plane.shape[-2] - 1)
+                intensities[:, round, i] = plane[y, x]
+        return intensities
+
+    def decode(self, intensities: np.ndarray) -> tuple:
+        """Assigns each intensity vector the gene with the nearest barcode. Intensities and
+            barcodes are normalized to unit length first, so only the relative brightness of
+            the channels matters.
+
+        Args:
+            intensities (np.ndarray): The intensities of shape (n, rounds, channels).
+
+        Returns:
+            tuple: the gene index of each spot (-1 if not decoded), the distance to the barcode
+                and the length of the intensity vector, each of shape (n,)
+        """
+        vectors, lengths = _normalize(
+            intensities.reshape(len(intensities), -1).astype(np.float32, copy=False))
+        genes = np.empty(len(vectors), dtype=np.int32)
+        # For unit vectors the nearest barcode is the one with the largest dot product. The
+        # spots are processed in chunks to bound the size of the similarity matrix.
+        for start in range(0, len(vectors), _CHUNK_SIZE):
+            genes[start:start + _CHUNK_SIZE] = np.argmax(
+                vectors[start:start + _CHUNK_SIZE] @ self._barcodes.T, axis=1)
+        distances = np.linalg.norm(vectors - self._barcodes[genes], axis=1)
+        genes[lengths == 0] = -1
+        if self.max_distance is not None:
+            genes[distances > self.max_distance] = -1
+        return genes, distances, lengths
+
+    def decode_tile(self, tile: Tile, peaks: np.ndarray) -> np.ndarray:
+        """Extracts and decodes the intensities of all spots of a tile.
+
+        Args:
+            tile (Tile): The registered tile.
+            peaks (np.ndarray): The spots (x, y) of shape (n, 2), e.g. found by a PeakFinder
+                in the reference round.
+
+        Returns:
+            np.ndarray: The spots table, a structured array with the fields of SPOT_DTYPE.
+        """
+        genes, distances, lengths = self.decode(self.extract_intensities(tile, peaks))
+        spots = np.empty(len(peaks), dtype=SPOT_DTYPE)
+        spots['x'] = peaks[:, 0]
+        spots['y'] = peaks[:, 1]
+        spots['gene'] = genes
+        spots['distance'] = distances
+        spots['intensity'] = lengths
+        return spots
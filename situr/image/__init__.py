@@ -1,3 +1,7 @@
 from .situ_image import extend_dim, remove_dim
 from .situ_image import SituImage
+from .image_backend import ImageBackend, PillowImageBackend, MemmapImageBackend
+from .image_backend import fingerprint_files
 from .situ_tile import Tile
+from .projection import Projection, MaxIntensityProjection, BestFocusProjection, ExtendedDepthOfFieldProjection
+from .tile_collection import TileCollection
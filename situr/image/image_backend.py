@@ -0,0 +1,211 @@
+import abc
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from typing import List
+
+
+def _read_plane(file: str) -> np.ndarray:
+    """Reads a single 2D plane. Files ending in .npy are memory mapped, all others are decoded
+        with PIL.
+    """
+    if file.endswith('.npy'):
+        return np.load(file, mmap_mode='r')
+    return np.array(Image.open(file))
+
+
+def fingerprint_files(file_list: List[List[str]]) -> str:
+    """Returns a hash of the names, sizes and modification times of the files of a SituImage.
+        It changes whenever one of the files is replaced.
+
+    Args:
+        file_list (List[List[str]]): The file list of a SituImage.
+
+    Returns:
+        str: the hex digest identifying the files
+    """
+    sha = hashlib.sha1()
+    for focus_level_list in file_list:
+        for file in focus_level_list:
+            stat = os.stat(file)
+            sha.update(repr((os.path.abspath(file), stat.st_size, stat.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+
+class ImageBackend:
+    """Abstract class describing how the files of a SituImage are turned into image data.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def load(self,
+             file_list: List[List[str]],
+             channels: List[int] = None,
+             focus_levels: List[int] = None,
+             out: np.ndarray = None) -> np.ndarray:
+        """Loads the image data described by a file list.
+
+        Args:
+            file_list (List[List[str]]): The file list of a SituImage.
+            channels (List[int], optional): Only load these channels. Defaults to None (all).
+            focus_levels (List[int], optional): Only load these focus levels.
+                Defaults to None (all).
+            out (np.ndarray, optional): Preallocated array of the right shape the data is
+                written to. Defaults to None (a new array is returned).
+
+        Raises:
+            NotImplementedError: This method is abstract and therefore calling
+                it results in an error.
+
+        Returns:
+            np.ndarray: the image data of shape (channels, focus_levels, image_size_y, image_size_x)
+        """
+        raise NotImplementedError(self.__class__.__name__ + '.load')
+
+    @staticmethod
+    def _select(file_list: List[List[str]],
+                channels: List[int] = None,
+                focus_levels: List[int] = None) -> tuple:
+        """Returns the requested channel and focus level indices, all if None is given.
+        """
+        if channels is None:
+            channels = range(len(file_list))
+        if focus_levels is None:
+            focus_levels = range(len(file_list[0]))
+        return list(channels), list(focus_levels)
+
+
+class PillowImageBackend(ImageBackend):
+    """Decodes the files on a thread pool directly into one preallocated array.
+        It inherits from ImageBackend.
+
+    ...
+
+    Attributes
+    ----------
+    workers : int
+        the number of threads decoding files
+    """
+
+    def __init__(self, workers: int = None):
+        """Initializes the backend.
+
+        Args:
+            workers (int, optional): The number of threads decoding files, 1 decodes in the
+                calling thread. Defaults to None (the default of ThreadPoolExecutor).
+        """
+        self.workers = workers
+
+    def load(self,
+             file_list: List[List[str]],
+             channels: List[int] = None,
+             focus_levels: List[int] = None,
+             out: np.ndarray = None) -> np.ndarray:
+        channels, focus_levels = self._select(file_list, channels, focus_levels)
+        planes = [(i, j, file_list[channel][focus_level])
+                  for i, channel in enumerate(channels)
+                  for j, focus_level in enumerate(focus_levels)]
+
+        # The first plane defines shape and dtype of the whole image
+        first_plane = _read_plane(planes[0][2])
+        data = out if out is not None else np.empty(
+            (len(channels), len(focus_levels)) + first_plane.shape, dtype=first_plane.dtype)
+        data[0, 0, :, :] = first_plane
+        del first_plane
+
+        def read(plane):
+            i, j, file = plane
+            data[i, j, :, :] = _read_plane(file)
+
+        if self.workers == 1:
+            for plane in planes[1:]:
+                read(plane)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # list() to reraise exceptions of the workers
+                list(executor.map(read, planes[1:]))
+        return data
+
+
+class MemmapImageBackend(ImageBackend):
+    """Keeps the data of a round in a single .npy file of shape
+        (channels, focus_levels, image_size_y, image_size_x) and memory maps it. Slicing a channel
+        or focus level therefore only reads the bytes of that slice from disk.
+        The .npy file is created from the original files on first use, one plane at a time.
+        It inherits from ImageBackend.
+
+    ...
+
+    Attributes
+    ----------
+    directory : str
+        the directory the converted rounds are stored in
+    mmap_mode : str
+        the mode passed to numpy.load. The default 'c' (copy on write) allows transformations
+        to be applied in memory without changing the file.
+    """
+
+    def __init__(self, directory: str, mmap_mode: str = 'c'):
+        """Initializes the backend.
+
+        Args:
+            directory (str): The directory the converted rounds are stored in.
+            mmap_mode (str, optional): The memory map mode (see numpy.load). Defaults to 'c'.
+        """
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+
+    def get_path(self, file_list: List[List[str]]) -> str:
+        """Returns the path of the converted .npy file for a file list. The path depends on the
+            names, sizes and modification times of the files, so a replaced file is converted
+            again instead of reading stale data.
+
+        Args:
+            file_list (List[List[str]]): The file list of a SituImage.
+
+        Returns:
+            str: the path of the .npy file
+        """
+        return os.path.join(self.directory, fingerprint_files(file_list) + '.npy')
+
+    def load(self,
+             file_list: List[List[str]],
+             channels: List[int] = None,
+             focus_levels: List[int] = None,
+             out: np.ndarray = None) -> np.ndarray:
+        path = self.get_path(file_list)
+        if not os.path.exists(path):
+            self.convert(file_list, path)
+        data = np.load(path, mmap_mode=self.mmap_mode)
+        if channels is not None or focus_levels is not None:
+            channels, focus_levels = self._select(file_list, channels, focus_levels)
+            data = data[np.ix_(channels, focus_levels)]
+        if out is None:
+            return data
+        out[...] = data
+        return out
+
+    @staticmethod
+    def convert(file_list: List[List[str]], path: str):
+        """Writes the files of a round into one .npy file without holding more than one plane
+            in memory.
+
+        Args:
+            file_list (List[List[str]]): The file list of a SituImage.
+            path (str): The .npy file to write.
+        """
+        first_plane = _read_plane(file_list[0][0])
+        shape = (len(file_list), len(file_list[0])) + first_plane.shape
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Write to a temporary file first so that an interrupted conversion is not picked up
+        temporary_path = path + '.tmp.npy'
+        data = np.lib.format.open_memmap(
+            temporary_path, mode='w+', dtype=first_plane.dtype, shape=shape)
+        for channel, focus_level_list in enumerate(file_list):
+            for focus_level, file in enumerate(focus_level_list):
+                data[channel, focus_level, :, :] = _read_plane(file)
+        data.flush()
+        del data
+        os.replace(temporary_path, path)
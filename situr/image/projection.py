@@ -0,0 +1,146 @@
+import abc
+
+import numpy as np
+import scipy.ndimage
+
+from situr.image.situ_image import SituImage
+
+
+def _laplace(stack: np.ndarray) -> np.ndarray:
+    """Returns the laplacian of each plane of the stack over the last two axes. The border
+        pixels are set to zero.
+    """
+    stack = stack.astype(np.float32, copy=False)
+    laplacian = np.zeros(stack.shape, dtype=np.float32)
+    laplacian[..., 1:-1, 1:-1] = stack[..., :-2, 1:-1] + stack[..., 2:, 1:-1] + \
+        stack[..., 1:-1, :-2] + stack[..., 1:-1, 2:] - 4 * stack[..., 1:-1, 1:-1]
+    return laplacian
+
+
+def _cast(projected: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Casts a projection back to the data type of the stack, rounding integer types.
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        projected = np.clip(np.round(projected), info.min, info.max)
+    return projected.astype(dtype, copy=False)
+
+
+class Projection:
+    """Abstract class for projections that reduce the focus levels of an image to a single
+        plane per channel. Registration and peak finding can then run on the projected plane
+        instead of a single focus level.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def get_parameters(self) -> dict:
+        """Returns the parameters that influence the projection.
+
+        Returns:
+            dict: the json serializable parameters of this projection
+        """
+        return dict(vars(self))
+
+    @abc.abstractmethod
+    def project(self, stack: np.ndarray) -> np.ndarray:
+        """Projects a stack of focus levels.
+
+        Args:
+            stack (np.ndarray): The stack of shape (..., focus_levels, image_size_y, image_size_x),
+                e.g. (channels, focus_levels, image_size_y, image_size_x)
+
+        Returns:
+            np.ndarray: The projected planes of shape (..., image_size_y, image_size_x)
+        """
+        raise NotImplementedError(self.__class__.__name__ + '.project')
+
+    def project_image(self, img: SituImage) -> np.ndarray:
+        """Projects all channels of an image in a single pass.
+
+        Args:
+            img (SituImage): The image
+
+        Returns:
+            np.ndarray: The projected channels of shape (channels, image_size_y, image_size_x)
+        """
+        return self.project(img.get_data())
+
+    def project_channel(self, img: SituImage, channel: int) -> np.ndarray:
+        """Projects one channel of an image. If the image is not loaded only the files of this
+            channel are read.
+
+        Args:
+            img (SituImage): The image
+            channel (int): The channel to project
+
+        Returns:
+            np.ndarray: The projected plane of shape (image_size_y, image_size_x)
+        """
+        if img.is_loaded():
+            return self.project(img.get_channel(channel))
+        return self.project(img.read_planes(channels=[channel])[0])
+
+
+class MaxIntensityProjection(Projection):
+    """Projects each pixel to its maximum over all focus levels. It inherits from Projection.
+    """
+
+    def project(self, stack: np.ndarray) -> np.ndarray:
+        return stack.max(axis=-3)
+
+
+class BestFocusProjection(Projection):
+    """Selects the sharpest focus level of each channel, where sharpness is the variance of the
+        laplacian of a plane. It inherits from Projection.
+    """
+
+    def get_focus_levels(self, stack: np.ndarray) -> np.ndarray:
+        """Returns the index of the sharpest focus level.
+
+        Args:
+            stack (np.ndarray): The stack of shape (..., focus_levels, image_size_y, image_size_x)
+
+        Returns:
+            np.ndarray: The sharpest focus level of shape (...)
+        """
+        return _laplace(stack).var(axis=(-2, -1)).argmax(axis=-1)
+
+    def project(self, stack: np.ndarray) -> np.ndarray:
+        index = self.get_focus_levels(stack)[..., np.newaxis, np.newaxis, np.newaxis]
+        return np.take_along_axis(stack, index, axis=-3)[..., 0, :, :]
+
+
+class ExtendedDepthOfFieldProjection(Projection):
+    """Blends all focus levels so that each region is taken from the focus levels where it is
+        sharpest. The weight of a focus level at a pixel is its local laplacian energy.
+        It inherits from Projection.
+
+    ...
+
+    Attributes
+    ----------
+    sigma : float
+        the standard deviation of the gaussian the laplacian energy is smoothed with, larger
+        values give smoother transitions between focus levels
+    """
+
+    def __init__(self, sigma: float = 2.0):
+        """Initializes the projection.
+
+        Args:
+            sigma (float, optional): The standard deviation of the gaussian the laplacian
+                energy is smoothed with. Defaults to 2.0.
+        """
+        self.sigma = sigma
+
+    def project(self, stack: np.ndarray) -> np.ndarray:
+        energy = _laplace(stack)
+        np.square(energy, out=energy)
+        sigma = (0,) * (stack.ndim - 2) + (self.sigma, self.sigma)
+        energy = scipy.ndimage.gaussian_filter(energy, sigma)
+        total = energy.sum(axis=-3, keepdims=True)
+        # flat regions have no energy in any focus level and are averaged
+        weights = np.where(total > 0, energy / np.where(total > 0, total, 1),
+                           np.float32(1 / stack.shape[-3]))
+        projected = (weights * stack).sum(axis=-3)
+        return _cast(projected, stack.dtype)
@@ -1,8 +1,16 @@
+import itertools
+import os
+from collections import OrderedDict
 import numpy as np
 from PIL import Image
-from typing import List
+from typing import Callable, List, Tuple
 
-from situr.transformation import Transform, IdentityTransform
+from situr.transformation import Transform, IdentityTransform, ScratchBuffers
+from situr.transformation import apply_transformations_to_stack
+from situr.image.image_backend import ImageBackend, PillowImageBackend, fingerprint_files
+
+# Versions handed out to modified images, 0 is reserved for unmodified data
+_data_versions = itertools.count(1)
 
 
 def extend_dim(array: np.ndarray) -> np.ndarray:
@@ -41,7 +49,8 @@ class SituImage:
     ----------
     data : numpy.array
         the image data containing all the channels of
-        shape (channels, focus_levels, image_size_y, image_size_x)
+        shape (channels, focus_levels, image_size_y, image_size_x). Setting it directly gives
+        the image a new version.
     files :  List[List[str]]
         A list of lists. Each inner list corresponds to one focus level.
         Its contents correspons to a file for each channel.
@@ -50,9 +59,38 @@ class SituImage:
     channel_transformations : List[Transform]
         A list of transformations for each channel,
         wherby the index corresponds to the channel
+    channel_registration_results : List[RegistrationResult]
+        For each channel the result of the registration that produced its transformation
+        (see situr.registration.RegistrationResult), None if it was not registered
+    backend : ImageBackend
+        the backend that turns the files into image data
+    float_dtype : numpy.dtype
+        the working precision. Floating point image data is stored with it and
+        transformations are interpolated with it.
+    version : int
+        0 while the data is unmodified, changed to a new unique value whenever a
+        transformation is applied to the data or the data is set directly.
+    on_access : Callable[[SituImage, bool], None]
+        Optional callback that is notified whenever the image data is accessed. The second
+        argument tells if the data had to be loaded from disk for this access.
+    buffer : np.ndarray
+        Optional preallocated array (e.g. a round of a Tile buffer) the data is loaded into,
+        so that data is a view into it.
+    lazy_transformations : List[Transform]
+        For each channel the transformation that is applied when a plane is read with
+        get_focus_level or get_channel, None if no transformation is applied lazily
+        (see apply_transformations).
+    max_cached_planes : int
+        the number of lazily transformed planes that are kept in memory
     """
 
-    def __init__(self, file_list: List[List[str]], nucleaus_channel: int = 4):
+    def __init__(self,
+                 file_list: List[List[str]],
+                 nucleaus_channel: int = 4,
+                 on_access: Callable[['SituImage', bool], None] = None,
+                 backend: ImageBackend = None,
+                 float_dtype=np.float32,
+                 max_cached_planes: int = 16):
         """Initializes a situ image.
 
         Args:
@@ -67,13 +105,45 @@ class SituImage:
                     ]
             nucleaus_channel (int, optional): The channel that is showing the nucleai
                 and not other data. Defaults to 4.
+            on_access (Callable[[SituImage, bool], None], optional): Callback that is called
+                with the image and a flag telling if the data was loaded on each data access.
+                Defaults to None.
+            backend (ImageBackend, optional): The backend used to load the files, e.g.
+                MemmapImageBackend to avoid reading whole rounds into memory.
+                Defaults to None (PillowImageBackend).
+            float_dtype (optional): The working precision. Integer data is kept as it is,
+                floating point data is converted to this dtype. Defaults to np.float32.
+            max_cached_planes (int, optional): The number of lazily transformed planes kept in
+                memory. Defaults to 16.
         """
         self.files = file_list
-        self.data = None
+        self.float_dtype = np.dtype(float_dtype)
+        self.on_access = on_access
+        self.backend = backend if backend is not None else PillowImageBackend()
+        self._data = None
+        self.buffer = None
+        self.version = 0
         self.nucleaus_channel = nucleaus_channel
         self.channel_transformations = [
             IdentityTransform() for file in file_list
         ]
+        self.channel_registration_results = [None for file in file_list]
+        self.lazy_transformations = None
+        self.max_cached_planes = max_cached_planes
+        self._plane_cache: 'OrderedDict[Tuple[int, int], np.ndarray]' = OrderedDict()
+
+    @property
+    def data(self) -> np.ndarray:
+        """The loaded image data, None if the image is not loaded (see get_data).
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data: np.ndarray):
+        # data that is set directly does not come from the files, so cached results for the
+        # files (e.g. found peaks) must not be used for it
+        self._data = data
+        self.version = next(_data_versions)
 
     def get_data(self) -> np.ndarray:
         """Returns the image data (also loads it if not yet in memory).
@@ -81,54 +151,208 @@ class SituImage:
         Returns:
             np.ndarray: the image data in the shape (channel, focus_level, image_dim, image_dim)
         """
-        if self.data is None:
+        loaded = self.data is None
+        if loaded:
             self._load_image()
+        if self.on_access is not None:
+            self.on_access(self, loaded)
         return self.data
 
-    def apply_transformations(self):
-        """Applies the stored transformations to the image.
-        """
-        for i, transformation in enumerate(self.channel_transformations):
-            for focus_level in range(self.get_focus_level_count()):
-                img = self.get_focus_level(i, focus_level)
-                transformation.apply_tranformation(img)
+    def apply_transformations(self,
+                              additional_transformation: Transform = None,
+                              workers: int = 1,
+                              output: np.ndarray = None,
+                              lazy: bool = False,
+                              dtype=None) -> np.ndarray:
+        """Applies the stored transformations to the image. Each plane is resampled only once.
+            Changing the image data keeps its size, so parts that are transformed outside of
+            it are cut off. Use output or dtype to get the whole transformed image.
 
-    def apply_transform_to_whole_image(self, transform: Transform):
+        Args:
+            additional_transformation (Transform, optional): A transformation (e.g. of the round)
+                that is composed with each channel transformation and applied after it.
+                Defaults to None.
+            workers (int, optional): The number of threads the planes are distributed on.
+                Defaults to 1.
+            output (np.ndarray, optional): Preallocated array of shape
+                (channels, focus_levels, canvas_y, canvas_x) the transformed image is written to
+                instead of changing the image data. Its dtype is kept and the canvas has to be
+                at least of the size returned by get_output_shape. Defaults to None.
+            lazy (bool, optional): If True nothing is resampled now. Instead get_focus_level and
+                get_channel transform a plane when it is first read and keep the last
+                max_cached_planes planes in memory. The raw data is neither loaded nor changed,
+                get_data still returns it. Defaults to False.
+            dtype (optional): If given and output is None, the transformed image is written to
+                a new array of this dtype and the size returned by get_output_shape instead of
+                changing the image data. Defaults to None.
+
+        Raises:
+            ValueError: If output is too small to hold the transformed image.
+
+        Returns:
+            np.ndarray: the transformed image data (output if it was given or allocated), None
+                if lazy
+        """
+        transformations = self._get_transformations(additional_transformation)
+        if lazy:
+            self._set_lazy_transformations(self._compose_lazy(transformations))
+            return None
+        return self._resample(transformations, workers, output, dtype)
+
+    def apply_transform_to_whole_image(self,
+                                       transform: Transform,
+                                       workers: int = 1,
+                                       output: np.ndarray = None,
+                                       lazy: bool = False,
+                                       dtype=None) -> np.ndarray:
         """Applies an external transformation to every channel and focus level of an image.
 
         Args:
             transform (Transform): the transformation that will be applied
+            workers (int, optional): The number of threads the planes are distributed on.
+                Defaults to 1.
+            output (np.ndarray, optional): Preallocated array the transformed image is written to
+                instead of changing the image data (see apply_transformations). Defaults to None.
+            lazy (bool, optional): If True the transformation is only applied when a plane is
+                read (see apply_transformations). Defaults to False.
+            dtype (optional): The dtype of a new array the transformed image is written to
+                instead of changing the image data (see apply_transformations).
+                Defaults to None.
+
+        Raises:
+            ValueError: If output is too small to hold the transformed image.
+
+        Returns:
+            np.ndarray: the transformed image data (output if it was given or allocated), None
+                if lazy
         """
-        for channel in range(self.get_channel_count()):
-            for focus_level in range(self.get_focus_level_count()):
-                img = self.get_focus_level(channel, focus_level)
-                transform.apply_tranformation(img)
+        if lazy:
+            self._set_lazy_transformations(self._compose_lazy([transform for _ in self.files]))
+            return None
+        return self._resample([transform] * self.get_channel_count(), workers, output, dtype)
 
-    def set_channel_transformation(self, channel: int, transformation: Transform):
+    def get_output_shape(self, additional_transformation: Transform = None) -> Tuple[int, ...]:
+        """Returns the shape of an output that holds the whole image after apply_transformations
+            (see Transform.get_output_shape).
+
+        Args:
+            additional_transformation (Transform, optional): The transformation that is passed
+                on to apply_transformations. Defaults to None.
+
+        Returns:
+            Tuple[int, ...]: the shape (channels, focus_levels, canvas_y, canvas_x)
+        """
+        return self._get_output_shape(
+            self._compose_lazy(self._get_transformations(additional_transformation)))
+
+    def _get_transformations(self, additional_transformation: Transform) -> List[Transform]:
+        """Returns the channel transformations composed with the additional one.
+        """
+        if additional_transformation is None:
+            return self.channel_transformations
+        return [transformation.compose(additional_transformation)
+                for transformation in self.channel_transformations]
+
+    def _get_output_shape(self, transformations: List[Transform]) -> Tuple[int, ...]:
+        shape = self.get_data().shape
+        canvas = np.max([transformation.get_output_shape(shape[-2:])
+                         for transformation in transformations], axis=0)
+        return shape[:-2] + tuple(int(size) for size in canvas)
+
+    def _compose_lazy(self, transformations: List[Transform]) -> List[Transform]:
+        """Composes the pending lazy transformations with the given ones.
+        """
+        if self.lazy_transformations is None:
+            return transformations
+        return [lazy_transformation.compose(transformation) for lazy_transformation,
+                transformation in zip(self.lazy_transformations, transformations)]
+
+    def _set_lazy_transformations(self, transformations: List[Transform]):
+        self.lazy_transformations = transformations
+        self._plane_cache.clear()
+        self.version = next(_data_versions)
+
+    def _resample(self,
+                  transformations: List[Transform],
+                  workers: int,
+                  output: np.ndarray,
+                  dtype) -> np.ndarray:
+        """Resamples the data with the transformations composed after the pending lazy ones.
+            The data is changed if neither output nor dtype is given.
+        """
+        transformations = self._compose_lazy(transformations)
+        if output is not None or dtype is not None:
+            shape = self._get_output_shape(transformations)
+            if output is None:
+                output = np.empty(shape, dtype=dtype)
+            elif output.shape[:-2] != shape[:-2] or \
+                    any(size < required for size, required in zip(output.shape[-2:], shape[-2:])):
+                raise ValueError('The output of shape {} cannot hold the transformed image of '
+                                 'shape {}'.format(output.shape, shape))
+            return apply_transformations_to_stack(self.get_data(), transformations,
+                                                  workers=workers, output=output,
+                                                  float_dtype=self.float_dtype)
+        apply_transformations_to_stack(self.get_data(), transformations, workers=workers,
+                                       float_dtype=self.float_dtype)
+        self.lazy_transformations = None
+        self._plane_cache.clear()
+        self.version = next(_data_versions)
+        return self.data
+
+    def project(self, projection) -> np.ndarray:
+        """Replaces the focus levels of every channel by a single projected plane, so that
+            later stages only process one focus level. The files are not changed, reloading the
+            image restores all focus levels.
+
+        Args:
+            projection (Projection): The projection, e.g. MaxIntensityProjection()
+
+        Returns:
+            np.ndarray: the projected image data of shape (channels, 1, width, height)
+        """
+        self._data = np.ascontiguousarray(projection.project(self.get_data())[:, np.newaxis])
+        # the projection has a different shape and no longer fits the buffer
+        self.buffer = None
+        self.version = next(_data_versions)
+        return self._data
+
+    def set_channel_transformation(self,
+                                   channel: int,
+                                   transformation: Transform,
+                                   registration_result=None):
         """Sets a transformation for a channel, however does not apply it.
 
         Args:
             channel (int): The channel that the transformation should be applied to
             transformation (Transform): The transformation that will be applied to
                 the specified channel
+            registration_result (RegistrationResult, optional): The result of the registration
+                the transformation comes from. Defaults to None.
         """
         self.channel_transformations[channel] = transformation
+        self.channel_registration_results[channel] = registration_result
 
     def get_channel_count(self) -> int:
-        """Method to get the number of channels an image has.
+        """Method to get the number of channels an image has. It does not load the image and
+            does not count as access (see on_access).
 
         Returns:
             int: the number of channels
         """
-        return self.get_data().shape[0]
+        if self._data is None:
+            return len(self.files)
+        return self._data.shape[0]
 
     def get_focus_level_count(self) -> int:
-        """Method to get the number of focus levels an image has.
+        """Method to get the number of focus levels an image has. It does not load the image
+            and does not count as access (see on_access).
 
         Returns:
             int: the number of focus levels
         """
-        return self.get_data().shape[1]
+        if self._data is None:
+            return len(self.files[0])
+        return self._data.shape[1]
 
     def get_focus_level(self, channel: int, focus_level: int) -> np.ndarray:
         """Loads channel and focus level of an image.
@@ -140,6 +364,8 @@ class SituImage:
         Returns:
             np.ndarray: The loaded image of shape (width, height)
         """
+        if self.lazy_transformations is not None:
+            return self._get_transformed_plane(channel, focus_level)
         return self.get_data()[channel, focus_level, :, :]
 
     def get_channel(self, channel: int) -> np.ndarray:
@@ -151,23 +377,144 @@ class SituImage:
         Returns:
             np.ndarray: The loaded image of shape (focus_level, width, height)
         """
+        if self.lazy_transformations is not None:
+            return np.stack([self._get_transformed_plane(channel, focus_level)
+                             for focus_level in range(len(self.files[channel]))])
         return self.get_data()[channel, :, :, :]
 
+    def _get_transformed_plane(self, channel: int, focus_level: int) -> np.ndarray:
+        """Returns a plane transformed by its lazy transformation. The raw plane is read from
+            the data if it is loaded and otherwise only its file is read.
+        """
+        key = (channel, focus_level)
+        plane = self._plane_cache.get(key)
+        if plane is not None:
+            self._plane_cache.move_to_end(key)
+            return plane
+        raw_plane = self.read_planes([channel], [focus_level])[0, 0]
+        plane = self.lazy_transformations[channel].apply_tranformation(
+            raw_plane, output=np.empty(raw_plane.shape, dtype=raw_plane.dtype),
+            buffers=ScratchBuffers(self.float_dtype))
+        # Cached planes are shared between callers and must not be modified
+        plane.flags.writeable = False
+        self._plane_cache[key] = plane
+        while len(self._plane_cache) > self.max_cached_planes:
+            self._plane_cache.popitem(last=False)
+        return plane
+
     def _load_image(self):
         """Loads the whole image from files
         """
-        image_list = []
-        for focus_level_list in self.files:
-            channels = []
-            for file in focus_level_list:
-                channels.append(np.array(Image.open(file)))
-            image_list.append(channels)
-        self.data = np.array(image_list)
+        data = self._convert(self.backend.load(self.files, out=self.buffer))
+        if self.buffer is not None and data is not self.buffer:
+            self.buffer[...] = data
+            data = self.buffer
+        self._data = data
+        # the raw data with pending lazy transformations keeps the state it had before
+        if self.lazy_transformations is None:
+            self.version = 0
+
+    def set_buffer(self, buffer: np.ndarray):
+        """Makes the image data a view into a preallocated array. Loaded data is moved into the
+            buffer, otherwise the data is loaded into it on the next access.
+
+        Args:
+            buffer (np.ndarray): The array of shape (channels, focus_levels, width, height)
+                or None to load into new arrays again, loaded data is then copied out of the
+                old buffer
+        """
+        if self._data is not None and self._data is not buffer:
+            if buffer is not None:
+                buffer[...] = self._data
+                self._data = buffer
+            elif self._data is self.buffer:
+                self._data = self._data.copy()
+        self.buffer = buffer
+
+    def read_planes(self, channels: List[int] = None, focus_levels: List[int] = None) -> np.ndarray:
+        """Reads only the requested channels and focus levels. If the image is not loaded only
+            the files of these planes are read and the image stays unloaded.
+
+        Args:
+            channels (List[int], optional): The channels to read. Defaults to None (all).
+            focus_levels (List[int], optional): The focus levels to read. Defaults to None (all).
+
+        Returns:
+            np.ndarray: The planes of shape (len(channels), len(focus_levels), width, height)
+        """
+        if self.data is not None:
+            if channels is None:
+                channels = range(self.data.shape[0])
+            if focus_levels is None:
+                focus_levels = range(self.data.shape[1])
+            return self.data[np.ix_(list(channels), list(focus_levels))]
+        return self._convert(self.backend.load(self.files, channels, focus_levels))
+
+    def _convert(self, data: np.ndarray) -> np.ndarray:
+        """Converts floating point data to the working precision.
+        """
+        if np.issubdtype(data.dtype, np.floating) and data.dtype != self.float_dtype:
+            return data.astype(self.float_dtype)
+        return data
 
     def unload_image(self):
         """Unloads the image data to free up memory
         """
-        self.data = None
+        self._data = None
+
+    def get_fingerprint(self) -> str:
+        """Returns a hash of the file names, sizes and modification times of the image files.
+            It changes whenever one of the files is replaced.
+
+        Returns:
+            str: the hex digest identifying the files of this image
+        """
+        return fingerprint_files(self.files)
+
+    def get_state_key(self) -> tuple:
+        """Returns a hashable key that identifies the current content of the image data.
+            Unmodified images with the same files share a key, images that had transformations
+            applied get a unique key that changes with every applied transformation.
+
+        Returns:
+            tuple: the key of the current image content
+        """
+        if self.version == 0:
+            return ('files', tuple(tuple(focus_level_list) for focus_level_list in self.files))
+        return ('version', self.version)
+
+    def save_image(self, file_list: List[List[str]]):
+        """Writes every channel and focus level of the image to a file.
+
+        Args:
+            file_list (List[List[str]]): The files to write to with the same layout as the
+                file list passed to the constructor. Missing directories are created.
+        """
+        data = self.get_data()
+        for channel, focus_level_list in enumerate(file_list):
+            for focus_level, file in enumerate(focus_level_list):
+                directory = os.path.dirname(file)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                Image.fromarray(data[channel, focus_level, :, :]).save(file)
+
+    def is_loaded(self) -> bool:
+        """Tells if the image data is currently held in memory.
+
+        Returns:
+            bool: True if the data is loaded
+        """
+        return self.data is not None
+
+    def is_modified(self) -> bool:
+        """Tells if the loaded data differs from the files, e.g. because a transformation was
+            applied to it or it was projected. Unloading modified data loses the changes.
+            Pending lazy transformations do not modify the data.
+
+        Returns:
+            bool: True if the data can not be reloaded from the files
+        """
+        return self.is_loaded() and self.version != 0 and self.lazy_transformations is None
 
     def show_channel(self, channel: int, focus_level: int = 0, img_show=True) -> Image:
         """Prints and returns the specified channel and focus_level of the image.
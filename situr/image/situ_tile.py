@@ -1,9 +1,11 @@
 from situr.transformation import Transform, IdentityTransform
+import hashlib
 import numpy as np
 
 from situr.image.situ_image import SituImage
+from situr.image.image_backend import ImageBackend
 
-from typing import List
+from typing import Callable, List, Tuple
 
 
 class Tile:
@@ -18,9 +20,20 @@ class Tile:
         the images representing the individual rounds.
     round_transformations :  List[Transform]
         A list containing transformations for each round (e.g. for registration).
+    round_registration_results : List[RegistrationResult]
+        For each round the result of the registration that produced its transformation
+        (see situr.registration.RegistrationResult), None if it was not registered
+    data : np.ndarray
+        the buffer of shape (rounds, channels, focus_levels, image_size, image_size) the rounds
+        are views into, None until it is allocated (see allocate)
     """
 
-    def __init__(self, file_list: List[List[List[str]]], nucleaus_channel: int = 4):
+    def __init__(self,
+                 file_list: List[List[List[str]]],
+                 nucleaus_channel: int = 4,
+                 on_access: Callable[[SituImage, bool], None] = None,
+                 backend: ImageBackend = None,
+                 float_dtype=np.float32):
         """The constructor for a tile.
 
         Args:
@@ -29,43 +42,160 @@ class Tile:
                 channel and the final list represents the focus levels (for more go to SituImage).
             nucleaus_channel (int, optional): The channel that contains information about nucleai.
                 Defaults to 4.
+            on_access (Callable[[SituImage, bool], None], optional): Callback that is passed on
+                to every SituImage of this tile (see SituImage). Defaults to None.
+            backend (ImageBackend, optional): The backend used to load the rounds.
+                Defaults to None (PillowImageBackend).
+            float_dtype (optional): The working precision of the rounds (see SituImage).
+                Defaults to np.float32.
         """
         self.images = []
+        self.data = None
         self.round_transformations = []
+        self.round_registration_results = []
+        self._image_arguments = {'nucleaus_channel': nucleaus_channel, 'on_access': on_access,
+                                 'backend': backend, 'float_dtype': float_dtype}
         for situ_image_list in file_list:
-            self.images.append(
-                SituImage(situ_image_list, nucleaus_channel=nucleaus_channel))
-            self.round_transformations.append(IdentityTransform())
+            self.add_round(situ_image_list)
 
-    def apply_transformations(self):
-        """Method that first applies all round transformations
-            and then all channel transformations.
+    def add_round(self, situ_image_list: List[List[str]]) -> int:
+        """Appends a round, e.g. one acquired after the tile was registered. The round has no
+            transformation and no registration result, so it can be registered on its own
+            (see CombinedRegistration.register_added_rounds).
+
+        Args:
+            situ_image_list (List[List[str]]): The files of the round, one list of focus
+                levels per channel (see SituImage).
+
+        Returns:
+            int: the number of the new round
+        """
+        if self.data is not None:
+            # the buffer has room for the existing rounds only
+            self.release()
+        self.images.append(SituImage(situ_image_list, **self._image_arguments))
+        self.round_transformations.append(IdentityTransform())
+        self.round_registration_results.append(None)
+        return len(self.images) - 1
+
+    def apply_transformations(self,
+                              tile_transformation: Transform = None,
+                              workers: int = 1,
+                              output: np.ndarray = None,
+                              lazy: bool = False,
+                              dtype=None) -> np.ndarray:
+        """Method that first applies all channel transformations and then all round
+            transformations. The transformations are composed so that every plane is
+            resampled only once.
+
+        Args:
+            tile_transformation (Transform, optional): A transformation of the whole tile that
+                is applied after the round transformations. Defaults to None.
+            workers (int, optional): The number of threads the planes are distributed on.
+                Defaults to 1.
+            output (np.ndarray, optional): Preallocated array of shape
+                (rounds, channels, focus_levels, canvas_y, canvas_x) the transformed tile is
+                written to instead of changing the rounds. The canvas has to be at least of the
+                size returned by get_output_shape. Defaults to None.
+            lazy (bool, optional): If True a plane is only transformed when it is read with
+                get_focus_level or get_channel (see SituImage.apply_transformations).
+                Defaults to False.
+            dtype (optional): If given and output is None, the transformed tile is written to
+                a new array of this dtype and the size returned by get_output_shape instead of
+                changing the rounds. Defaults to None.
+
+        Raises:
+            ValueError: If output is too small to hold the transformed tile.
+
+        Returns:
+            np.ndarray: output if it was given or allocated, otherwise None
         """
-        self.apply_channel_transformations()
-        self.apply_round_transformations()
+        if output is None and dtype is not None and not lazy:
+            output = np.empty(self.get_output_shape(tile_transformation), dtype=dtype)
+        for round, transformation in enumerate(self.round_transformations):
+            if tile_transformation is not None:
+                transformation = transformation.compose(tile_transformation)
+            self.images[round].apply_transformations(
+                transformation, workers=workers,
+                output=None if output is None else output[round], lazy=lazy)
+        return output
+
+    def get_output_shape(self, tile_transformation: Transform = None) -> Tuple[int, ...]:
+        """Returns the shape of an output that holds all rounds after apply_transformations
+            (see SituImage.get_output_shape).
+
+        Args:
+            tile_transformation (Transform, optional): The transformation that is passed on to
+                apply_transformations. Defaults to None.
 
-    def apply_channel_transformations(self):
+        Returns:
+            Tuple[int, ...]: the shape (rounds, channels, focus_levels, canvas_y, canvas_x)
+        """
+        shapes = []
+        for round, transformation in enumerate(self.round_transformations):
+            if tile_transformation is not None:
+                transformation = transformation.compose(tile_transformation)
+            shapes.append(self.images[round].get_output_shape(transformation))
+        return (len(self.images),) + tuple(int(size) for size in np.max(shapes, axis=0))
+
+    def apply_channel_transformations(self, workers: int = 1):
         """Method that apllies all stored channel transformations.
             It does not apply any round transformations.
+
+        Args:
+            workers (int, optional): The number of threads the planes are distributed on.
+                Defaults to 1.
         """
         for i in range(self.get_round_count()):
-            self.images[i].apply_transformations()
+            self.images[i].apply_transformations(workers=workers)
 
-    def apply_round_transformations(self):
+    def apply_round_transformations(self, workers: int = 1):
         """Method that applies all stored transformations for each round.
             It doesn't apply channel transformations.
+
+        Args:
+            workers (int, optional): The number of threads the planes are distributed on.
+                Defaults to 1.
         """
         for round, transformation in enumerate(self.round_transformations):
-            self.images[round].apply_transform_to_whole_image(transformation)
+            self.images[round].apply_transform_to_whole_image(transformation, workers=workers)
+
+    def project(self, projection):
+        """Replaces the focus levels of every round by a single projected plane per channel
+            (see SituImage.project).
+
+        Args:
+            projection (Projection): The projection, e.g. MaxIntensityProjection()
+        """
+        for image in self.images:
+            image.project(projection)
 
-    def set_round_transformation(self, round: int, transformation: Transform):
+    def set_round_transformation(self,
+                                 round: int,
+                                 transformation: Transform,
+                                 registration_result=None):
         """Set the transformation for one round, however, does not apply it.
 
         Args:
             round (int): the round the transformation should be applied to
             transformation (Transform): the transformation for the round
+            registration_result (RegistrationResult, optional): The result of the registration
+                the transformation comes from. Defaults to None.
         """
         self.round_transformations[round] = transformation
+        self.round_registration_results[round] = registration_result
+
+    def get_fingerprint(self) -> str:
+        """Returns a hash of the file names, sizes and modification times of all rounds
+            (see SituImage.get_fingerprint).
+
+        Returns:
+            str: the hex digest identifying the files of this tile
+        """
+        sha = hashlib.sha1()
+        for image in self.images:
+            sha.update(image.get_fingerprint().encode())
+        return sha.hexdigest()
 
     def get_round_count(self) -> int:
         """Returns the number of rounds this tile has.
@@ -94,17 +224,56 @@ class Tile:
         """
         return self.images[round_number]
 
+    def allocate(self) -> np.ndarray:
+        """Allocates a single buffer for all rounds and makes the data of every round a view
+            into it. Loaded rounds are moved into the buffer, the others are loaded directly
+            into it when they are accessed. Shape and dtype are taken from the first round.
+            The buffer stays allocated when rounds are unloaded until release is called.
+
+        Returns:
+            np.ndarray: the buffer of shape (rounds, channels, focus_levels, image_size,
+                image_size)
+        """
+        if self.data is None:
+            first_round = self.images[0].get_data()
+            self.data = np.empty((len(self.images),) + first_round.shape,
+                                 dtype=first_round.dtype)
+            for round, image in enumerate(self.images):
+                image.set_buffer(self.data[round])
+        return self.data
+
+    def release(self):
+        """Drops the buffer of the tile. Loaded rounds keep their data.
+        """
+        for image in self.images:
+            image.set_buffer(None)
+        self.data = None
+
     def to_numpy_array(self) -> np.ndarray:
-        """Method converting the whole tile to a numpy array.
+        """Method returning the whole tile as a numpy array. The array is the buffer of the
+            tile (see allocate), so it is not copied and changes to it change the rounds.
 
         Returns:
             np.ndarray: the numpy array representation of a tile.
             It is of shape (rounds, channels, focus_levels, image_size, image_size).
         """
-        tmp_list = []
+        if self.data is not None and any(image.buffer is None for image in self.images):
+            # a round was replaced (e.g. projected) and no longer fits the buffer
+            self.release()
+        self.allocate()
         for image in self.images:
-            tmp_list.append(image.get_data())
-        return np.array(tmp_list)
+            image.get_data()
+        return self.data
+
+    def save(self, file_list: List[List[List[str]]]):
+        """Writes all rounds of the tile to files.
+
+        Args:
+            file_list (List[List[List[str]]]): The files to write to with the same layout as the
+                file list passed to the constructor.
+        """
+        for image, situ_image_list in zip(self.images, file_list):
+            image.save_image(situ_image_list)
 
     def get_channel(self, round: int, channel: int) -> np.ndarray:
         """Loads and returns the specified channel for all focus_levels.
@@ -1,3 +1,13 @@
+from collections import OrderedDict
+from typing import Dict, List
+import numpy as np
+
+from situr.image.situ_image import SituImage
+from situr.image.image_backend import ImageBackend
+from situr.image.situ_tile import Tile
+from situr.transformation import Transform, IdentityTransform
+
+
 class TileCollection:
     '''
     The idea here is about a class that knows where to find all the images and then being able to load the tile that is wanted on demand.
@@ -10,6 +20,250 @@ class TileCollection:
     * Z 1 to 30 - focus level
     * Y 2048
     * X 2048
+
+    The files of every tile are indexed when the collection is created, but Tile objects are only
+    built when they are requested. The decoded image data of all tiles is kept below a byte budget
+    by unloading the least recently used rounds (SituImage) once the budget is exceeded.
+    Rounds whose data was modified (see SituImage.is_modified), e.g. by an applied
+    transformation, can not be reloaded and are therefore never unloaded by the collection, so
+    they may exceed the budget. Save or unload them once they are no longer needed.
+    The buffer of a tile (see Tile.allocate) counts against the budget as a whole and is only
+    released together with all rounds of the tile.
+
+    ...
+
+    Attributes
+    ----------
+    files : List[List[List[List[str]]]]
+        One file list for each tile (see Tile for the layout of a single file list).
+    nucleaus_channel : int
+        The channel that contains information about nucleai.
+    max_bytes : int
+        The maximum number of bytes of image data that is kept in memory. None means no limit.
+    backend : ImageBackend
+        The backend used to load the rounds of every tile.
+    float_dtype : numpy.dtype
+        The working precision of the rounds (see SituImage).
+    tile_transformations : List[Transform]
+        For each tile the transformation placing it in the mosaic of all tiles
+        (see situr.stitching.Stitching).
+    hits : int
+        Number of data accesses to rounds that were already loaded.
+    misses : int
+        Number of data accesses that required a round to be loaded from disk.
+    evictions : int
+        Number of rounds that were unloaded to stay below max_bytes.
     '''
-    def __init__(self):
-        pass
\ No newline at end of file
+
+    def __init__(self,
+                 file_list: List[List[List[List[str]]]],
+                 nucleaus_channel: int = 4,
+                 max_bytes: int = None,
+                 backend: ImageBackend = None,
+                 float_dtype=np.float32):
+        """Initializes a tile collection.
+
+        Args:
+            file_list (List[List[List[List[str]]]]): A list containing the file list of each tile.
+                The file list of a tile is the same as for the constructor of Tile.
+            nucleaus_channel (int, optional): The channel that contains information about nucleai.
+                Defaults to 4.
+            max_bytes (int, optional): The maximum number of bytes of decoded image data kept in
+                memory. The most recently used round is never unloaded, even if it alone exceeds
+                the budget. Defaults to None (no limit).
+            backend (ImageBackend, optional): The backend used to load the rounds.
+                Defaults to None (PillowImageBackend).
+            float_dtype (optional): The working precision of the rounds (see SituImage).
+                Defaults to np.float32.
+        """
+        self.files = file_list
+        self.nucleaus_channel = nucleaus_channel
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.float_dtype = float_dtype
+        self.tiles: Dict[int, Tile] = {}
+        self.tile_transformations: List[Transform] = [IdentityTransform() for _ in file_list]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._resident: 'OrderedDict[int, SituImage]' = OrderedDict()
+        self._image_tiles: Dict[int, Tile] = {}
+
+    @classmethod
+    def from_pattern(cls,
+                     pattern: str,
+                     tile_count: int,
+                     round_count: int,
+                     channel_count: int,
+                     focus_level_count: int = 1,
+                     **kwargs) -> 'TileCollection':
+        """Creates a tile collection from a file name pattern.
+
+        Args:
+            pattern (str): A format string using the fields tile, round, channel and focus_level,
+                e.g. 'tile_{tile}/round_{round}/channel_{channel}_z{focus_level}.tif'.
+            tile_count (int): The number of tiles
+            round_count (int): The number of rounds per tile
+            channel_count (int): The number of channels per round
+            focus_level_count (int, optional): The number of focus levels per channel.
+                Defaults to 1.
+            **kwargs: Further arguments passed on to the constructor.
+
+        Returns:
+            TileCollection: the collection containing all files described by the pattern
+        """
+        file_list = [
+            [
+                [
+                    [pattern.format(tile=tile, round=round, channel=channel,
+                                    focus_level=focus_level)
+                     for focus_level in range(focus_level_count)]
+                    for channel in range(channel_count)
+                ]
+                for round in range(round_count)
+            ]
+            for tile in range(tile_count)
+        ]
+        return cls(file_list, **kwargs)
+
+    def get_tile_count(self) -> int:
+        """Returns the number of tiles in this collection.
+
+        Returns:
+            int: the number of tiles
+        """
+        return len(self.files)
+
+    def get_tile_files(self, tile_number: int) -> List[List[List[str]]]:
+        """Returns the file list of a tile without creating the tile.
+
+        Args:
+            tile_number (int): The tile number (starting with index 0)
+
+        Returns:
+            List[List[List[str]]]: The file list of the tile (see Tile).
+        """
+        return self.files[tile_number]
+
+    def get_tile(self, tile_number: int) -> Tile:
+        """Returns the tile with the given number. The tile is created on first access and
+            its image data is only loaded when it is used.
+
+        Args:
+            tile_number (int): The tile number (starting with index 0)
+
+        Returns:
+            Tile: The tile corresponding to the requested tile number.
+        """
+        tile = self.tiles.get(tile_number)
+        if tile is None:
+            tile = Tile(self.files[tile_number],
+                        nucleaus_channel=self.nucleaus_channel,
+                        on_access=self._on_image_access,
+                        backend=self.backend,
+                        float_dtype=self.float_dtype)
+            self.tiles[tile_number] = tile
+            for image in tile.images:
+                self._image_tiles[id(image)] = tile
+        return tile
+
+    def set_tile_transformation(self, tile_number: int, transformation: Transform):
+        """Sets the transformation placing a tile in the mosaic, however, does not apply it.
+
+        Args:
+            tile_number (int): The tile number (starting with index 0)
+            transformation (Transform): The transformation of the tile
+        """
+        self.tile_transformations[tile_number] = transformation
+
+    def get_resident_bytes(self) -> int:
+        """Returns the number of bytes of image data that are currently loaded.
+
+        Returns:
+            int: the number of loaded bytes
+        """
+        # rounds in a tile buffer are counted with the buffer, which stays allocated until
+        # it is released
+        return sum(image.data.nbytes for image in self._resident.values()
+                   if image.is_loaded() and image.buffer is None) + \
+            sum(tile.data.nbytes for tile in self.tiles.values() if tile.data is not None)
+
+    def get_cache_statistics(self) -> Dict[str, int]:
+        """Returns counters describing how well the byte budget fits the workload.
+
+        Returns:
+            Dict[str, int]: A dictionary with the keys hits, misses, evictions,
+                resident_rounds, resident_bytes and max_bytes.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'resident_rounds': len(self._resident),
+            'resident_bytes': self.get_resident_bytes(),
+            'max_bytes': self.max_bytes,
+        }
+
+    def reset_cache_statistics(self):
+        """Sets the hit, miss and eviction counters back to zero.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def unload(self):
+        """Unloads the image data of all tiles in this collection.
+        """
+        for image in self._resident.values():
+            image.unload_image()
+        self._resident.clear()
+
+    def _on_image_access(self, image: SituImage, loaded: bool):
+        key = id(image)
+        if loaded:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self._resident[key] = image
+        self._resident.move_to_end(key)
+        if loaded:
+            self._evict()
+
+    def _evict(self):
+        # Images unloaded from outside of the collection no longer count against the budget
+        for key in [key for key, image in self._resident.items() if not image.is_loaded()]:
+            del self._resident[key]
+        if self.max_bytes is None:
+            return
+        resident_bytes = self.get_resident_bytes()
+        # the most recently used round and the tile it belongs to are never unloaded
+        newest = next(reversed(self._resident.values()))
+        for key in list(self._resident)[:-1]:
+            if resident_bytes <= self.max_bytes:
+                break
+            image = self._resident.get(key)
+            if image is None:
+                continue
+            tile = self._image_tiles.get(key)
+            if image.buffer is not None and tile is not None and tile.data is not None:
+                resident_bytes -= self._evict_tile(tile, newest)
+            elif not image.is_modified():
+                del self._resident[key]
+                resident_bytes -= image.data.nbytes
+                image.unload_image()
+                self.evictions += 1
+
+    def _evict_tile(self, tile: Tile, newest: SituImage) -> int:
+        """Unloads all rounds of a tile and releases its buffer, unless a round is modified
+            or is the newest image. Returns the number of freed bytes.
+        """
+        if any(image is newest or image.is_modified() for image in tile.images):
+            return 0
+        for image in tile.images:
+            if image.is_loaded():
+                image.unload_image()
+                self.evictions += 1
+            self._resident.pop(id(image), None)
+        freed = tile.data.nbytes
+        tile.release()
+        return freed
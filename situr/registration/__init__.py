@@ -1,5 +1,12 @@
-from .registration import Registration, RegistrationFunction, IcpRegistrationFunction
+from .profiler import Profiler, log_record, measure
+from .registration import Registration, RegistrationFunction, RegistrationResult, QualityThresholds
+from .registration import IcpRegistrationFunction, Icp2dRegistrationFunction
+from .robust_registration import subsample_peaks, TrimmedIcpRegistrationFunction, RansacRegistrationFunction
 from .channel_registration import SituImageChannelRegistration, ChannelRegistration, AcrossRoundChannelRegistration
 from .round_registration import RoundRegistration, AllChannelRoundRegistration
+from .phase_correlation import phase_correlation, PhaseCorrelationRegistrationFunction, PhaseCorrelationRoundRegistration
+from .registration_store import RegistrationStore
 from .tile_registration import CombinedRegistration
-from .peak_finder import PeakFinder, PeakFinderDifferenceOfGaussian
+from .peak_finder import PeakFinder, PeakFinderDifferenceOfGaussian, PeakFinderBlockedDifferenceOfGaussian
+from .quality import get_tile_quality, write_quality_report
+from .batch_registration import BatchRegistration, TileRegistrationResult
@@ -0,0 +1,241 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Union
+
+import numpy as np
+
+from situr.image.image_backend import ImageBackend
+from situr.image.situ_tile import Tile
+from situr.image.tile_collection import TileCollection
+from situr.registration.profiler import Profiler, measure
+from situr.registration.quality import get_tile_quality
+from situr.registration.tile_registration import CombinedRegistration
+from situr.transformation import Transform
+
+
+class TileRegistrationResult:
+    """The outcome of registering one tile in a BatchRegistration.
+
+    ...
+
+    Attributes
+    ----------
+    tile_number : int
+        the index of the tile in the batch
+    channel_transformations : List[List[Transform]]
+        the channel transformations of each round, None if the registration failed
+    round_transformations : List[Transform]
+        the transformation of each round, None if the registration failed
+    output_files : List[List[List[str]]]
+        the files the registered tile was written to, None if nothing was written
+    skipped : bool
+        True if stored results and output files existed, so the tile was not processed again
+    error : str
+        the formatted traceback if the registration failed, otherwise None
+    profile : List[dict]
+        the profiling records of the tile if the batch was profiled, otherwise None
+    quality : dict
+        the summary of the registration results of the tile (see get_tile_quality), None if
+        the registration failed
+    """
+
+    def __init__(self,
+                 tile_number: int,
+                 channel_transformations: List[List[Transform]] = None,
+                 round_transformations: List[Transform] = None,
+                 output_files: List[List[List[str]]] = None,
+                 error: str = None,
+                 skipped: bool = False,
+                 profile: List[dict] = None,
+                 quality: dict = None):
+        self.tile_number = tile_number
+        self.channel_transformations = channel_transformations
+        self.round_transformations = round_transformations
+        self.output_files = output_files
+        self.error = error
+        self.skipped = skipped
+        self.profile = profile
+        self.quality = quality
+
+    def is_successful(self) -> bool:
+        """Tells if the tile was registered without an error.
+
+        Returns:
+            bool: True if no error occured
+        """
+        return self.error is None
+
+
+def _register_tile(registration: CombinedRegistration,
+                   tile_number: int,
+                   file_list: List[List[List[str]]],
+                   nucleaus_channel: int,
+                   output_files: List[List[List[str]]],
+                   trace_memory: bool = None,
+                   backend: ImageBackend = None,
+                   float_dtype=np.float32) -> TileRegistrationResult:
+    """Loads, registers, transforms and writes one tile. This runs inside a worker process,
+        only the transformations (and the profiling records) are sent back. The tile is
+        profiled if trace_memory is not None.
+    """
+    profiler = None if trace_memory is None else \
+        Profiler(trace_memory=trace_memory, context={'tile': tile_number})
+    profile = None if profiler is None else profiler.records
+    try:
+        tile = Tile(file_list, nucleaus_channel=nucleaus_channel, backend=backend,
+                    float_dtype=float_dtype)
+        skipped = output_files is not None and registration.is_registered(tile) and \
+            all(os.path.exists(file) for situ_image_list in output_files
+                for focus_level_list in situ_image_list for file in focus_level_list)
+        if skipped:
+            # Only the transformations are restored, no pixel data is loaded
+            registration.result_store.restore(tile, registration.get_parameters())
+        else:
+            registration.do_registration_and_transform(tile, profiler)
+            if output_files is not None:
+                with measure(profiler, 'save'):
+                    tile.save(output_files)
+        return TileRegistrationResult(
+            tile_number,
+            channel_transformations=[
+                image.channel_transformations for image in tile.images],
+            round_transformations=tile.round_transformations,
+            output_files=output_files,
+            skipped=skipped,
+            profile=profile,
+            quality=get_tile_quality(tile, tile_number))
+    except Exception:
+        return TileRegistrationResult(tile_number, error=traceback.format_exc(), profile=profile)
+
+
+class BatchRegistration:
+    """This class registers many tiles in parallel on a process pool. Each worker loads,
+        registers, transforms and writes its own tile, so that no pixel data is sent
+        between the processes.
+
+    ...
+
+    Attributes
+    ----------
+    registration : CombinedRegistration
+        the registration that is performed on each tile
+    output_pattern : str
+        format string with the fields tile, round, channel and focus_level for the output files
+    workers : int
+        the number of worker processes
+    profiler : Profiler
+        if set, the records of all tiles are added to it as the tiles finish
+    backend : ImageBackend
+        the backend used to load tiles given as file lists
+    float_dtype : numpy.dtype
+        the working precision of tiles given as file lists (see SituImage)
+    """
+
+    def __init__(self,
+                 registration: CombinedRegistration = CombinedRegistration(),
+                 output_pattern: str = None,
+                 workers: int = None,
+                 nucleaus_channel: int = 4,
+                 profiler: Profiler = None,
+                 backend: ImageBackend = None,
+                 float_dtype=np.float32) -> None:
+        """Initialize a batch registration.
+
+        Args:
+            registration (CombinedRegistration, optional): The registration performed on each
+                tile. It has to be picklable. Defaults to CombinedRegistration().
+            output_pattern (str, optional): A format string using the fields tile, round,
+                channel and focus_level, e.g.
+                'out/tile_{tile}/round_{round}/c{channel}_z{focus_level}.tif'.
+                If None the registered tiles are not written. Defaults to None.
+            workers (int, optional): The number of worker processes.
+                Defaults to None (the number of CPUs).
+            nucleaus_channel (int, optional): The nucleaus channel used for tiles given as file
+                lists. Defaults to 4.
+            profiler (Profiler, optional): If given, every tile is profiled in its worker and
+                the records are added to this profiler, which calls its callback in the main
+                process. Defaults to None.
+            backend (ImageBackend, optional): The backend used to load tiles given as file
+                lists, tiles of a TileCollection use its backend. It has to be picklable.
+                Defaults to None (PillowImageBackend).
+            float_dtype (optional): The working precision of tiles given as file lists, tiles
+                of a TileCollection use its float_dtype. Defaults to np.float32.
+        """
+        self.registration = registration
+        self.output_pattern = output_pattern
+        self.workers = workers
+        self.nucleaus_channel = nucleaus_channel
+        self.profiler = profiler
+        self.backend = backend
+        self.float_dtype = float_dtype
+
+    def get_output_files(self,
+                         tile_number: int,
+                         file_list: List[List[List[str]]]) -> List[List[List[str]]]:
+        """Returns the files a tile is written to.
+
+        Args:
+            tile_number (int): the index of the tile
+            file_list (List[List[List[str]]]): the input files of the tile
+
+        Returns:
+            List[List[List[str]]]: the output files with the same layout as file_list or None
+                if no output pattern is set
+        """
+        if self.output_pattern is None:
+            return None
+        return [
+            [
+                [self.output_pattern.format(tile=tile_number, round=round, channel=channel,
+                                            focus_level=focus_level)
+                 for focus_level in range(len(focus_level_list))]
+                for channel, focus_level_list in enumerate(situ_image_list)
+            ]
+            for round, situ_image_list in enumerate(file_list)
+        ]
+
+    def do_registration(
+            self,
+            tiles: Union[TileCollection, List[List[List[List[str]]]]]
+    ) -> Iterator[TileRegistrationResult]:
+        """Registers all tiles and yields a result for each tile as soon as it is finished.
+            The results are therefore not ordered by tile number. If the registration has a
+            result store, tiles with stored results and existing output files are skipped,
+            which allows resuming an interrupted batch. If the iteration over the results is
+            stopped early, the tiles that have not started yet are cancelled.
+
+        Args:
+            tiles (Union[TileCollection, List[List[List[List[str]]]]]): Either a tile collection
+                or a list containing the file list of each tile.
+
+        Yields:
+            TileRegistrationResult: the result of a single tile
+        """
+        if isinstance(tiles, TileCollection):
+            file_lists = [tiles.get_tile_files(i) for i in range(tiles.get_tile_count())]
+            nucleaus_channel = tiles.nucleaus_channel
+            backend, float_dtype = tiles.backend, tiles.float_dtype
+        else:
+            file_lists = tiles
+            nucleaus_channel = self.nucleaus_channel
+            backend, float_dtype = self.backend, self.float_dtype
+
+        trace_memory = None if self.profiler is None else self.profiler.trace_memory
+        workers = self.workers if self.workers is not None else os.cpu_count()
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [
+                executor.submit(_register_tile, self.registration, tile_number, file_list,
+                                nucleaus_channel, self.get_output_files(tile_number, file_list),
+                                trace_memory, backend, float_dtype)
+                for tile_number, file_list in enumerate(file_lists)
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                if self.profiler is not None:
+                    for record in result.profile:
+                        self.profiler.add_record(record)
+                yield result
+        finally:
+            executor.shutdown(cancel_futures=True)
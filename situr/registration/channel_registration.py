@@ -1,8 +1,11 @@
+from typing import List
+
 import numpy as np
 from situr.image import situ_image
 
 from situr.image.situ_tile import Tile
 from situr.registration.peak_finder import PeakFinder, PeakFinderDifferenceOfGaussian
+from situr.registration.profiler import Profiler
 from situr.image.situ_image import SituImage
 from situr.registration import Registration, RegistrationFunction, IcpRegistrationFunction
 
@@ -12,24 +15,33 @@ class SituImageChannelRegistration(Registration):
         SituImage and not on a Tile.
         It inherits from Registration.
     """
-    def do_channel_registration(self, situ_img: SituImage, reference_channel: int = 0):
+    def do_channel_registration(self,
+                                situ_img: SituImage,
+                                reference_channel: int = 0,
+                                profiler: Profiler = None):
         """This function performs a registration for each channel (except the nucleaus channel).
 
         Args:
             situ_img (SituImage): The image that should be registered
             reference_channel (int, optional): the reference channel that all channels are
                 registered against. Defaults to 0.
+            profiler (Profiler, optional): If given, peak finding and registration are
+                measured. Defaults to None.
         """
-        reference_peaks = self.peak_finder.get_channel_peaks(
-            situ_img, reference_channel)
+        def get_reference_peaks(downsample):
+            return self.peak_finder.get_channel_peaks(
+                situ_img, reference_channel, downsample=downsample)
+
         for channel in range(situ_img.get_channel_count()):
             if channel != situ_img.nucleaus_channel and channel != reference_channel:
-                current_channel_peaks = self.peak_finder.get_channel_peaks(
-                    situ_img, channel)
-                transformation = self.registration_function.do_registration(
-                    current_channel_peaks, reference_peaks)
+                def get_current_channel_peaks(downsample):
+                    return self.peak_finder.get_channel_peaks(
+                        situ_img, channel, downsample=downsample)
+
+                result = self._register_peaks(get_current_channel_peaks, get_reference_peaks,
+                                              profiler, channel=channel)
                 situ_img.set_channel_transformation(
-                    channel, transformation)
+                    channel, result.transformation, result)
 
 
 class ChannelRegistration(Registration):
@@ -37,28 +49,49 @@ class ChannelRegistration(Registration):
         seperately and registered with the reference channel.
         It inherits from Registration.
     """
-    def do_channel_registration(self, tile: Tile, reference_channel: int = 0):
+    def do_channel_registration(self,
+                                tile: Tile,
+                                reference_channel: int = 0,
+                                profiler: Profiler = None,
+                                rounds: List[int] = None):
         """Perform a SituImageChannelRegistration for each Image.
 
         Args:
             tile (Tile): the tile that the registration is supposed to be on.
             reference_channel (int, optional): the reference channel that all channels are
                 registered against. Defaults to 0.
+            profiler (Profiler, optional): If given, peak finding and registration are
+                measured. Defaults to None.
+            rounds (List[int], optional): Only these rounds are registered, e.g. rounds added
+                to the tile. Defaults to None (all rounds).
         """
         
-        registration = SituImageChannelRegistration(self.registration_function, peak_finder=self.peak_finder)
+        registration = SituImageChannelRegistration(
+            self.registration_function,
+            peak_finder=self.peak_finder,
+            pyramid=self.pyramid,
+            quality_thresholds=self.quality_thresholds,
+            fallback_functions=self.fallback_functions)
         # For each channel (except nucleus) compute transform compared to reference_channel
         # Add Channel transformation to Channel
-        for round in range(tile.get_round_count()):
+        if rounds is None:
+            rounds = range(tile.get_round_count())
+        for round in rounds:
             situ_img = tile.get_round(round)
-            registration.do_channel_registration(situ_img, reference_channel)
+            registration.do_channel_registration(
+                situ_img, reference_channel,
+                None if profiler is None else profiler.bind(round=round))
 
 
 class AcrossRoundChannelRegistration(ChannelRegistration):
     """This class is a registration that uses rounds across images to do the registration.
         Inherits from ChannelRegistration.
     """
-    def do_channel_registration(self, tile: Tile, reference_channel: int = 0):
+    def do_channel_registration(self,
+                                tile: Tile,
+                                reference_channel: int = 0,
+                                profiler: Profiler = None,
+                                rounds: List[int] = None):
         """Performs a registration, where a channel is merged across rounds to give more datapoints.
             This, however, makes it slower.
 
@@ -66,23 +99,27 @@ class AcrossRoundChannelRegistration(ChannelRegistration):
             tile (Tile): the tile that the registration is supposed to be on.
             reference_channel (int, optional): the reference channel that all channels are
                 registered against. Defaults to 0.
+            profiler (Profiler, optional): If given, peak finding and registration are
+                measured. Defaults to None.
+            rounds (List[int], optional): Only these rounds are merged and registered.
+                Defaults to None (all rounds).
         """
-        reference_peaks = []
-        for round in range(tile.get_round_count()):
-            reference_peaks.append(self.peak_finder.get_channel_peaks(
-                tile.get_round(round), reference_channel))
-        reference_peaks = np.concatenate(reference_peaks, axis=0)
+        if rounds is None:
+            rounds = range(tile.get_round_count())
+
+        def get_merged_peaks(channel, downsample):
+            peaks = []
+            for round in rounds:
+                peaks.append(self.peak_finder.get_channel_peaks(
+                    tile.get_round(round), channel, downsample=downsample))
+            return np.concatenate(peaks, axis=0)
+
         for channel in range(tile.get_channel_count()):
             if channel != tile.get_round(0).nucleaus_channel and channel != reference_channel:
-                current_channel_peaks = []
-                for round in range(tile.get_round_count()):
-                    current_channel_peaks.append(
-                        self.peak_finder.get_channel_peaks(tile.get_round(round), channel))
-                current_channel_peaks = np.concatenate(
-                    current_channel_peaks, axis=0)
-
-                transformation = self.registration_function.do_registration(
-                    current_channel_peaks, reference_peaks)
-                for round in range(tile.get_round_count()):
+                result = self._register_peaks(
+                    lambda downsample: get_merged_peaks(channel, downsample),
+                    lambda downsample: get_merged_peaks(reference_channel, downsample),
+                    profiler, channel=channel)
+                for round in rounds:
                     tile.get_round(round).set_channel_transformation(
-                        channel, transformation)
+                        channel, result.transformation, result)
@@ -1,35 +1,207 @@
 import abc
+import hashlib
+import json
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image, ImageDraw
-from skimage import img_as_float
+from skimage import img_as_float32, img_as_float64
 from skimage.feature import blob_dog
+from skimage.transform import downscale_local_mean
 import numpy as np
 from matplotlib import pyplot as plt
 
+from situr.image.projection import Projection
 from situr.image.situ_image import SituImage
 
 
+def _as_float(img_array: np.ndarray, float_dtype) -> np.ndarray:
+    """Converts an image to floating point values in the given precision like img_as_float.
+    """
+    if np.dtype(float_dtype) == np.float64:
+        return img_as_float64(img_array)
+    return img_as_float32(img_array)
+
+
+def _select_brightest(peaks: np.ndarray, plane: np.ndarray, max_peaks: int) -> np.ndarray:
+    """Returns the max_peaks peaks (x, y) on the brightest pixels of the plane in their
+        original order, or all peaks if there are not more.
+    """
+    if max_peaks is None or len(peaks) <= max_peaks:
+        return peaks
+    x = np.clip(np.round(peaks[:, 0]).astype(np.intp), 0, plane.shape[1] - 1)
+    y = np.clip(np.round(peaks[:, 1]).astype(np.intp), 0, plane.shape[0] - 1)
+    brightest = np.argpartition(-plane[y, x], max_peaks - 1)[:max_peaks]
+    return peaks[np.sort(brightest)]
+
+
 class PeakFinder:
+    """Abstract class for finding peaks in images. Found peaks are cached per image content,
+        channel, focus level and peak finder parameters. Applying a transformation to an image
+        changes its content and therefore invalidates its cached peaks.
+
+    ...
+
+    Attributes
+    ----------
+    use_cache : bool
+        if found peaks are cached in memory
+    cache_directory : str
+        if set, peaks of untransformed images are also stored in this directory so that
+        they can be reused by later runs
+    projection : Projection
+        if set, peaks are found on the projection of all focus levels of a channel instead of
+        a single focus level
+    max_peaks : int
+        if set, only this many peaks with the brightest pixels are kept, which bounds the cost
+        of the registrations using them
+    max_cached_peaks : int
+        the number of peak arrays kept in the in memory cache, the least recently used are
+        dropped first
+    """
     __metaclass__ = abc.ABCMeta
 
+    def __init__(self,
+                 use_cache: bool = True,
+                 cache_directory: str = None,
+                 projection: Projection = None,
+                 max_peaks: int = None,
+                 max_cached_peaks: int = 256):
+        """Initializes the peak cache.
+
+        Args:
+            use_cache (bool, optional): If found peaks should be cached. Defaults to True.
+            cache_directory (str, optional): Directory to persist peaks of untransformed images
+                in. Defaults to None (peaks are only cached in memory).
+            projection (Projection, optional): If given, peaks are found on the projected
+                channel and the focus level is ignored. Defaults to None.
+            max_peaks (int, optional): The largest number of peaks returned, the peaks on the
+                brightest pixels are kept. Defaults to None (all peaks).
+            max_cached_peaks (int, optional): The number of peak arrays kept in memory.
+                Defaults to 256.
+        """
+        self.use_cache = use_cache
+        self.cache_directory = cache_directory
+        self.projection = projection
+        self.max_peaks = max_peaks
+        self.max_cached_peaks = max_cached_peaks
+        self.peak_cache: OrderedDict = OrderedDict()
+        # the last state key of each transformed image, to drop its peaks once it changes
+        self._image_state_keys = {}
+
+    def get_parameters(self) -> dict:
+        """Returns the parameters that influence the found peaks.
+
+        Returns:
+            dict: the parameters of this peak finder
+        """
+        parameters = {}
+        if self.max_peaks is not None:
+            parameters['max_peaks'] = self.max_peaks
+        if self.projection is not None:
+            projection = {'class': self.projection.__class__.__name__}
+            projection.update(self.projection.get_parameters())
+            parameters['projection'] = projection
+        return parameters
+
+    def clear_cache(self):
+        """Removes all peaks from the in memory cache.
+        """
+        self.peak_cache.clear()
+        self._image_state_keys.clear()
+
     @abc.abstractmethod
     def find_peaks(self, img_array: np.ndarray) -> np.ndarray:
         """Finds the peaks in the input image"""
         raise NotImplementedError(
             self.__class__.__name__ + '.find_peaks')
 
-    def get_channel_peaks(self, img: SituImage, channel: int, focus_level: int = 0) -> np.ndarray:
+    def get_channel_peaks(self,
+                          img: SituImage,
+                          channel: int,
+                          focus_level: int = 0,
+                          downsample: int = 1) -> np.ndarray:
         """Returns the coordinates of peaks (local maxima) in the specified channel and focus_level.
             It uses the method find_peaks.
 
         Args:
             img (SituImage): The image to find the peaks on.
             channel (int): The channel that should be used when printing
-            focus_level (int, optional): The focus level that should be used. Defaults to 0.
+            focus_level (int, optional): The focus level that should be used. It is ignored if
+                the peak finder has a projection. Defaults to 0.
+            downsample (int, optional): If larger than 1 the peaks are searched in an image that
+                is downsampled by this factor (block mean), which finds fewer and coarser peaks.
+                The peaks are still returned in full resolution coordinates. Defaults to 1.
 
         Returns:
             np.ndarray: np.ndarray: The peaks found by this method as np.array of shape (n, 2)
         """
-        return self.find_peaks(img.get_data()[channel, focus_level, :, :])
+        if self.projection is not None:
+            focus_level = 0
+        if not self.use_cache:
+            return self._find_channel_peaks(img, channel, focus_level, downsample)
+
+        parameters = (self.__class__.__name__, json.dumps(self.get_parameters(), sort_keys=True))
+        state_key = img.get_state_key()
+        self._drop_stale_peaks(img, state_key)
+        key = (state_key, channel, focus_level, downsample, parameters)
+        peaks = self.peak_cache.get(key)
+        if peaks is not None:
+            self.peak_cache.move_to_end(key)
+            return peaks
+
+        # Only unmodified images can be identified across runs
+        path = None
+        if self.cache_directory is not None and img.version == 0:
+            name = hashlib.sha1(repr(
+                (img.get_fingerprint(), channel, focus_level, downsample, parameters)).encode())
+            path = os.path.join(self.cache_directory, name.hexdigest() + '.npy')
+            if os.path.exists(path):
+                peaks = np.load(path)
+
+        if peaks is None:
+            peaks = self._find_channel_peaks(img, channel, focus_level, downsample)
+            if path is not None:
+                os.makedirs(self.cache_directory, exist_ok=True)
+                np.save(path, peaks)
+
+        # Cached peaks are shared between callers and must not be modified
+        peaks.flags.writeable = False
+        self.peak_cache[key] = peaks
+        while len(self.peak_cache) > self.max_cached_peaks:
+            self.peak_cache.popitem(last=False)
+        return peaks
+
+    def _drop_stale_peaks(self, img: SituImage, state_key: tuple):
+        """Removes the cached peaks of a transformed image's previous content. Peaks of
+            unmodified files are kept, other images with the same files may still use them.
+        """
+        previous = self._image_state_keys.pop(id(img), None)
+        if state_key[0] == 'version':
+            self._image_state_keys[id(img)] = state_key
+        if previous is None or previous == state_key:
+            return
+        for key in [key for key in self.peak_cache if key[0] == previous]:
+            del self.peak_cache[key]
+
+    def _find_channel_peaks(self,
+                            img: SituImage,
+                            channel: int,
+                            focus_level: int,
+                            downsample: int) -> np.ndarray:
+        if self.projection is not None:
+            plane = self.projection.project_channel(img, channel)
+        else:
+            plane = img.get_focus_level(channel, focus_level)
+        if downsample == 1:
+            return _select_brightest(self.find_peaks(plane), plane, self.max_peaks)
+        # Scale to [0, 1] before averaging so that thresholds keep their meaning
+        coarse = downscale_local_mean(img_as_float32(plane), (downsample, downsample))
+        coarse = coarse.astype(np.float32)
+        peaks = _select_brightest(self.find_peaks(coarse), coarse, self.max_peaks)
+        # A coarse pixel covers downsample full resolution pixels, map to their center
+        return peaks * downsample + (downsample - 1) / 2
 
     def scatterplot_channel_peaks(self,
                                   img: SituImage,
@@ -91,8 +263,10 @@ class PeakFinderDifferenceOfGaussian(PeakFinder):
     min_sigma (float)
     max_sigma (int)
     threshold (float)
+    float_dtype (numpy.dtype)
     """
-    def __init__(self, min_sigma=0.75, max_sigma=3, threshold=0.1):
+    def __init__(self, min_sigma=0.75, max_sigma=3, threshold=0.1, float_dtype=np.float32,
+                 **kwargs):
         """ For more detailed information about the parameters in the constructor
             refer to blob_dog from skimage.feature.
 
@@ -100,18 +274,129 @@ class PeakFinderDifferenceOfGaussian(PeakFinder):
             min_sigma (float, optional): Defaults to 0.75.
             max_sigma (int, optional): Defaults to 3.
             threshold (float, optional): Defaults to 0.1.
+            float_dtype (optional): The working precision, np.float32 or np.float64.
+                Defaults to np.float32.
+            **kwargs: The cache settings passed on to PeakFinder.
         """
+        super().__init__(**kwargs)
+        self.float_dtype = np.dtype(float_dtype)
         self.min_sigma = min_sigma
         self.max_sigma = max_sigma
         self.threshold = threshold
 
+    def get_parameters(self) -> dict:
+        parameters = super().get_parameters()
+        parameters.update({
+            'min_sigma': self.min_sigma,
+            'max_sigma': self.max_sigma,
+            'threshold': self.threshold,
+            'float_dtype': self.float_dtype.name,
+        })
+        return parameters
+
     def find_peaks(self, img_array: np.ndarray) -> np.ndarray:
         """Finds the peaks in the input image"""
 
-        img = img_as_float(img_array)
+        img = _as_float(img_array, self.float_dtype)
         peaks = blob_dog(img, min_sigma=self.min_sigma,
                          max_sigma=self.max_sigma, threshold=self.threshold)
 
         # Swap x and y
         peaks = peaks[:, [0, 1]] = peaks[:, [1, 0]]
         return peaks
+
+
+def _find_block_peaks(block: np.ndarray, min_sigma: float, max_sigma: float,
+                      threshold: float, float_dtype) -> np.ndarray:
+    """Runs blob_dog on one block and returns the (row, column) coordinates of its peaks.
+    """
+    peaks = blob_dog(_as_float(block, float_dtype), min_sigma=min_sigma,
+                     max_sigma=max_sigma, threshold=threshold)
+    return peaks[:, 0:2]
+
+
+class PeakFinderBlockedDifferenceOfGaussian(PeakFinderDifferenceOfGaussian):
+    """A difference of gaussian peak finder that splits the image into overlapping blocks and
+        processes them in parallel. The margin around each block is large enough for the
+        gaussian filters, so that a peak is found in a block like in the whole image. Every peak
+        is only kept by the block whose inner region contains it, which removes the duplicates
+        found in the overlapping margins. The memory needed is bounded by the block size.
+        It inherits from PeakFinderDifferenceOfGaussian.
+
+    ...
+
+    Attributes
+    ----------
+    block_size (int)
+    workers (int)
+    use_processes (bool)
+    """
+
+    def __init__(self, min_sigma=0.75, max_sigma=3, threshold=0.1, float_dtype=np.float32,
+                 block_size=512, workers=None, use_processes=False, **kwargs):
+        """For the parameters of the difference of gaussian refer to
+            PeakFinderDifferenceOfGaussian.
+
+        Args:
+            block_size (int, optional): The size of the inner region of a block. Defaults to 512.
+            workers (int, optional): The number of threads or processes. Defaults to None
+                (the default of the executor).
+            use_processes (bool, optional): Use a process pool instead of a thread pool.
+                Defaults to False.
+        """
+        super().__init__(min_sigma=min_sigma, max_sigma=max_sigma, threshold=threshold,
+                         float_dtype=float_dtype, **kwargs)
+        self.block_size = block_size
+        self.workers = workers
+        self.use_processes = use_processes
+
+    def get_parameters(self) -> dict:
+        parameters = super().get_parameters()
+        parameters['block_size'] = self.block_size
+        return parameters
+
+    def get_margin(self) -> int:
+        """Returns the number of pixels each block is extended by on every side.
+
+        Returns:
+            int: the margin in pixels
+        """
+        # blob_dog uses sigmas up to max_sigma * 1.6 and the gaussian filter is truncated at
+        # four standard deviations
+        return int(math.ceil(4 * 1.6 * self.max_sigma)) + 1
+
+    def find_peaks(self, img_array: np.ndarray) -> np.ndarray:
+        """Finds the peaks in the input image"""
+        margin = self.get_margin()
+        size_y, size_x = img_array.shape
+        blocks = []
+        for start_y in range(0, size_y, self.block_size):
+            for start_x in range(0, size_x, self.block_size):
+                blocks.append((start_y, start_x,
+                               min(start_y + self.block_size, size_y),
+                               min(start_x + self.block_size, size_x)))
+
+        executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=self.workers) as executor:
+            futures = []
+            for start_y, start_x, end_y, end_x in blocks:
+                origin_y = max(start_y - margin, 0)
+                origin_x = max(start_x - margin, 0)
+                block = img_array[origin_y:min(end_y + margin, size_y),
+                                  origin_x:min(end_x + margin, size_x)]
+                futures.append(executor.submit(_find_block_peaks, block, self.min_sigma,
+                                               self.max_sigma, self.threshold,
+                                               self.float_dtype))
+
+            peaks = []
+            for (start_y, start_x, end_y, end_x), future in zip(blocks, futures):
+                block_peaks = future.result()
+                block_peaks[:, 0] += max(start_y - margin, 0)
+                block_peaks[:, 1] += max(start_x - margin, 0)
+                inside = (block_peaks[:, 0] >= start_y) & (block_peaks[:, 0] < end_y) & \
+                    (block_peaks[:, 1] >= start_x) & (block_peaks[:, 1] < end_x)
+                peaks.append(block_peaks[inside])
+
+        peaks = np.concatenate(peaks, axis=0) if peaks else np.empty((0, 2))
+        # Swap x and y
+        return peaks[:, [1, 0]]
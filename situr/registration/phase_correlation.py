@@ -0,0 +1,292 @@
+import time
+from typing import List
+import numpy as np
+import scipy.ndimage
+
+from situr.image.situ_tile import Tile
+from situr.registration.registration import RegistrationFunction, RegistrationResult
+from situr.registration.registration import QualityThresholds
+from situr.registration.round_registration import RoundRegistration
+from situr.registration.peak_finder import PeakFinder, PeakFinderDifferenceOfGaussian
+from situr.registration.profiler import Profiler, measure
+from situr.transformation import Transform, RotateTranslateTransform
+
+
+def phase_correlation(moving: np.ndarray, reference: np.ndarray, window: bool = True) -> tuple:
+    """Estimates the translation of one or many images against a reference with FFT phase
+        correlation and sub-pixel refinement by fitting a parabola around the correlation peak.
+        All moving images are transformed in one batched FFT.
+
+    Args:
+        moving (np.ndarray): images of shape (n, image_size_y, image_size_x) or a single image
+        reference (np.ndarray): the reference image of shape (image_size_y, image_size_x)
+        window (bool, optional): Apply a Hann window to suppress the image borders.
+            Defaults to True.
+
+    Returns:
+        tuple: the shifts (y, x) of shape (n, 2) (or (2,) for a single image) that move the
+            moving images onto the reference and the height of each correlation peak of
+            shape (n,) (or a float), which is close to 1 for a reliable match
+    """
+    single = moving.ndim == 2
+    moving = np.asarray(moving, dtype=np.float32).reshape((-1,) + reference.shape)
+    reference = np.asarray(reference, dtype=np.float32)
+    shape = reference.shape
+
+    if window:
+        hann = np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+        moving = moving * hann
+        reference = reference * hann
+
+    cross_power = np.fft.rfft2(reference) * np.conj(np.fft.rfft2(moving, axes=(-2, -1)))
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power, s=shape, axes=(-2, -1))
+
+    count = correlation.shape[0]
+    flat_peaks = np.argmax(correlation.reshape(count, -1), axis=1)
+    peak_y, peak_x = np.unravel_index(flat_peaks, shape)
+    batch = np.arange(count)
+    height = correlation[batch, peak_y, peak_x]
+
+    shifts = np.empty((count, 2))
+    for axis, (peak, size) in enumerate(((peak_y, shape[0]), (peak_x, shape[1]))):
+        before = np.array(peak) - 1
+        after = (np.array(peak) + 1) % size
+        if axis == 0:
+            lower = correlation[batch, before, peak_x]
+            upper = correlation[batch, after, peak_x]
+        else:
+            lower = correlation[batch, peak_y, before]
+            upper = correlation[batch, peak_y, after]
+        curvature = lower - 2 * height + upper
+        delta = np.where(np.abs(curvature) > 1e-12,
+                         0.5 * (lower - upper) / np.where(curvature == 0, 1, curvature), 0)
+        shift = peak + np.clip(delta, -0.5, 0.5)
+        # the correlation is circular, large shifts are negative ones
+        shifts[:, axis] = np.where(shift > size / 2, shift - size, shift)
+
+    if single:
+        return shifts[0], float(height[0])
+    return shifts, height
+
+
+class PhaseCorrelationRegistrationFunction(RegistrationFunction):
+    """A registration function that finds the translation between two sets of peaks by
+        rendering them into images and using FFT phase correlation. It only estimates
+        translations and is therefore well suited as initial guess for a refining registration
+        function such as IcpRegistrationFunction. Images can also be registered directly with
+        register_images. It inherits from RegistrationFunction.
+
+    ...
+
+    Attributes
+    ----------
+    bin_size : float
+        the size of a pixel of the rendered peak images in peak coordinates
+    sigma : float
+        the standard deviation (in pixels of the rendered image) used to blur the peaks
+    refine_function : RegistrationFunction
+        if set, the translation is used as initial transformation of this function
+    """
+
+    def __init__(self,
+                 bin_size: float = 1.0,
+                 sigma: float = 1.0,
+                 refine_function: RegistrationFunction = None) -> None:
+        """Initializes the registration function.
+
+        Args:
+            bin_size (float, optional): The size of a pixel of the rendered peak images in peak
+                coordinates. Defaults to 1.0.
+            sigma (float, optional): The standard deviation (in pixels of the rendered image)
+                used to blur the peaks. Defaults to 1.0.
+            refine_function (RegistrationFunction, optional): If given, the translation is used
+                as initial transformation of this function and its result is returned.
+                Defaults to None.
+        """
+        self.bin_size = bin_size
+        self.sigma = sigma
+        self.refine_function = refine_function
+
+    def get_parameters(self) -> dict:
+        parameters = super().get_parameters()
+        if self.refine_function is not None:
+            parameters['refine_function'] = self.refine_function.get_parameters()
+        return parameters
+
+    def do_registration(self,
+                        data_peaks: np.ndarray,
+                        reference_peaks: np.ndarray,
+                        initial_transform: Transform = None) -> Transform:
+        """Method that uses phase correlation to register the data_peaks.
+
+        Args:
+            data_peaks (np.ndarray): The peaks to be registered to the reference
+            reference_peaks (np.ndarray): The reference peaks
+            initial_transform (Transform, optional): A first guess of the transformation.
+                Defaults to None.
+
+        Returns:
+            Transform: the resulting transformaton from the registration
+        """
+        return self.register(data_peaks, reference_peaks, initial_transform).transformation
+
+    def register(self,
+                 data_peaks: np.ndarray,
+                 reference_peaks: np.ndarray,
+                 initial_transform: Transform = None) -> RegistrationResult:
+        moved_peaks = data_peaks
+        if initial_transform is not None:
+            moved_peaks = initial_transform.apply_to_points(data_peaks)
+
+        maximum = np.ceil(np.maximum(moved_peaks.max(axis=0), reference_peaks.max(axis=0))
+                          / self.bin_size).astype(int) + 1
+        shape = (maximum[1], maximum[0])
+        shift, height = phase_correlation(self._render(moved_peaks, shape),
+                                          self._render(reference_peaks, shape),
+                                          window=False)
+        transformation = RotateTranslateTransform(np.eye(2), offset=shift * self.bin_size)
+        if initial_transform is not None:
+            transformation = initial_transform.compose(transformation)
+
+        if self.refine_function is not None:
+            return self.refine_function.register(data_peaks, reference_peaks,
+                                                 initial_transform=transformation)
+        return RegistrationResult(transformation, correlation=height)
+
+    def register_images(self,
+                        moving: np.ndarray,
+                        reference: np.ndarray) -> List[RegistrationResult]:
+        """Registers one or many images against a reference image with one batched FFT.
+
+        Args:
+            moving (np.ndarray): images of shape (n, image_size_y, image_size_x)
+            reference (np.ndarray): the reference image of shape (image_size_y, image_size_x)
+
+        Returns:
+            List[RegistrationResult]: a translation for each moving image with the height of
+                its correlation peak
+        """
+        shifts, heights = phase_correlation(np.asarray(moving).reshape(
+            (-1,) + reference.shape), reference)
+        return [RegistrationResult(RotateTranslateTransform(np.eye(2), offset=shift),
+                                   correlation=float(height))
+                for shift, height in zip(shifts, heights)]
+
+    def _render(self, peaks: np.ndarray, shape: tuple) -> np.ndarray:
+        """Renders peaks (x, y) into an image of the given shape (y, x).
+        """
+        img = np.zeros(shape, dtype=np.float32)
+        coordinates = np.round(peaks / self.bin_size).astype(int)
+        inside = (coordinates[:, 0] >= 0) & (coordinates[:, 0] < shape[1]) & \
+            (coordinates[:, 1] >= 0) & (coordinates[:, 1] < shape[0])
+        np.add.at(img, (coordinates[inside, 1], coordinates[inside, 0]), 1)
+        if self.sigma > 0:
+            img = scipy.ndimage.gaussian_filter(img, self.sigma)
+        return img
+
+
+class PhaseCorrelationRoundRegistration(RoundRegistration):
+    """This class registers all rounds of a tile at once by phase correlation of the reference
+        channel images. The moving rounds are stacked and transformed in one batched FFT against
+        the reference round. Optionally each translation is refined on peaks by a registration
+        function. Without refinement the quality thresholds can only check the height of the
+        correlation peak (see QualityThresholds.min_correlation), rejected rounds are registered
+        on peaks by the fallback functions starting from the correlated translation.
+        It inherits from RoundRegistration.
+    """
+
+    def __init__(self,
+                 registration_function: RegistrationFunction = None,
+                 peak_finder: PeakFinder = PeakFinderDifferenceOfGaussian(),
+                 phase_correlation_function: PhaseCorrelationRegistrationFunction =
+                 PhaseCorrelationRegistrationFunction(),
+                 focus_level: int = 0,
+                 quality_thresholds: QualityThresholds = None,
+                 fallback_functions: List[RegistrationFunction] = None):
+        """Initialize the round registration.
+
+        Args:
+            registration_function (RegistrationFunction, optional): If given, it refines the
+                phase correlation translation of each round on peaks. Defaults to None.
+            peak_finder (PeakFinder, optional): The peak finder used for the refinement.
+                Defaults to PeakFinderDifferenceOfGaussian().
+            phase_correlation_function (PhaseCorrelationRegistrationFunction, optional): The
+                function used to correlate the images.
+                Defaults to PhaseCorrelationRegistrationFunction().
+            focus_level (int, optional): The focus level that is correlated. Defaults to 0.
+            quality_thresholds (QualityThresholds, optional): If given, every result is checked
+                and marked as accepted or not. Defaults to None.
+            fallback_functions (List[RegistrationFunction], optional): Tried in order on the
+                peaks of a round whose result fails the quality thresholds (see Registration).
+                Defaults to None.
+        """
+        super().__init__(registration_function, peak_finder, None, quality_thresholds,
+                         fallback_functions)
+        self.phase_correlation_function = phase_correlation_function
+        self.focus_level = focus_level
+
+    def get_parameters(self) -> dict:
+        parameters = super().get_parameters()
+        parameters['phase_correlation_function'] = \
+            self.phase_correlation_function.get_parameters()
+        parameters['focus_level'] = self.focus_level
+        return parameters
+
+    def do_round_registration(self,
+                              situ_tile: Tile,
+                              reference_round: int = 0,
+                              reference_channel: int = 0,
+                              profiler: Profiler = None,
+                              warp_peaks: bool = False,
+                              rounds: List[int] = None):
+        """This method generates a round registration transformation for a tile and saves it in
+            the tile.
+
+        Args:
+            situ_tile (Tile): The tile that the transformation is to be performed on.
+            reference_round (int, optional): The round that is referenced and will not be changed.
+                Defaults to 0.
+            reference_channel (int, optional): The channel that is used to compare rounds.
+                Defaults to 0.
+            profiler (Profiler, optional): If given, the correlation and the refinement are
+                measured. Defaults to None.
+            warp_peaks (bool, optional): If True the channel transformations are not applied
+                to the images yet and are applied to the peaks of the refinement instead. The
+                correlated reference channel is not registered and therefore not transformed.
+                Defaults to False.
+            rounds (List[int], optional): Only these rounds are correlated and refined against
+                the cached reference peaks (see RoundRegistration.do_round_registration).
+                Defaults to None (all rounds).
+        """
+        registered_rounds = self.get_rounds(situ_tile, reference_round, rounds)
+        if not registered_rounds:
+            return
+        reference = situ_tile.get_round(reference_round).get_focus_level(
+            reference_channel, self.focus_level)
+        moving = np.stack([situ_tile.get_round(round).get_focus_level(
+            reference_channel, self.focus_level) for round in registered_rounds])
+        start = time.perf_counter()
+        with measure(profiler, 'do_registration', rounds=len(registered_rounds),
+                     function=self.phase_correlation_function.__class__.__name__):
+            results = self.phase_correlation_function.register_images(moving, reference)
+        # the rounds are correlated in one batch, each gets its share of the time
+        runtime = (time.perf_counter() - start) / len(results)
+        for result in results:
+            result.runtime = runtime
+
+        if self.registration_function is not None:
+            self._register_rounds(situ_tile, reference_round, [reference_channel], profiler,
+                                  warp_peaks, rounds, self.focus_level, results)
+            return
+        use_cache = rounds is not None
+        for round, result in zip(registered_rounds, results):
+            result = self._check_quality(
+                result,
+                lambda: (self._get_merged_peaks(situ_tile.get_round(round), [reference_channel],
+                                                self.focus_level, 1, warp_peaks),
+                         self._get_reference_peaks(situ_tile.get_round(reference_round),
+                                                   [reference_channel], self.focus_level, 1,
+                                                   warp_peaks, use_cache)),
+                result.transformation, profiler, round=round)
+            situ_tile.set_round_transformation(round, result.transformation, result)
@@ -0,0 +1,143 @@
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+
+def log_record(record: dict):
+    """A profiler callback that writes each record as one json line to the logger of this module.
+
+    Args:
+        record (dict): the profiling record
+    """
+    logger.info(json.dumps(record, default=float))
+
+
+def measure(profiler: 'Profiler', stage: str, **context) -> ContextManager[dict]:
+    """Measures the enclosed block with the profiler (see Profiler.measure), so that profiled
+        and unprofiled code share one code path.
+
+    Args:
+        profiler (Profiler): the profiler, None to measure nothing
+        stage (str): the name of the stage
+        **context: fields identifying what is measured, e.g. round=1, channel=2
+
+    Returns:
+        ContextManager[dict]: yields the record of the stage, a record that is dropped if
+            profiler is None
+    """
+    if profiler is None:
+        return nullcontext({})
+    return profiler.measure(stage, **context)
+
+
+class Profiler:
+    """Collects timings and metrics of the stages of a registration (loading, peak finding,
+        registration and transformation). Every measured stage creates one record, a dict
+        with the stage name, the tile, round and channel it belongs to, the elapsed seconds and
+        stage specific metrics such as the number of peaks, the fitness and iterations of a
+        registration or the bytes loaded. Profiling is enabled by passing a profiler to the
+        registration, without one no measurements are taken.
+
+    ...
+
+    Attributes
+    ----------
+    callback : Callable[[dict], None]
+        called with every record as soon as its stage finished, e.g. log_record
+    keep_records : bool
+        if True the records are collected in records
+    trace_memory : bool
+        if True the peak memory allocated during each stage is measured with tracemalloc, which
+        slows down the stages considerably
+    context : dict
+        fields added to every record, e.g. the tile number
+    records : List[dict]
+        the collected records
+    """
+
+    def __init__(self,
+                 callback: Callable[[dict], None] = None,
+                 keep_records: bool = True,
+                 trace_memory: bool = False,
+                 context: dict = None):
+        self.callback = callback
+        self.keep_records = keep_records
+        self.trace_memory = trace_memory
+        self.context = context if context is not None else {}
+        self.records = []
+        self._lock = threading.Lock()
+
+    def bind(self, **context) -> 'Profiler':
+        """Returns a profiler that adds the given fields to all its records and shares the
+            callback and the collected records with this profiler.
+
+        Returns:
+            Profiler: the bound profiler
+        """
+        profiler = Profiler(self.callback, self.keep_records, self.trace_memory,
+                            dict(self.context, **context))
+        profiler.records = self.records
+        profiler._lock = self._lock
+        return profiler
+
+    @contextmanager
+    def measure(self, stage: str, **context) -> Iterator[dict]:
+        """Measures the time of the enclosed block. Metrics can be added to the yielded record.
+
+        Args:
+            stage (str): the name of the stage
+            **context: fields identifying what is measured, e.g. round=1, channel=2
+
+        Yields:
+            dict: the record of the stage
+        """
+        record = dict(self.context, stage=stage, **context)
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if tracing:
+                record['peak_allocated_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.add_record(record)
+
+    def add_record(self, record: dict):
+        """Adds a record that was created elsewhere, e.g. in a worker process.
+
+        Args:
+            record (dict): the record
+        """
+        if self.keep_records:
+            with self._lock:
+                self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self, key: List[str] = ('stage',)) -> dict:
+        """Sums up the records grouped by the given fields.
+
+        Args:
+            key (List[str], optional): the fields to group by, e.g. ('tile', 'stage').
+                Defaults to ('stage',).
+
+        Returns:
+            dict: for each group the number of records and the total seconds
+        """
+        summary = {}
+        for record in self.records:
+            group = tuple(record.get(field) for field in key)
+            group = group[0] if len(group) == 1 else group
+            entry = summary.setdefault(group, {'count': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += record['seconds']
+        return summary
@@ -0,0 +1,81 @@
+import csv
+import json
+import os
+from typing import List
+
+from situr.image.situ_tile import Tile
+from situr.registration.registration import RegistrationResult
+
+# The columns of the per tile summary, in the order they are written
+SUMMARY_FIELDS = ['tile', 'registrations', 'rejected', 'fallbacks', 'min_fitness',
+                  'max_inlier_rmse', 'min_inlier_count', 'min_correlation', 'runtime', 'accepted']
+
+
+def _result_row(result: RegistrationResult, round: int, channel: int = None) -> dict:
+    row = {'round': round, 'channel': channel}
+    row.update(result.to_dict())
+    del row['transformation']
+    return row
+
+
+def get_tile_quality(tile: Tile, tile_number: int = None) -> dict:
+    """Summarizes the registration results stored in a tile (see
+        Tile.round_registration_results and SituImage.channel_registration_results).
+
+    Args:
+        tile (Tile): The registered tile.
+        tile_number (int, optional): The number of the tile in its collection.
+            Defaults to None.
+
+    Returns:
+        dict: the fields of SUMMARY_FIELDS and under 'results' one row per registered channel
+            and round with the metrics of its RegistrationResult. accepted is False if any
+            result was rejected and None if no result was checked.
+    """
+    rows = []
+    for round, image in enumerate(tile.images):
+        for channel, result in enumerate(image.channel_registration_results):
+            if result is not None:
+                rows.append(_result_row(result, round, channel))
+        if tile.round_registration_results[round] is not None:
+            rows.append(_result_row(tile.round_registration_results[round], round))
+
+    def values(field):
+        return [row[field] for row in rows if row[field] is not None]
+
+    checked = values('accepted')
+    return {
+        'tile': tile_number,
+        'registrations': len(rows),
+        'rejected': checked.count(False),
+        'fallbacks': len(values('fallback')),
+        'min_fitness': min(values('fitness'), default=None),
+        'max_inlier_rmse': max(values('inlier_rmse'), default=None),
+        'min_inlier_count': min(values('inlier_count'), default=None),
+        'min_correlation': min(values('correlation'), default=None),
+        'runtime': sum(values('runtime')),
+        'accepted': all(checked) if checked else None,
+        'results': rows,
+    }
+
+
+def write_quality_report(qualities: List[dict], path: str):
+    """Writes the quality summaries of many tiles, e.g. of all tiles of a collection
+        registered by a BatchRegistration (see TileRegistrationResult.quality). A .json file
+        contains the summaries with the results of every channel and round, any other file is
+        written as csv with one line per tile.
+
+    Args:
+        qualities (List[dict]): The summaries returned by get_tile_quality, None entries
+            (e.g. of failed tiles) are skipped.
+        path (str): The file to write.
+    """
+    qualities = [quality for quality in qualities if quality is not None]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', newline='') as file:
+        if path.endswith('.json'):
+            json.dump(qualities, file, indent=2)
+            return
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(qualities)
@@ -1,22 +1,183 @@
 import abc
+import time
+from typing import Callable, List, Tuple
 from situr.registration.peak_finder import PeakFinderDifferenceOfGaussian
-import open3d as o3
+from situr.registration.profiler import Profiler, measure
 import numpy as np
+from scipy.spatial import cKDTree
 
 from situr.image import extend_dim
-from situr.transformation import Transform, RotateTranslateTransform
+from situr.transformation import Transform, RotateTranslateTransform, transform_from_dict
+
+
+class RegistrationResult:
+    """The transformation found by a RegistrationFunction together with information about
+        how well it fits.
+
+    ...
+
+    Attributes
+    ----------
+    transformation : Transform
+        the transformation registering the data peaks to the reference peaks
+    fitness : float
+        the fraction of data peaks that have a reference peak within the correspondence distance,
+        None if unknown
+    inlier_rmse : float
+        the root mean square distance of the corresponding peaks, None if unknown
+    iterations : int
+        the number of iterations the registration needed, None if unknown
+    inlier_count : int
+        the number of data peaks that have a reference peak within the correspondence distance,
+        None if unknown
+    runtime : float
+        the seconds the registration took including all pyramid levels and fallbacks, None if
+        unknown
+    accepted : bool
+        if the result meets the quality thresholds of the registration, None if not checked
+    fallback : int
+        the index of the fallback function that produced the result, None if it was produced by
+        the registration function itself
+    correlation : float
+        the height of the phase correlation peak the translation was taken from, close to 1 for
+        a reliable match, None if no phase correlation was used
+    """
+
+    def __init__(self,
+                 transformation: Transform,
+                 fitness: float = None,
+                 inlier_rmse: float = None,
+                 iterations: int = None,
+                 inlier_count: int = None,
+                 runtime: float = None,
+                 accepted: bool = None,
+                 fallback: int = None,
+                 correlation: float = None):
+        self.transformation = transformation
+        self.fitness = fitness
+        self.inlier_rmse = inlier_rmse
+        self.iterations = iterations
+        self.inlier_count = inlier_count
+        self.runtime = runtime
+        self.accepted = accepted
+        self.fallback = fallback
+        self.correlation = correlation
+
+    def to_dict(self) -> dict:
+        """Returns a json serializable representation of the result (see from_dict).
+
+        Returns:
+            dict: the transformation and the fit metrics
+        """
+        return {
+            'transformation': self.transformation.to_dict(),
+            'fitness': None if self.fitness is None else float(self.fitness),
+            'inlier_rmse': None if self.inlier_rmse is None else float(self.inlier_rmse),
+            'iterations': None if self.iterations is None else int(self.iterations),
+            'inlier_count': None if self.inlier_count is None else int(self.inlier_count),
+            'runtime': None if self.runtime is None else float(self.runtime),
+            'accepted': None if self.accepted is None else bool(self.accepted),
+            'fallback': None if self.fallback is None else int(self.fallback),
+            'correlation': None if self.correlation is None else float(self.correlation),
+        }
+
+    @classmethod
+    def from_dict(cls, parameters: dict) -> 'RegistrationResult':
+        """Creates a result from the output of to_dict.
+
+        Args:
+            parameters (dict): the transformation and the fit metrics
+
+        Returns:
+            RegistrationResult: the result
+        """
+        parameters = dict(parameters)
+        parameters['transformation'] = transform_from_dict(parameters['transformation'])
+        return cls(**parameters)
+
+
+class QualityThresholds:
+    """The limits a registration result has to meet to be accepted. Limits that are None are
+        not checked, as are metrics a registration function does not report.
+
+    ...
+
+    Attributes
+    ----------
+    min_fitness : float
+        the smallest accepted fitness
+    max_inlier_rmse : float
+        the largest accepted inlier RMSE in pixels
+    min_inlier_count : int
+        the smallest accepted number of inliers
+    min_correlation : float
+        the smallest accepted height of the phase correlation peak
+    """
+
+    def __init__(self,
+                 min_fitness: float = None,
+                 max_inlier_rmse: float = None,
+                 min_inlier_count: int = None,
+                 min_correlation: float = None):
+        self.min_fitness = min_fitness
+        self.max_inlier_rmse = max_inlier_rmse
+        self.min_inlier_count = min_inlier_count
+        self.min_correlation = min_correlation
+
+    def get_parameters(self) -> dict:
+        """Returns the limits.
+
+        Returns:
+            dict: the json serializable parameters
+        """
+        parameters = {
+            'min_fitness': self.min_fitness,
+            'max_inlier_rmse': self.max_inlier_rmse,
+            'min_inlier_count': self.min_inlier_count,
+        }
+        if self.min_correlation is not None:
+            parameters['min_correlation'] = self.min_correlation
+        return parameters
+
+    def accepts(self, result: RegistrationResult) -> bool:
+        """Tells if a result meets all limits.
+
+        Args:
+            result (RegistrationResult): the result
+
+        Returns:
+            bool: True if no limit is violated
+        """
+        if self.min_fitness is not None and result.fitness is not None and \
+                result.fitness < self.min_fitness:
+            return False
+        if self.max_inlier_rmse is not None and result.inlier_rmse is not None and \
+                result.inlier_rmse > self.max_inlier_rmse:
+            return False
+        if self.min_inlier_count is not None and result.inlier_count is not None and \
+                result.inlier_count < self.min_inlier_count:
+            return False
+        if self.min_correlation is not None and result.correlation is not None and \
+                result.correlation < self.min_correlation:
+            return False
+        return True
 
 
 class RegistrationFunction:
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def do_registration(self, data_peaks: np.ndarray, reference_peaks: np.ndarray) -> Transform:
+    def do_registration(self,
+                        data_peaks: np.ndarray,
+                        reference_peaks: np.ndarray,
+                        initial_transform: Transform = None) -> Transform:
         """Method that does the registration on two arrays of peaks.
 
         Args:
             data_peaks (np.ndarray): [description]
             reference_peaks (np.ndarray): [description]
+            initial_transform (Transform, optional): A first guess of the transformation,
+                e.g. from a coarser registration. Defaults to None.
 
         Raises:
             NotImplementedError: This method is abstract and therefore calling
@@ -27,39 +188,241 @@ class RegistrationFunction:
         """
         raise NotImplementedError(self.__class__.__name__ + '.do_registration')
 
+    def get_parameters(self) -> dict:
+        """Returns the class and the settings of the registration function, e.g. to detect if
+            stored registration results were created with the same settings.
+
+        Returns:
+            dict: the json serializable parameters
+        """
+        parameters = {'class': self.__class__.__name__}
+        for name, value in vars(self).items():
+            if isinstance(value, (bool, int, float, str)) or value is None:
+                parameters[name] = value
+        return parameters
+
+    def register(self,
+                 data_peaks: np.ndarray,
+                 reference_peaks: np.ndarray,
+                 initial_transform: Transform = None) -> RegistrationResult:
+        """Does the registration like do_registration but also returns how well the
+            transformation fits. Subclasses that know the fit override this method.
+
+        Args:
+            data_peaks (np.ndarray): The peaks to be registered to the reference
+            reference_peaks (np.ndarray): The reference peaks
+            initial_transform (Transform, optional): A first guess of the transformation.
+                Defaults to None.
+
+        Returns:
+            RegistrationResult: the transformation and its fit
+        """
+        return RegistrationResult(
+            self.do_registration(data_peaks, reference_peaks, initial_transform))
+
+
 class IcpRegistrationFunction(RegistrationFunction):
     def __init__(self, max_correspondence_distance=50) -> None:
         self.max_distance = max_correspondence_distance
 
     def do_registration(self,
                         data_peaks: np.ndarray,
-                        reference_peaks: np.ndarray) -> RotateTranslateTransform:
+                        reference_peaks: np.ndarray,
+                        initial_transform: Transform = None) -> RotateTranslateTransform:
         """Method that uses ICP to register the data_peaks.
 
         Args:
             data_peaks (np.ndarray): The peaks to be registered to the reference
             reference_peaks (np.ndarray): The reference peaks
+            initial_transform (Transform, optional): A first guess of the transformation.
+                Defaults to None.
 
         Returns:
             RotateTranslateTransform: the resulting transformaton from the registration
         """
+        return self.register(data_peaks, reference_peaks, initial_transform).transformation
+
+    def register(self,
+                 data_peaks: np.ndarray,
+                 reference_peaks: np.ndarray,
+                 initial_transform: Transform = None) -> RegistrationResult:
+        # open3d is slow to import, only load it when it is used
+        import open3d as o3
+
         source = o3.geometry.PointCloud()
         source.points = o3.utility.Vector3dVector(extend_dim(data_peaks))
         target = o3.geometry.PointCloud()
         target.points = o3.utility.Vector3dVector(extend_dim(reference_peaks))
+        init = np.eye(4)
+        if initial_transform is not None:
+            matrix = initial_transform.get_matrix()
+            init[0:2, 0:2] = matrix[0:2, 0:2]
+            init[0:2, 3] = matrix[0:2, 2]
         reg_p2p = o3.pipelines.registration.registration_icp(
-            source, target, self.max_distance)
-        return RotateTranslateTransform(
+            source, target, self.max_distance, init)
+        transformation = RotateTranslateTransform(
             reg_p2p.transformation[0:2, 0:2],
             offset=reg_p2p.transformation[[1, 0], 3])
+        return RegistrationResult(transformation, fitness=reg_p2p.fitness,
+                                  inlier_rmse=reg_p2p.inlier_rmse,
+                                  inlier_count=len(reg_p2p.correspondence_set))
+
+
+def _estimate_similarity(source: np.ndarray,
+                         target: np.ndarray,
+                         with_scale: bool) -> tuple:
+    """Closed form least squares estimate (Umeyama) of scale, rotation and translation so that
+        target ~ scale * source @ rotation.T + translation.
+
+    Args:
+        source (np.ndarray): points of shape (n, 2)
+        target (np.ndarray): corresponding points of shape (n, 2)
+        with_scale (bool): if False the scale is fixed to 1
+
+    Returns:
+        tuple: scale (float), rotation (np.ndarray of shape (2, 2)),
+            translation (np.ndarray of shape (2,))
+    """
+    source_mean = source.mean(axis=0)
+    target_mean = target.mean(axis=0)
+    source_centered = source - source_mean
+    target_centered = target - target_mean
+
+    covariance = target_centered.T @ source_centered / source.shape[0]
+    u, singular_values, vt = np.linalg.svd(covariance)
+    correction = np.eye(2)
+    if np.linalg.det(u) * np.linalg.det(vt) < 0:
+        correction[1, 1] = -1
+    rotation = u @ correction @ vt
+
+    scale = 1.0
+    if with_scale:
+        source_variance = (source_centered ** 2).sum() / source.shape[0]
+        if source_variance > 0:
+            scale = np.trace(np.diag(singular_values) @ correction) / source_variance
+    translation = target_mean - scale * source_mean @ rotation.T
+    return scale, rotation, translation
+
+
+def _split_similarity(transformation: Transform) -> tuple:
+    """Splits a transformation into scale, rotation and translation (x, y). Shear of a general
+        affine transformation is dropped.
+
+    Args:
+        transformation (Transform): the transformation, None for the identity
+
+    Returns:
+        tuple: scale (float), rotation (np.ndarray of shape (2, 2)),
+            translation (np.ndarray of shape (2,))
+    """
+    if transformation is None:
+        return 1.0, np.eye(2), np.zeros(2)
+    matrix = transformation.get_matrix()
+    linear = matrix[0:2, 0:2]
+    scale = np.sqrt(abs(np.linalg.det(linear)))
+    u, _, vt = np.linalg.svd(linear)
+    return scale, u @ vt, matrix[0:2, 2].copy()
+
+
+class Icp2dRegistrationFunction(RegistrationFunction):
+    """Point to point ICP working directly on 2D peaks with numpy and scipy. Correspondences
+        are found with a KD-tree and each iteration solves the rigid (or similarity) transform in
+        closed form. It inherits from RegistrationFunction.
+
+    ...
+
+    Attributes
+    ----------
+    max_distance : float
+        the maximum distance of two peaks to be considered corresponding
+    max_iterations : int
+        the maximum number of ICP iterations
+    relative_tolerance : float
+        the registration stops once the RMSE changes relatively less than this
+    with_scale : bool
+        if a scale factor is estimated in addition to rotation and translation
+    """
+
+    def __init__(self,
+                 max_correspondence_distance: float = 50,
+                 max_iterations: int = 30,
+                 relative_tolerance: float = 1e-6,
+                 with_scale: bool = False) -> None:
+        self.max_distance = max_correspondence_distance
+        self.max_iterations = max_iterations
+        self.relative_tolerance = relative_tolerance
+        self.with_scale = with_scale
+
+    def do_registration(self,
+                        data_peaks: np.ndarray,
+                        reference_peaks: np.ndarray,
+                        initial_transform: Transform = None) -> RotateTranslateTransform:
+        """Method that uses ICP to register the data_peaks.
+
+        Args:
+            data_peaks (np.ndarray): The peaks to be registered to the reference
+            reference_peaks (np.ndarray): The reference peaks
+            initial_transform (Transform, optional): A first guess of the transformation.
+                Defaults to None.
+
+        Returns:
+            RotateTranslateTransform: the resulting transformaton from the registration
+        """
+        return self.register(data_peaks, reference_peaks, initial_transform).transformation
+
+    def register(self,
+                 data_peaks: np.ndarray,
+                 reference_peaks: np.ndarray,
+                 initial_transform: Transform = None) -> RegistrationResult:
+        data_peaks = np.asarray(data_peaks, dtype=np.float64)
+        reference_peaks = np.asarray(reference_peaks, dtype=np.float64)
+        tree = cKDTree(reference_peaks)
+
+        scale, rotation, translation = _split_similarity(initial_transform)
+        previous_rmse = np.inf
+        iterations = 0
+        for iterations in range(1, self.max_iterations + 1):
+            moved = scale * data_peaks @ rotation.T + translation
+            distances, indices = tree.query(moved, distance_upper_bound=self.max_distance)
+            inliers = np.isfinite(distances)
+            if np.count_nonzero(inliers) < 2:
+                break
+            rmse = np.sqrt(np.mean(distances[inliers] ** 2))
+            if np.isfinite(previous_rmse) and \
+                    previous_rmse - rmse <= self.relative_tolerance * previous_rmse:
+                break
+            previous_rmse = rmse
+            scale, rotation, translation = _estimate_similarity(
+                data_peaks[inliers], reference_peaks[indices[inliers]], self.with_scale)
+
+        moved = scale * data_peaks @ rotation.T + translation
+        distances, _ = tree.query(moved, distance_upper_bound=self.max_distance)
+        inliers = np.isfinite(distances)
+        inlier_count = np.count_nonzero(inliers)
+        fitness = inlier_count / max(data_peaks.shape[0], 1)
+        inlier_rmse = np.sqrt(np.mean(distances[inliers] ** 2)) if inliers.any() else 0.0
+
+        transformation = RotateTranslateTransform(
+            rotation, scale=scale, offset=translation[[1, 0]])
+        return RegistrationResult(transformation, fitness=fitness, inlier_rmse=inlier_rmse,
+                                  iterations=iterations, inlier_count=inlier_count)
 
 
 class Registration:
+    """Base class of the registrations. Optionally registrations run coarse to fine: the
+        transformation is first estimated on peaks found in downsampled images (pyramid levels)
+        and then refined at full resolution, where the registration function can use a tight
+        correspondence distance. Optionally the result is checked against quality thresholds
+        and, if it fails them, the same peaks are registered again with fallback functions.
+    """
     __metaclass__ = abc.ABCMeta
 
     def __init__(self,
                  registration_function: RegistrationFunction() = IcpRegistrationFunction(),
-                 peak_finder=PeakFinderDifferenceOfGaussian()):
+                 peak_finder=PeakFinderDifferenceOfGaussian(),
+                 pyramid: List[Tuple[int, RegistrationFunction]] = None,
+                 quality_thresholds: QualityThresholds = None,
+                 fallback_functions: List[RegistrationFunction] = None):
         """Initialize channel registration and tell which registration function to use.
 
         Args:
@@ -67,6 +430,191 @@ class Registration:
                 Defaults to IcpRegistrationFunction().
             peak_finder (PeakFinder, optional): The peak finder to be used for the registration.
                 Defaults to PeakFinderDifferenceOfGaussian().
+            pyramid (List[Tuple[int, RegistrationFunction]], optional): Coarse levels ordered
+                from coarse to fine. Each level is a downsampling factor and the registration
+                function used at that level, e.g. [(4, Icp2dRegistrationFunction(100))].
+                Distances are always in full resolution pixels. The result of each level is the
+                initial transformation of the next one and registration_function does the final
+                full resolution step. Defaults to None (only full resolution).
+            quality_thresholds (QualityThresholds, optional): If given, every result is checked
+                and marked as accepted or not. Defaults to None.
+            fallback_functions (List[RegistrationFunction], optional): Tried in order on the
+                full resolution peaks if a result fails the quality thresholds, e.g.
+                [Icp2dRegistrationFunction(100), RansacRegistrationFunction(100)]. The first
+                accepted result is used, otherwise the one with the highest fitness.
+                Defaults to None.
         """
         self.registration_function = registration_function
         self.peak_finder = peak_finder
+        self.pyramid = pyramid if pyramid is not None else []
+        self.quality_thresholds = quality_thresholds
+        self.fallback_functions = fallback_functions if fallback_functions is not None else []
+
+    def _get_peaks(self,
+                   img,
+                   channel: int,
+                   focus_level: int = 0,
+                   downsample: int = 1,
+                   warp_peaks: bool = False) -> np.ndarray:
+        """Returns the peaks of a channel of an image.
+
+        Args:
+            img (SituImage): the image
+            channel (int): the channel
+            focus_level (int, optional): the focus level. Defaults to 0.
+            downsample (int, optional): the downsampling factor. Defaults to 1.
+            warp_peaks (bool, optional): If True the peaks are moved by the (not yet applied)
+                channel transformation of the image. Defaults to False.
+
+        Returns:
+            np.ndarray: the peaks (x, y) of shape (n, 2)
+        """
+        peaks = self.peak_finder.get_channel_peaks(img, channel, focus_level, downsample)
+        if warp_peaks:
+            return img.channel_transformations[channel].apply_to_points(peaks)
+        return peaks
+
+    def _register_peaks(self,
+                        get_data_peaks: Callable[[int], np.ndarray],
+                        get_reference_peaks: Callable[[int], np.ndarray],
+                        profiler: Profiler = None,
+                        initial_transform: Transform = None,
+                        **context) -> RegistrationResult:
+        """Registers peaks coarse to fine through all pyramid levels. If the full resolution
+            result fails the quality thresholds, the fallback functions register the same peaks
+            from the same initial transformation.
+
+        Args:
+            get_data_peaks (Callable[[int], np.ndarray]): returns the data peaks for a
+                downsampling factor
+            get_reference_peaks (Callable[[int], np.ndarray]): returns the reference peaks for a
+                downsampling factor
+            profiler (Profiler, optional): If given, peak finding and each registration level
+                are measured. Defaults to None.
+            initial_transform (Transform, optional): A first guess of the transformation for
+                the first level. Defaults to None.
+            **context: fields added to the profiling records, e.g. round and channel
+
+        Returns:
+            RegistrationResult: the result of the full resolution registration
+        """
+        get_data_peaks = _measure_peaks(get_data_peaks, profiler, **context)
+        get_reference_peaks = _measure_peaks(
+            get_reference_peaks, profiler, reference=True, **context)
+
+        runtime = 0.0
+        for downsample, registration_function in self.pyramid + [(1, self.registration_function)]:
+            data_peaks = get_data_peaks(downsample)
+            reference_peaks = get_reference_peaks(downsample)
+            result = self._register(registration_function, data_peaks, reference_peaks,
+                                    initial_transform, profiler, downsample=downsample,
+                                    **context)
+            runtime += result.runtime
+            if downsample != 1:
+                initial_transform = result.transformation
+        result.runtime = runtime
+        return self._check_quality(result, lambda: (data_peaks, reference_peaks),
+                                   initial_transform, profiler, **context)
+
+    def _check_quality(self,
+                       result: RegistrationResult,
+                       get_peaks: Callable[[], Tuple[np.ndarray, np.ndarray]],
+                       initial_transform: Transform = None,
+                       profiler: Profiler = None,
+                       **context) -> RegistrationResult:
+        """Marks a result as accepted or not. If it fails the quality thresholds, the fallback
+            functions register the full resolution peaks from the initial transformation.
+
+        Args:
+            result (RegistrationResult): the result to check, its runtime is increased by the
+                runtime of the fallbacks
+            get_peaks (Callable[[], Tuple[np.ndarray, np.ndarray]]): returns the data and the
+                reference peaks, only called if a fallback is needed
+            initial_transform (Transform, optional): The initial transformation of the
+                fallbacks. Defaults to None.
+            profiler (Profiler, optional): If given, the fallbacks are measured.
+                Defaults to None.
+            **context: fields added to the profiling records, e.g. round and channel
+
+        Returns:
+            RegistrationResult: the first accepted result, otherwise the one with the highest
+                fitness
+        """
+        if self.quality_thresholds is None:
+            return result
+        result.accepted = self.quality_thresholds.accepts(result)
+        if result.accepted or not self.fallback_functions:
+            return result
+
+        runtime = result.runtime or 0.0
+        data_peaks, reference_peaks = get_peaks()
+        for fallback, registration_function in enumerate(self.fallback_functions):
+            fallback_result = self._register(
+                registration_function, data_peaks, reference_peaks, initial_transform,
+                profiler, downsample=1, fallback=fallback, **context)
+            runtime += fallback_result.runtime
+            fallback_result.accepted = self.quality_thresholds.accepts(fallback_result)
+            fallback_result.fallback = fallback
+            if fallback_result.accepted or \
+                    (fallback_result.fitness or 0) > (result.fitness or 0):
+                result = fallback_result
+            if result.accepted:
+                break
+        result.runtime = runtime
+        return result
+
+    def _register(self,
+                  registration_function: RegistrationFunction,
+                  data_peaks: np.ndarray,
+                  reference_peaks: np.ndarray,
+                  initial_transform: Transform,
+                  profiler: Profiler,
+                  **context) -> RegistrationResult:
+        """Runs one registration function and sets the runtime of its result.
+        """
+        with measure(profiler, 'do_registration',
+                     function=registration_function.__class__.__name__, **context) as record:
+            start = time.perf_counter()
+            result = registration_function.register(
+                data_peaks, reference_peaks, initial_transform=initial_transform)
+            result.runtime = time.perf_counter() - start
+            record.update(fitness=result.fitness, inlier_rmse=result.inlier_rmse,
+                          iterations=result.iterations, inlier_count=result.inlier_count)
+        return result
+
+    def get_parameters(self) -> dict:
+        """Returns the class and the settings of the registration.
+
+        Returns:
+            dict: the json serializable parameters
+        """
+        peak_finder_parameters = {'class': self.peak_finder.__class__.__name__}
+        peak_finder_parameters.update(self.peak_finder.get_parameters())
+        parameters = {
+            'class': self.__class__.__name__,
+            'registration_function': None if self.registration_function is None
+            else self.registration_function.get_parameters(),
+            'peak_finder': peak_finder_parameters,
+            'pyramid': [[downsample, registration_function.get_parameters()]
+                        for downsample, registration_function in self.pyramid],
+        }
+        # only set when used, so stored results of registrations without them stay valid
+        if self.quality_thresholds is not None:
+            parameters['quality_thresholds'] = self.quality_thresholds.get_parameters()
+            parameters['fallback_functions'] = [
+                registration_function.get_parameters()
+                for registration_function in self.fallback_functions]
+        return parameters
+
+
+def _measure_peaks(get_peaks: Callable[[int], np.ndarray],
+                   profiler: Profiler,
+                   **context) -> Callable[[int], np.ndarray]:
+    """Wraps a peak getter so that each call is measured by the profiler.
+    """
+    def measured_get_peaks(downsample: int) -> np.ndarray:
+        with measure(profiler, 'get_channel_peaks', downsample=downsample, **context) as record:
+            peaks = get_peaks(downsample)
+            record['peaks'] = len(peaks)
+        return peaks
+    return measured_get_peaks
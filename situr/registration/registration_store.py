@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+from typing import Dict
+
+import numpy as np
+
+from situr.image.situ_image import SituImage
+from situr.image.situ_tile import Tile
+from situr.registration.registration import RegistrationResult
+from situr.transformation import transform_from_dict
+
+
+class RegistrationStore:
+    """Stores the registration results of tiles in a directory with one small json file per tile.
+        A file is keyed by the fingerprint of the tile's files (names, sizes and modification
+        times) and the registration parameters, so changed inputs or settings are registered
+        again while unchanged tiles can be restored without recomputation.
+        Next to them the peaks of the reference rounds are kept, so rounds added to a
+        registered tile can be registered by another process (see
+        CombinedRegistration.register_added_rounds).
+
+    ...
+
+    Attributes
+    ----------
+    directory : str
+        the directory the results are stored in
+    """
+
+    def __init__(self, directory: str):
+        """Initializes the store.
+
+        Args:
+            directory (str): The directory the results are stored in. It is created when the
+                first result is saved.
+        """
+        self.directory = directory
+
+    def get_path(self, tile: Tile, parameters: dict) -> str:
+        """Returns the file a tile registered with the given parameters is stored in.
+
+        Args:
+            tile (Tile): the registered tile
+            parameters (dict): the json serializable registration parameters
+
+        Returns:
+            str: the path of the json file
+        """
+        key = hashlib.sha1()
+        key.update(tile.get_fingerprint().encode())
+        key.update(json.dumps(parameters, sort_keys=True).encode())
+        return os.path.join(self.directory, key.hexdigest() + '.json')
+
+    def contains(self, tile: Tile, parameters: dict) -> bool:
+        """Tells if results for a tile and parameters are stored.
+
+        Args:
+            tile (Tile): the tile
+            parameters (dict): the json serializable registration parameters
+
+        Returns:
+            bool: True if results are stored
+        """
+        return os.path.exists(self.get_path(tile, parameters))
+
+    def save(self, tile: Tile, parameters: dict):
+        """Stores the channel and round transformations of a tile together with their
+            registration results.
+
+        Args:
+            tile (Tile): the registered tile
+            parameters (dict): the json serializable registration parameters
+        """
+        record = {
+            'parameters': parameters,
+            'rounds': [
+                {
+                    'round_transformation': tile.round_transformations[round].to_dict(),
+                    'round_registration_result': _result_to_dict(
+                        tile.round_registration_results[round]),
+                    'channel_transformations': [
+                        transformation.to_dict()
+                        for transformation in image.channel_transformations],
+                    'channel_registration_results': [
+                        _result_to_dict(result)
+                        for result in image.channel_registration_results],
+                }
+                for round, image in enumerate(tile.images)
+            ],
+        }
+        path = self.get_path(tile, parameters)
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so that an interrupted write is not picked up
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(record, file)
+        os.replace(temporary_path, path)
+
+    def restore(self, tile: Tile, parameters: dict) -> bool:
+        """Sets the stored transformations and registration results on a tile,
+            but does not apply them.
+
+        Args:
+            tile (Tile): the tile
+            parameters (dict): the json serializable registration parameters
+
+        Returns:
+            bool: True if results were found and restored
+        """
+        path = self.get_path(tile, parameters)
+        if not os.path.exists(path):
+            return False
+        with open(path) as file:
+            record = json.load(file)
+        for round, round_record in enumerate(record['rounds']):
+            tile.set_round_transformation(
+                round,
+                transform_from_dict(round_record['round_transformation']),
+                _result_from_dict(round_record['round_registration_result']))
+            image = tile.get_round(round)
+            for channel, (transformation, result) in enumerate(zip(
+                    round_record['channel_transformations'],
+                    round_record['channel_registration_results'])):
+                image.set_channel_transformation(
+                    channel, transform_from_dict(transformation), _result_from_dict(result))
+        return True
+
+    def get_reference_peaks_path(self, image: SituImage, parameters: dict) -> str:
+        """Returns the file the reference peaks of a round registered with the given
+            parameters are stored in. It is keyed by the fingerprint of the untransformed files
+            of the round, so it stays valid when rounds are added to the tile.
+
+        Args:
+            image (SituImage): the reference round
+            parameters (dict): the json serializable registration parameters
+
+        Returns:
+            str: the path of the npz file
+        """
+        key = hashlib.sha1()
+        key.update(image.get_fingerprint().encode())
+        key.update(json.dumps(parameters, sort_keys=True).encode())
+        return os.path.join(self.directory, key.hexdigest() + '.npz')
+
+    def save_reference_peaks(self,
+                             image: SituImage,
+                             parameters: dict,
+                             peaks: Dict[tuple, np.ndarray]):
+        """Stores the reference peaks of a round (see RoundRegistration.reference_peak_cache).
+
+        Args:
+            image (SituImage): the reference round
+            parameters (dict): the json serializable registration parameters
+            peaks (Dict[tuple, np.ndarray]): the peaks for each key of the reference peak cache
+        """
+        keys = list(peaks)
+        path = self.get_reference_peaks_path(image, parameters)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = path + '.tmp.npz'
+        np.savez(temporary_path, keys=json.dumps(keys),
+                 **{'peaks_{}'.format(i): peaks[key] for i, key in enumerate(keys)})
+        os.replace(temporary_path, path)
+
+    def restore_reference_peaks(self,
+                                image: SituImage,
+                                parameters: dict) -> Dict[tuple, np.ndarray]:
+        """Loads the reference peaks of a round.
+
+        Args:
+            image (SituImage): the reference round
+            parameters (dict): the json serializable registration parameters
+
+        Returns:
+            Dict[tuple, np.ndarray]: the peaks for each key of the reference peak cache, None if
+                no peaks are stored
+        """
+        path = self.get_reference_peaks_path(image, parameters)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return {
+                _cache_key(key): data['peaks_{}'.format(i)]
+                for i, key in enumerate(json.loads(str(data['keys'])))
+            }
+
+
+def _cache_key(key: list) -> tuple:
+    # json turns the tuple of channels into a list
+    return tuple(tuple(value) if isinstance(value, list) else value for value in key)
+
+
+def _result_to_dict(result: RegistrationResult) -> dict:
+    return None if result is None else result.to_dict()
+
+
+def _result_from_dict(parameters: dict) -> RegistrationResult:
+    return None if parameters is None else RegistrationResult.from_dict(parameters)
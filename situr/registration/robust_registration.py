@@ -0,0 +1,313 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from situr.registration.registration import Icp2dRegistrationFunction, RegistrationResult
+from situr.registration.registration import _estimate_similarity, _split_similarity
+from situr.transformation import Transform, RotateTranslateTransform
+
+
+def subsample_peaks(peaks: np.ndarray, max_peaks: int, rng: np.random.Generator) -> np.ndarray:
+    """Returns a random subset of at most max_peaks peaks in their original order.
+
+    Args:
+        peaks (np.ndarray): The peaks of shape (n, 2).
+        max_peaks (int): The largest number of peaks returned, None to keep all.
+        rng (np.random.Generator): The random generator that picks the peaks.
+
+    Returns:
+        np.ndarray: the peaks of shape (min(n, max_peaks), 2)
+    """
+    if max_peaks is None or len(peaks) <= max_peaks:
+        return peaks
+    return peaks[np.sort(rng.choice(len(peaks), max_peaks, replace=False))]
+
+
+class TrimmedIcpRegistrationFunction(Icp2dRegistrationFunction):
+    """Trimmed ICP: like Icp2dRegistrationFunction, but each iteration drops the
+        correspondences that are much farther apart than the median one before estimating the
+        transformation, so peaks without a partner in the other channel or round do not pull the
+        result away. A fixed fraction is not trimmed, as that would drop the well matched peaks
+        far from the center of rotation first. The data peaks are capped by random subsampling,
+        which bounds the runtime of each call. It inherits from Icp2dRegistrationFunction.
+
+    ...
+
+    Attributes
+    ----------
+    outlier_factor : float
+        correspondences whose distance exceeds this many times the median distance of all
+        correspondences are trimmed in each iteration
+    min_outlier_distance : float
+        correspondences closer than this many pixels are never trimmed, peaks found on whole
+        pixels are up to 0.7 pixels off even if the registration is exact
+    absolute_tolerance : float
+        the registration stops once an iteration moves no data peak further than this many
+        pixels
+    max_peaks : int
+        the largest number of data peaks used, None to use all
+    seed : int
+        the seed of the random subsampling, so repeated registrations give the same result
+    """
+
+    def __init__(self,
+                 max_correspondence_distance: float = 50,
+                 max_iterations: int = 30,
+                 relative_tolerance: float = 1e-6,
+                 with_scale: bool = False,
+                 outlier_factor: float = 3.0,
+                 min_outlier_distance: float = 1.5,
+                 absolute_tolerance: float = 1e-3,
+                 max_peaks: int = 5000,
+                 seed: int = 0) -> None:
+        """Initializes the registration function. For the first parameters refer to
+            Icp2dRegistrationFunction.
+
+        Args:
+            outlier_factor (float, optional): Correspondences farther apart than this many times
+                the median distance are not used. Defaults to 3.0.
+            min_outlier_distance (float, optional): Correspondences closer than this are
+                always used. Defaults to 1.5.
+            absolute_tolerance (float, optional): The largest movement of a peak in pixels
+                that still counts as converged. Defaults to 1e-3.
+            max_peaks (int, optional): The largest number of data peaks used. Defaults to 5000.
+            seed (int, optional): The seed of the subsampling. Defaults to 0.
+        """
+        super().__init__(max_correspondence_distance, max_iterations, relative_tolerance,
+                         with_scale)
+        self.outlier_factor = outlier_factor
+        self.min_outlier_distance = min_outlier_distance
+        self.absolute_tolerance = absolute_tolerance
+        self.max_peaks = max_peaks
+        self.seed = seed
+
+    def _prepare(self, data_peaks: np.ndarray, reference_peaks: np.ndarray) -> tuple:
+        """Subsamples the data peaks and builds the KD-tree of the reference peaks.
+        """
+        rng = np.random.default_rng(self.seed)
+        data_peaks = subsample_peaks(np.asarray(data_peaks, dtype=np.float64),
+                                     self.max_peaks, rng)
+        reference_peaks = np.asarray(reference_peaks, dtype=np.float64)
+        return data_peaks, reference_peaks, cKDTree(reference_peaks), rng
+
+    def _refine(self,
+                data_peaks: np.ndarray,
+                reference_peaks: np.ndarray,
+                tree: cKDTree,
+                scale: float,
+                rotation: np.ndarray,
+                translation: np.ndarray,
+                max_distance: float = None) -> RegistrationResult:
+        """Runs trimmed ICP from the given similarity and returns its result. The
+            correspondence distance defaults to max_distance.
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        moved = scale * data_peaks @ rotation.T + translation
+        previous_rmse = np.inf
+        iterations = 0
+        for iterations in range(1, self.max_iterations + 1):
+            distances, indices = tree.query(moved, distance_upper_bound=max_distance)
+            inliers = np.flatnonzero(np.isfinite(distances))
+            if len(inliers) < 2:
+                break
+            # correspondences much farther apart than the typical one are outliers
+            trimmed = inliers[distances[inliers] <= max(
+                self.outlier_factor * np.median(distances[inliers]), self.min_outlier_distance)]
+            if len(trimmed) >= 2:
+                inliers = trimmed
+            rmse = np.sqrt(np.mean(distances[inliers] ** 2))
+            if np.isfinite(previous_rmse) and \
+                    previous_rmse - rmse <= self.relative_tolerance * previous_rmse:
+                break
+            previous_rmse = rmse
+            scale, rotation, translation = _estimate_similarity(
+                data_peaks[inliers], reference_peaks[indices[inliers]], self.with_scale)
+            previous_moved = moved
+            moved = scale * data_peaks @ rotation.T + translation
+            if np.max(np.abs(moved - previous_moved)) <= self.absolute_tolerance:
+                break
+
+        distances, _ = tree.query(moved, distance_upper_bound=max_distance)
+        inliers = np.isfinite(distances)
+        inlier_count = np.count_nonzero(inliers)
+        fitness = inlier_count / max(data_peaks.shape[0], 1)
+        inlier_rmse = np.sqrt(np.mean(distances[inliers] ** 2)) if inliers.any() else 0.0
+
+        transformation = RotateTranslateTransform(
+            rotation, scale=scale, offset=translation[[1, 0]])
+        return RegistrationResult(transformation, fitness=fitness, inlier_rmse=inlier_rmse,
+                                  iterations=iterations, inlier_count=inlier_count)
+
+    def register(self,
+                 data_peaks: np.ndarray,
+                 reference_peaks: np.ndarray,
+                 initial_transform: Transform = None) -> RegistrationResult:
+        data_peaks, reference_peaks, tree, _ = self._prepare(data_peaks, reference_peaks)
+        return self._refine(data_peaks, reference_peaks, tree,
+                            *_split_similarity(initial_transform))
+
+
+class RansacRegistrationFunction(TrimmedIcpRegistrationFunction):
+    """Finds the transformation with RANSAC before refining it with trimmed ICP, so a wrong
+        nearest neighbour guess at the start cannot lead ICP into a local minimum. The peaks
+        have no descriptors, so each data peak is matched to its nearest reference peaks within
+        the correspondence distance of the initial transformation. Hypotheses are drawn from two
+        of these candidate matches each and scored in batches as whole arrays. The search stops
+        early once enough hypotheses were drawn to find an all inlier sample with the given
+        confidence. The consensus of the best hypothesis is refined with trimmed ICP within the
+        inlier distance. It inherits from TrimmedIcpRegistrationFunction.
+
+    ...
+
+    Attributes
+    ----------
+    inlier_distance : float
+        the largest distance in pixels of a match that agrees with a hypothesis
+    candidates : int
+        the number of nearest reference peaks each data peak is matched to
+    max_hypotheses : int
+        the largest number of hypotheses that are scored
+    batch_size : int
+        the number of hypotheses scored at once
+    confidence : float
+        the probability of having drawn at least one all inlier sample at which the search
+        stops
+    max_scored_matches : int
+        the hypotheses are scored on a random subset of this many matches
+    """
+
+    def __init__(self,
+                 max_correspondence_distance: float = 50,
+                 max_iterations: int = 30,
+                 relative_tolerance: float = 1e-6,
+                 with_scale: bool = False,
+                 outlier_factor: float = 3.0,
+                 min_outlier_distance: float = 1.5,
+                 absolute_tolerance: float = 1e-3,
+                 max_peaks: int = 5000,
+                 seed: int = 0,
+                 inlier_distance: float = 2.0,
+                 candidates: int = 4,
+                 max_hypotheses: int = 4096,
+                 batch_size: int = 64,
+                 confidence: float = 0.999,
+                 max_scored_matches: int = 2000) -> None:
+        """Initializes the registration function. For the first parameters refer to
+            TrimmedIcpRegistrationFunction.
+
+        Args:
+            inlier_distance (float, optional): The largest distance of an inlier match in
+                pixels. Defaults to 2.0.
+            candidates (int, optional): The number of reference peaks each data peak is matched
+                to. Defaults to 4.
+            max_hypotheses (int, optional): The largest number of hypotheses.
+                Defaults to 4096.
+            batch_size (int, optional): The number of hypotheses scored at once.
+                Defaults to 64.
+            confidence (float, optional): The confidence at which the search stops early.
+                Defaults to 0.999.
+            max_scored_matches (int, optional): The number of matches the hypotheses are
+                scored on. Defaults to 2000.
+        """
+        super().__init__(max_correspondence_distance, max_iterations, relative_tolerance,
+                         with_scale, outlier_factor, min_outlier_distance, absolute_tolerance,
+                         max_peaks, seed)
+        self.inlier_distance = inlier_distance
+        self.candidates = candidates
+        self.max_hypotheses = max_hypotheses
+        self.batch_size = batch_size
+        self.confidence = confidence
+        self.max_scored_matches = max_scored_matches
+
+    def _get_matches(self,
+                     data_peaks: np.ndarray,
+                     tree: cKDTree,
+                     scale: float,
+                     rotation: np.ndarray,
+                     translation: np.ndarray) -> tuple:
+        """Returns the indices of the data and reference peaks of all candidate matches.
+        """
+        moved = scale * data_peaks @ rotation.T + translation
+        distances, indices = tree.query(moved, k=self.candidates,
+                                        distance_upper_bound=self.max_distance)
+        distances = distances.reshape(len(data_peaks), -1)
+        indices = indices.reshape(len(data_peaks), -1)
+        data_indices, candidate = np.nonzero(np.isfinite(distances))
+        return data_indices, indices[data_indices, candidate]
+
+    def _hypotheses(self, source: np.ndarray, target: np.ndarray, first: np.ndarray,
+                    second: np.ndarray) -> tuple:
+        """Computes the similarity of each pair of matches. Pairs whose data peaks are too
+            close to define a rotation are marked invalid.
+        """
+        source_vector = source[second] - source[first]
+        target_vector = target[second] - target[first]
+        source_length = np.linalg.norm(source_vector, axis=1)
+        target_length = np.linalg.norm(target_vector, axis=1)
+        valid = (source_length > 2 * self.inlier_distance) & \
+            (target_length > 2 * self.inlier_distance)
+        angle = np.arctan2(
+            source_vector[:, 0] * target_vector[:, 1] - source_vector[:, 1] * target_vector[:, 0],
+            np.sum(source_vector * target_vector, axis=1))
+        cos, sin = np.cos(angle), np.sin(angle)
+        rotations = np.stack([np.stack([cos, -sin], axis=-1),
+                              np.stack([sin, cos], axis=-1)], axis=-2)
+        scales = np.ones(len(first))
+        if self.with_scale:
+            scales = np.where(valid, target_length / np.where(valid, source_length, 1), 1)
+        translations = target[first] - scales[:, np.newaxis] * \
+            np.einsum('hij,hj->hi', rotations, source[first])
+        return valid, scales, rotations, translations
+
+    def register(self,
+                 data_peaks: np.ndarray,
+                 reference_peaks: np.ndarray,
+                 initial_transform: Transform = None) -> RegistrationResult:
+        data_peaks, reference_peaks, tree, rng = self._prepare(data_peaks, reference_peaks)
+        similarity = _split_similarity(initial_transform)
+        data_indices, reference_indices = self._get_matches(data_peaks, tree, *similarity)
+        if len(data_indices) < 2:
+            return self._refine(data_peaks, reference_peaks, tree, *similarity)
+
+        source = data_peaks[data_indices]
+        target = reference_peaks[reference_indices]
+        # hypotheses are scored on a random subset of the matches, only the best one on all
+        scored = subsample_peaks(np.arange(len(source)), self.max_scored_matches, rng)
+        best_count = 0
+        best = None
+        drawn = 0
+        needed = self.max_hypotheses
+        while drawn < min(needed, self.max_hypotheses):
+            first = rng.integers(len(source), size=self.batch_size)
+            second = rng.integers(len(source), size=self.batch_size)
+            valid, scales, rotations, translations = self._hypotheses(
+                source, target, first, second)
+            drawn += self.batch_size
+            if not valid.any():
+                continue
+            scales, rotations, translations = scales[valid], rotations[valid], translations[valid]
+            # residuals of the scored matches under all hypotheses of shape (hypotheses, matches)
+            moved = scales[:, np.newaxis, np.newaxis] * \
+                np.einsum('hij,mj->hmi', rotations, source[scored]) + \
+                translations[:, np.newaxis, :]
+            counts = np.count_nonzero(
+                np.sum((moved - target[scored]) ** 2, axis=-1) <= self.inlier_distance ** 2,
+                axis=1)
+            hypothesis = np.argmax(counts)
+            if counts[hypothesis] > best_count:
+                best_count = counts[hypothesis]
+                best = scales[hypothesis], rotations[hypothesis], translations[hypothesis]
+                inlier_ratio = best_count / len(scored)
+                if inlier_ratio >= 1:
+                    break
+                needed = np.log(1 - self.confidence) / np.log(1 - inlier_ratio ** 2)
+
+        if best is None:
+            return self._refine(data_peaks, reference_peaks, tree, *similarity)
+        scale, rotation, translation = best
+        inliers = np.sum((scale * source @ rotation.T + translation - target) ** 2,
+                         axis=1) <= self.inlier_distance ** 2
+        similarity = _estimate_similarity(source[inliers], target[inliers], self.with_scale)
+        # the matches now agree within the inlier distance, farther peaks are not used
+        return self._refine(data_peaks, reference_peaks, tree, *similarity,
+                            max_distance=self.inlier_distance)
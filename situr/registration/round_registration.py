@@ -1,15 +1,158 @@
+from situr.image.situ_image import SituImage
 from situr.image.situ_tile import Tile
+from typing import List, Tuple
+import weakref
+
 import numpy as np
 
 from situr.registration import Registration, RegistrationFunction, IcpRegistrationFunction
+from situr.registration.registration import QualityThresholds
+from situr.registration.peak_finder import PeakFinderDifferenceOfGaussian
+from situr.registration.profiler import Profiler
 
 
 class RoundRegistration(Registration):
+    """This class registers the rounds of a tile against a reference round using the peaks of
+        the reference channel. It inherits from Registration.
+
+    ...
+
+    Attributes
+    ----------
+    reference_peak_cache : weakref.WeakKeyDictionary
+        for each reference round (SituImage) the peaks found during the last registration of
+        all rounds, so that rounds added later are registered without finding them again. An
+        entry is dropped together with its image.
+    """
+
+    def __init__(self,
+                 registration_function: RegistrationFunction = IcpRegistrationFunction(),
+                 peak_finder=PeakFinderDifferenceOfGaussian(),
+                 pyramid: List[Tuple[int, RegistrationFunction]] = None,
+                 quality_thresholds: QualityThresholds = None,
+                 fallback_functions: List[RegistrationFunction] = None):
+        """Initialize the round registration (see Registration).
+        """
+        super().__init__(registration_function, peak_finder, pyramid, quality_thresholds,
+                         fallback_functions)
+        self.reference_peak_cache = weakref.WeakKeyDictionary()
+
+    def __getstate__(self) -> dict:
+        # the cache refers to images of this process and is not sent to worker processes
+        state = self.__dict__.copy()
+        del state['reference_peak_cache']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.reference_peak_cache = weakref.WeakKeyDictionary()
+
+    def get_rounds(self,
+                   situ_tile: Tile,
+                   reference_round: int = 0,
+                   rounds: List[int] = None) -> List[int]:
+        """Returns the rounds that are registered.
+
+        Args:
+            situ_tile (Tile): the tile
+            reference_round (int, optional): The reference round, it is never registered.
+                Defaults to 0.
+            rounds (List[int], optional): The requested rounds. Defaults to None (all rounds).
+
+        Returns:
+            List[int]: the rounds to register
+        """
+        if rounds is None:
+            rounds = range(situ_tile.get_round_count())
+        return [round for round in rounds if round != reference_round]
+
+    def get_added_rounds(self, situ_tile: Tile, reference_round: int = 0) -> List[int]:
+        """Returns the rounds that have no registration result yet, e.g. because they were
+            added to the tile after it was registered (see Tile.add_round).
+
+        Args:
+            situ_tile (Tile): the tile
+            reference_round (int, optional): The reference round. Defaults to 0.
+
+        Returns:
+            List[int]: the unregistered rounds
+        """
+        return [round for round, result in enumerate(situ_tile.round_registration_results)
+                if result is None and round != reference_round]
+
+    def _get_merged_peaks(self,
+                          img: SituImage,
+                          channels: List[int],
+                          focus_level: int,
+                          downsample: int,
+                          warp_peaks: bool) -> np.ndarray:
+        """Returns the peaks of all given channels of an image in one array.
+        """
+        if len(channels) == 1:
+            return self._get_peaks(img, channels[0], focus_level, downsample, warp_peaks)
+        return np.concatenate([self._get_peaks(img, channel, focus_level, downsample, warp_peaks)
+                               for channel in channels], axis=0)
+
+    def _get_reference_peaks(self,
+                             img: SituImage,
+                             channels: List[int],
+                             focus_level: int,
+                             downsample: int,
+                             warp_peaks: bool,
+                             use_cache: bool) -> np.ndarray:
+        """Returns the merged peaks of the reference round. They are always stored in the
+            reference peak cache, but only taken from it if use_cache is set. If they are
+            missing from the cache while only some rounds are registered, the reference round
+            may already be transformed, its peaks are then not warped again.
+        """
+        cache = self.reference_peak_cache.setdefault(img, {})
+        key = (tuple(channels), focus_level, downsample, warp_peaks)
+        if not use_cache or key not in cache:
+            transformed = use_cache and img.version != 0
+            cache[key] = self._get_merged_peaks(img, channels, focus_level, downsample,
+                                                warp_peaks and not transformed)
+        return cache[key]
+
+    def _register_rounds(self,
+                         situ_tile: Tile,
+                         reference_round: int,
+                         channels: List[int],
+                         profiler: Profiler,
+                         warp_peaks: bool,
+                         rounds: List[int],
+                         focus_level: int = 0,
+                         initial_results: list = None):
+        """Registers the merged peaks of the channels of each round against those of the
+            reference round and saves the transformations in the tile. The reference peaks are
+            taken from the reference peak cache if only some rounds are registered.
+        """
+        use_cache = rounds is not None
+        rounds = self.get_rounds(situ_tile, reference_round, rounds)
+        reference = situ_tile.get_round(reference_round)
+
+        def get_reference_peaks(downsample):
+            return self._get_reference_peaks(reference, channels, focus_level, downsample,
+                                             warp_peaks, use_cache)
+
+        for i, round in enumerate(rounds):
+            initial_transform = None
+            if initial_results is not None:
+                initial_transform = initial_results[i].transformation
+            result = self._register_peaks(
+                lambda downsample: self._get_merged_peaks(
+                    situ_tile.get_round(round), channels, focus_level, downsample, warp_peaks),
+                get_reference_peaks, profiler, initial_transform, round=round)
+            if initial_results is not None and initial_results[i].runtime is not None:
+                result.runtime += initial_results[i].runtime
+            situ_tile.set_round_transformation(round, result.transformation, result)
 
     def do_round_registration(self,
                               situ_tile,
                               reference_round: int = 0,
-                              reference_channel: int = 0):
+                              reference_channel: int = 0,
+                              profiler: Profiler = None,
+                              warp_peaks: bool = False,
+                              rounds: List[int] = None):
         """This method generates a round registration transformation for a tile
             and saves it in the tile.
 
@@ -19,17 +162,17 @@ class RoundRegistration(Registration):
                 Defaults to 0.
             reference_channel (int, optional): The channel that is used to compare rounds.
                 Defaults to 0.
+            profiler (Profiler, optional): If given, peak finding and registration are
+                measured. Defaults to None.
+            warp_peaks (bool, optional): If True the channel transformations are not applied
+                to the images yet and are applied to the peaks instead. Defaults to False.
+            rounds (List[int], optional): Only these rounds are registered, against the
+                reference peaks of the last registration of all rounds (see
+                get_added_rounds). Defaults to None (all rounds, the reference peaks are found
+                again).
         """
-
-        reference_peaks = self.peak_finder.get_channel_peaks(situ_tile.get_round(
-            reference_round), reference_channel)
-        for round in range(situ_tile.get_round_count()):
-            if round != reference_channel:
-                current_round_peaks = self.peak_finder.get_channel_peaks(
-                    situ_tile.get_round(round), reference_channel)
-                transformation = self.registration_function.do_registration(
-                    current_round_peaks, reference_peaks)
-                situ_tile.set_round_transformation(round, transformation)
+        self._register_rounds(situ_tile, reference_round, [reference_channel], profiler,
+                              warp_peaks, rounds)
 
 
 class AllChannelRoundRegistration(RoundRegistration):
@@ -40,7 +183,10 @@ class AllChannelRoundRegistration(RoundRegistration):
     def do_round_registration(self,
                               situ_tile: Tile,
                               reference_round: int = 0,
-                              reference_channel: int = 0):
+                              reference_channel: int = 0,
+                              profiler: Profiler = None,
+                              warp_peaks: bool = False,
+                              rounds: List[int] = None):
         """This method generates a round registration transformation for a tile and saves it in
             the tile.
 
@@ -49,24 +195,14 @@ class AllChannelRoundRegistration(RoundRegistration):
             reference_round (int, optional): The round that is referenced and will not be changed.
                 Defaults to 0.
             reference_channel (int, optional): This parameter is ignored.
+            profiler (Profiler, optional): If given, peak finding and registration are
+                measured. Defaults to None.
+            warp_peaks (bool, optional): If True the channel transformations are not applied
+                to the images yet and are applied to the peaks instead. Defaults to False.
+            rounds (List[int], optional): Only these rounds are registered, against the cached
+                reference peaks (see RoundRegistration.do_round_registration).
+                Defaults to None (all rounds).
         """
-        reference_peaks = []
-        for channel in range(situ_tile.get_channel_count()):
-            # TODO: possibly exclude nucleaus channel
-            reference_peaks.append(self.peak_finder.get_channel_peaks(situ_tile.get_round(
-                reference_round), channel))
-        reference_peaks = np.concatenate(reference_peaks, axis=0)
-
-        for round in range(situ_tile.get_round_count()):
-            if round != reference_channel:
-                current_round_peaks = []
-                for channel in range(situ_tile.get_channel_count()):
-                    # TODO: possibly exclude nucleaus channel
-                    current_round_peaks.append(self.peak_finder.get_channel_peaks(
-                        situ_tile.get_round(round), channel))
-                current_round_peaks = np.concatenate(
-                    current_round_peaks, axis=0)
-
-                transformation = self.registration_function.do_registration(
-                    current_round_peaks, reference_peaks)
-                situ_tile.set_round_transformation(round, transformation)
+        # TODO: possibly exclude nucleaus channel
+        channels = list(range(situ_tile.get_channel_count()))
+        self._register_rounds(situ_tile, reference_round, channels, profiler, warp_peaks, rounds)
@@ -1,39 +1,209 @@
+from typing import Callable, List
+
 from situr.image.situ_tile import Tile
 from situr.registration import RoundRegistration, ChannelRegistration, round_registration
+from situr.registration.profiler import Profiler, measure
+from situr.registration.registration_store import RegistrationStore
 
 
 class CombinedRegistration:
     """CombinedRegistration is a registration that performs a channel and a round transformaton
         after each other. Also the transformations are directly applied after each registration.
+        With warp_peaks the channel transformations are applied to the peaks used by the round
+        registration instead of the images, and the tile is resampled only once at the end.
     """
 
     def __init__(self,
                  round_registration: RoundRegistration = RoundRegistration(),
                  channel_registration: ChannelRegistration = ChannelRegistration(),
                  reference_channel: int = 0,
-                 reference_round: int = 0) -> None:
+                 reference_round: int = 0,
+                 result_store: RegistrationStore = None,
+                 warp_peaks: bool = False,
+                 resample: bool = True) -> None:
+        """Initializes the combined registration.
+
+        Args:
+            round_registration (RoundRegistration, optional): The registration of the rounds.
+                Defaults to RoundRegistration().
+            channel_registration (ChannelRegistration, optional): The registration of the
+                channels. Defaults to ChannelRegistration().
+            reference_channel (int, optional): The reference channel. Defaults to 0.
+            reference_round (int, optional): The reference round. Defaults to 0.
+            result_store (RegistrationStore, optional): If given, registration results are
+                saved to it and tiles with stored results are only transformed.
+                Defaults to None.
+            warp_peaks (bool, optional): If True the round registration uses the channel
+                transformed peaks, so the images are neither resampled nor searched for peaks
+                again between the channel and the round registration. Defaults to False.
+            resample (bool, optional): If False the transformations are only set on the tile
+                and not applied, e.g. when only spot coordinates are needed (see
+                Transform.apply_to_points). Only used with warp_peaks. Defaults to True.
+        """
         self.round_registration = round_registration
         self.channel_registration = channel_registration
         self.reference_channel = reference_channel
         self.reference_round = reference_round
+        self.result_store = result_store
+        self.warp_peaks = warp_peaks
+        self.resample = resample
+
+    def get_parameters(self) -> dict:
+        """Returns the settings of the channel and round registration.
 
-    def do_registration_and_transform(self, tile: Tile):
+        Returns:
+            dict: the json serializable parameters
+        """
+        return {
+            'round_registration': self.round_registration.get_parameters(),
+            'channel_registration': self.channel_registration.get_parameters(),
+            'reference_channel': self.reference_channel,
+            'reference_round': self.reference_round,
+            'warp_peaks': self.warp_peaks,
+        }
+
+    def is_registered(self, tile: Tile) -> bool:
+        """Tells if the result store contains results for the tile and these settings.
+
+        Args:
+            tile (Tile): the tile
+
+        Returns:
+            bool: True if stored results exist
+        """
+        return self.result_store is not None and \
+            self.result_store.contains(tile, self.get_parameters())
+
+    def do_registration_and_transform(self, tile: Tile, profiler: Profiler = None):
         """ This function applies the registration in the following order:
             1. Register the channels for each round of each tile.
             2. Apply transformations
             3. Register the rounds
             4. Apply transformation
+            With warp_peaks step 2 is skipped and step 4 applies the composed channel and round
+            transformations (or nothing if resample is False).
+            If results for the tile are stored in the result store, they are restored and
+            applied instead.
 
         Args:
             tile (Tile): The tile that the registration and transformations are to be performed on.
+            profiler (Profiler, optional): If given, loading, peak finding, registration and
+                transformation of each round and channel are measured. Defaults to None.
         """
+        if self.result_store is not None and \
+                self.result_store.restore(tile, self.get_parameters()):
+            if self.resample or not self.warp_peaks:
+                self._apply_transformations(tile, profiler)
+            return
+
+        if profiler is not None:
+            _measure_rounds(tile, profiler, '_load_image',
+                            lambda round: tile.get_round(round).get_data())
+
         self.channel_registration.do_channel_registration(
-            tile, self.reference_channel)
+            tile, self.reference_channel, profiler)
+
+        if self.warp_peaks:
+            self.round_registration.do_round_registration(tile,
+                                                          self.reference_round,
+                                                          self.reference_channel,
+                                                          profiler,
+                                                          warp_peaks=True)
+            if self.result_store is not None:
+                self._save_results(tile)
+            if self.resample:
+                self._apply_transformations(tile, profiler)
+            return
 
-        tile.apply_channel_transformations()
+        _measure_rounds(tile, profiler, 'apply_channel_transformations',
+                        lambda round: tile.get_round(round).apply_transformations())
 
         self.round_registration.do_round_registration(tile,
                                                       self.reference_round,
-                                                      self.reference_channel)
+                                                      self.reference_channel,
+                                                      profiler)
+
+        if self.result_store is not None:
+            self._save_results(tile)
+
+        _measure_rounds(tile, profiler, 'apply_round_transformations',
+                        lambda round: tile.get_round(round).apply_transform_to_whole_image(
+                            tile.round_transformations[round]))
 
-        tile.apply_round_transformations()
+    def register_added_rounds(self, tile: Tile, profiler: Profiler = None) -> List[int]:
+        """Registers and transforms only the rounds of a registered tile that have no
+            registration result yet, e.g. rounds appended with Tile.add_round. Their channels
+            are registered as usual and each round is registered against the reference peaks
+            the round registration kept from registering the tile (or the result store kept,
+            if this registration did not register the tile), so the cost of a new round does
+            not grow with the number of rounds. The other rounds are not changed.
+
+        Args:
+            tile (Tile): The tile registered by do_registration_and_transform.
+            profiler (Profiler, optional): If given, peak finding and registration of the new
+                rounds are measured. Defaults to None.
+
+        Returns:
+            List[int]: the registered rounds
+        """
+        rounds = self.round_registration.get_added_rounds(tile, self.reference_round)
+        if not rounds:
+            return rounds
+        self.channel_registration.do_channel_registration(
+            tile, self.reference_channel, profiler, rounds=rounds)
+        if not self.warp_peaks:
+            for round in rounds:
+                tile.get_round(round).apply_transformations()
+
+        reference = tile.get_round(self.reference_round)
+        if self.result_store is not None and \
+                reference not in self.round_registration.reference_peak_cache:
+            peaks = self.result_store.restore_reference_peaks(reference, self.get_parameters())
+            if peaks is not None:
+                self.round_registration.reference_peak_cache[reference] = peaks
+        self.round_registration.do_round_registration(tile,
+                                                      self.reference_round,
+                                                      self.reference_channel,
+                                                      profiler,
+                                                      warp_peaks=self.warp_peaks,
+                                                      rounds=rounds)
+        if self.result_store is not None:
+            self._save_results(tile)
+
+        for round in rounds:
+            if not self.warp_peaks:
+                tile.get_round(round).apply_transform_to_whole_image(
+                    tile.round_transformations[round])
+            elif self.resample:
+                tile.get_round(round).apply_transformations(tile.round_transformations[round])
+        return rounds
+
+    def _save_results(self, tile: Tile):
+        """Saves the results of the tile and the reference peaks of its round registration to
+            the result store.
+        """
+        parameters = self.get_parameters()
+        self.result_store.save(tile, parameters)
+        reference = tile.get_round(self.reference_round)
+        peaks = self.round_registration.reference_peak_cache.get(reference)
+        if peaks:
+            self.result_store.save_reference_peaks(reference, parameters, peaks)
+
+    def _apply_transformations(self, tile: Tile, profiler: Profiler = None):
+        """Applies the channel and round transformations composed, each plane is resampled once.
+        """
+        _measure_rounds(tile, profiler, 'apply_transformations',
+                        lambda round: tile.get_round(round).apply_transformations(
+                            tile.round_transformations[round]))
+
+
+def _measure_rounds(tile: Tile, profiler: Profiler, stage: str, function: Callable[[int], object]):
+    """Calls function for each round of the tile and measures each call as a stage. The bytes
+        of the round are recorded as well, for _load_image only if the round was not loaded yet.
+    """
+    for round in range(tile.get_round_count()):
+        image = tile.get_round(round)
+        loaded = image.is_loaded()
+        with measure(profiler, stage, round=round) as record:
+            function(round)
+            record['bytes'] = 0 if stage == '_load_image' and loaded else image.data.nbytes
@@ -0,0 +1 @@
+from .stitching import PairwiseOffset, Stitching, grid_positions, write_mosaic
@@ -0,0 +1,316 @@
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from situr.image.tile_collection import TileCollection
+from situr.registration.phase_correlation import phase_correlation
+from situr.transformation import RotateTranslateTransform
+
+
+def grid_positions(rows: int,
+                   columns: int,
+                   tile_shape: Tuple[int, int],
+                   overlap: float,
+                   snake: bool = False) -> np.ndarray:
+    """Returns the nominal positions of tiles acquired on a regular grid, row by row.
+
+    Args:
+        rows (int): The number of rows of tiles.
+        columns (int): The number of columns of tiles.
+        tile_shape (Tuple[int, int]): The shape (y, x) of a tile in pixels.
+        overlap (float): The fraction of a tile that overlaps with its neighbour, e.g. 0.1.
+        snake (bool, optional): If True every second row is acquired from right to left.
+            Defaults to False.
+
+    Returns:
+        np.ndarray: The position (y, x) of the upper left corner of each tile of shape (n, 2).
+    """
+    step = np.asarray(tile_shape) * (1 - overlap)
+    positions = []
+    for row in range(rows):
+        order = range(columns - 1, -1, -1) if snake and row % 2 else range(columns)
+        for column in order:
+            positions.append((row * step[0], column * step[1]))
+    return np.array(positions)
+
+
+def _overlap(position: np.ndarray, other_position: np.ndarray,
+             tile_shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the upper left and lower right corner (y, x) of the region two tiles share.
+    """
+    start = np.maximum(position, other_position)
+    stop = np.minimum(position, other_position) + tile_shape
+    return start, stop
+
+
+class PairwiseOffset:
+    """The measured placement of a tile relative to an overlapping tile.
+
+    ...
+
+    Attributes
+    ----------
+    tile : int
+        the tile number of the first tile
+    other_tile : int
+        the tile number of the second tile
+    offset : np.ndarray
+        the measured position (y, x) of the second tile minus the position of the first tile
+    weight : float
+        the height of the phase correlation peak, close to 1 for a reliable offset
+    """
+
+    def __init__(self, tile: int, other_tile: int, offset: np.ndarray, weight: float):
+        self.tile = tile
+        self.other_tile = other_tile
+        self.offset = offset
+        self.weight = weight
+
+
+class Stitching:
+    """Places all tiles of a collection in one mosaic. Neighbouring tiles are registered by
+        phase correlation of the strips in which they overlap and a global least squares
+        problem finds positions that agree best with all pairwise offsets.
+
+    ...
+
+    Attributes
+    ----------
+    round : int
+        the round used to register the tiles
+    channel : int
+        the channel used to register the tiles
+    focus_level : int
+        the focus level used to register the tiles
+    min_overlap : int
+        tiles are only registered if their nominal overlap is at least this many pixels in both
+        directions
+    min_weight : float
+        pairwise offsets with a lower correlation peak are not used
+    prior_weight : float
+        the weight that pulls each tile towards its nominal position, it keeps tiles without
+        reliable neighbours in place
+    """
+
+    def __init__(self,
+                 round: int = 0,
+                 channel: int = 0,
+                 focus_level: int = 0,
+                 min_overlap: int = 32,
+                 min_weight: float = 0.05,
+                 prior_weight: float = 1e-3):
+        """Initializes the stitching.
+
+        Args:
+            round (int, optional): The round used for the registration. Defaults to 0.
+            channel (int, optional): The channel used for the registration. Defaults to 0.
+            focus_level (int, optional): The focus level used for the registration.
+                Defaults to 0.
+            min_overlap (int, optional): The smallest overlap in pixels of two registered tiles.
+                Defaults to 32.
+            min_weight (float, optional): The smallest correlation peak of a used pairwise
+                offset. Defaults to 0.05.
+            prior_weight (float, optional): The weight of the nominal position of each tile.
+                Defaults to 1e-3.
+        """
+        self.round = round
+        self.channel = channel
+        self.focus_level = focus_level
+        self.min_overlap = min_overlap
+        self.min_weight = min_weight
+        self.prior_weight = prior_weight
+
+    def get_plane(self, collection: TileCollection, tile_number: int) -> np.ndarray:
+        """Reads the plane of a tile that is used for stitching. Only the file of that plane is
+            read if the round is not loaded.
+
+        Args:
+            collection (TileCollection): the collection
+            tile_number (int): the tile number
+
+        Returns:
+            np.ndarray: the plane of shape (image_size_y, image_size_x)
+        """
+        image = collection.get_tile(tile_number).get_round(self.round)
+        return image.read_planes([self.channel], [self.focus_level])[0, 0]
+
+    def get_pairs(self, positions: np.ndarray, tile_shape: Tuple[int, int]) -> List[Tuple[int, int]]:
+        """Returns the pairs of tiles that overlap at their nominal positions.
+
+        Args:
+            positions (np.ndarray): The nominal positions (y, x) of shape (n, 2).
+            tile_shape (Tuple[int, int]): The shape (y, x) of a tile.
+
+        Returns:
+            List[Tuple[int, int]]: the overlapping pairs of tile numbers
+        """
+        pairs = []
+        for tile in range(len(positions)):
+            for other_tile in range(tile + 1, len(positions)):
+                start, stop = _overlap(positions[tile], positions[other_tile], tile_shape)
+                if np.all(stop - start >= self.min_overlap):
+                    pairs.append((tile, other_tile))
+        return pairs
+
+    def register_pairs(self, collection: TileCollection, positions: np.ndarray) -> List[PairwiseOffset]:
+        """Measures the offsets of all overlapping tiles. Each plane is read once and dropped
+            as soon as all pairs it belongs to are registered.
+
+        Args:
+            collection (TileCollection): The tiles.
+            positions (np.ndarray): The nominal positions (y, x) of shape (n, 2).
+
+        Returns:
+            List[PairwiseOffset]: the offsets of all overlapping pairs
+        """
+        positions = np.round(positions).astype(int)
+        first_plane = self.get_plane(collection, 0)
+        tile_shape = np.array(first_plane.shape)
+        pairs = self.get_pairs(positions, tile_shape)
+        remaining_uses = np.bincount(np.ravel(pairs), minlength=len(positions))
+        planes: Dict[int, np.ndarray] = {0: first_plane}
+
+        offsets = []
+        for tile, other_tile in pairs:
+            for number in (tile, other_tile):
+                if number not in planes:
+                    planes[number] = self.get_plane(collection, number)
+            start, stop = _overlap(positions[tile], positions[other_tile], tile_shape)
+            strips = []
+            for number in (tile, other_tile):
+                local_start = start - positions[number]
+                local_stop = stop - positions[number]
+                strips.append(planes[number][local_start[0]:local_stop[0],
+                                             local_start[1]:local_stop[1]])
+            shift, height = phase_correlation(strips[1], strips[0])
+            offsets.append(PairwiseOffset(
+                tile, other_tile, positions[other_tile] - positions[tile] + shift, height))
+            for number in (tile, other_tile):
+                remaining_uses[number] -= 1
+                if remaining_uses[number] == 0:
+                    del planes[number]
+        return offsets
+
+    def solve(self, offsets: List[PairwiseOffset], positions: np.ndarray) -> np.ndarray:
+        """Finds the positions that agree best with the pairwise offsets in the weighted least
+            squares sense.
+
+        Args:
+            offsets (List[PairwiseOffset]): The measured pairwise offsets.
+            positions (np.ndarray): The nominal positions (y, x) of shape (n, 2).
+
+        Returns:
+            np.ndarray: the positions (y, x) of shape (n, 2)
+        """
+        offsets = [offset for offset in offsets if offset.weight >= self.min_weight]
+        count = len(positions)
+        matrix = np.zeros((len(offsets) + count, count))
+        target = np.zeros((len(offsets) + count, 2))
+        weights = np.empty(len(offsets) + count)
+        for row, offset in enumerate(offsets):
+            matrix[row, offset.other_tile] = 1
+            matrix[row, offset.tile] = -1
+            target[row] = offset.offset
+            weights[row] = offset.weight
+        matrix[len(offsets):] = np.eye(count)
+        target[len(offsets):] = positions
+        weights[len(offsets):] = self.prior_weight
+
+        weights = np.sqrt(weights)[:, np.newaxis]
+        solution, _, _, _ = np.linalg.lstsq(matrix * weights, target * weights, rcond=None)
+        return solution
+
+    def stitch(self, collection: TileCollection, positions: np.ndarray) -> np.ndarray:
+        """Registers all overlapping tiles, solves their global placement and sets the tile
+            transformations of the collection accordingly.
+
+        Args:
+            collection (TileCollection): The tiles.
+            positions (np.ndarray): The nominal positions (y, x) of shape (n, 2), e.g. from
+                grid_positions or the stage coordinates of the microscope.
+
+        Returns:
+            np.ndarray: the positions (y, x) of shape (n, 2)
+        """
+        positions = np.asarray(positions, dtype=float)
+        solution = self.solve(self.register_pairs(collection, positions), positions)
+        for tile_number, position in enumerate(solution):
+            collection.set_tile_transformation(
+                tile_number, RotateTranslateTransform(np.eye(2), offset=position))
+        return solution
+
+
+def write_mosaic(collection: TileCollection,
+                 path: str,
+                 round: int = 0,
+                 channel: int = 0,
+                 focus_level: int = 0,
+                 block_size: int = 2048) -> Tuple[int, int]:
+    """Fuses one plane of all tiles into a mosaic .npy file. The tiles are placed at the
+        translation of their tile transformation (rounded to whole pixels) and overlapping
+        pixels are averaged. The mosaic is written block by block into a memory mapped file,
+        only the planes of the tiles touching the current row of blocks are held in memory.
+
+    Args:
+        collection (TileCollection): The tiles, usually placed by Stitching.stitch.
+        path (str): The .npy file to write.
+        round (int, optional): The round to fuse. Defaults to 0.
+        channel (int, optional): The channel to fuse. Defaults to 0.
+        focus_level (int, optional): The focus level to fuse. Defaults to 0.
+        block_size (int, optional): The size of the blocks in pixels. Defaults to 2048.
+
+    Returns:
+        Tuple[int, int]: the shape (y, x) of the mosaic
+    """
+    def get_plane(tile_number):
+        image = collection.get_tile(tile_number).get_round(round)
+        return image.read_planes([channel], [focus_level])[0, 0]
+
+    positions = np.array([
+        transformation.get_matrix()[[1, 0], 2]
+        for transformation in collection.tile_transformations])
+    positions = np.round(positions - positions.min(axis=0)).astype(int)
+    planes = {0: get_plane(0)}
+    tile_shape = np.array(planes[0].shape)
+    shape = tuple(int(size) for size in (positions + tile_shape).max(axis=0))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Write to a temporary file first so that an interrupted mosaic is not picked up
+    temporary_path = path + '.tmp.npy'
+    mosaic = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=planes[0].dtype,
+                                       shape=shape)
+    for block_y in range(0, shape[0], block_size):
+        block_stop_y = min(block_y + block_size, shape[0])
+        band = [tile_number for tile_number, position in enumerate(positions)
+                if position[0] < block_stop_y and position[0] + tile_shape[0] > block_y]
+        planes = {tile_number: planes[tile_number] if tile_number in planes
+                  else get_plane(tile_number) for tile_number in band}
+
+        for block_x in range(0, shape[1], block_size):
+            block_stop_x = min(block_x + block_size, shape[1])
+            block_start = np.array([block_y, block_x])
+            block_stop = np.array([block_stop_y, block_stop_x])
+            total = np.zeros(block_stop - block_start, dtype=np.float64)
+            count = np.zeros(block_stop - block_start, dtype=np.uint16)
+            for tile_number in band:
+                start = np.maximum(block_start, positions[tile_number])
+                stop = np.minimum(block_stop, positions[tile_number] + tile_shape)
+                if np.any(stop <= start):
+                    continue
+                source = planes[tile_number][
+                    start[0] - positions[tile_number][0]:stop[0] - positions[tile_number][0],
+                    start[1] - positions[tile_number][1]:stop[1] - positions[tile_number][1]]
+                target = (slice(start[0] - block_y, stop[0] - block_y),
+                          slice(start[1] - block_x, stop[1] - block_x))
+                total[target] += source
+                count[target] += 1
+            block = total / np.maximum(count, 1)
+            if np.issubdtype(mosaic.dtype, np.integer):
+                block = np.round(block)
+            mosaic[block_y:block_stop_y, block_x:block_stop_x] = block
+        mosaic.flush()
+
+    del mosaic
+    os.replace(temporary_path, path)
+    return shape
@@ -1 +1,2 @@
-from .transformation import Transform, IdentityTransform, RotateTranslateTransform
+from .transformation import Transform, AffineTransform, IdentityTransform, RotateTranslateTransform
+from .transformation import ScratchBuffers, apply_transformations_to_stack, transform_from_dict
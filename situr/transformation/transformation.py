@@ -1,29 +1,326 @@
 import abc
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 import numpy as np
-import scipy
+import scipy.ndimage
+
+# Swaps x and y of homogeneous 2D coordinates
+_SWAP_XY = np.array([[0, 1, 0],
+                     [1, 0, 0],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+class ScratchBuffers:
+    """Keeps temporary arrays that are reused between transformations of equally sized planes,
+        so that transforming a stack does not allocate memory for every plane.
+        A ScratchBuffers object must not be shared between threads.
+
+    ...
+
+    Attributes
+    ----------
+    float_dtype : numpy.dtype
+        the working precision of the interpolation, i.e. the dtype of the spline coefficients
+    """
+
+    def __init__(self, float_dtype=np.float32):
+        """Initializes empty scratch buffers.
+
+        Args:
+            float_dtype (optional): The working precision of the interpolation.
+                Defaults to np.float32.
+        """
+        self.float_dtype = np.dtype(float_dtype)
+        self.buffers = {}
+
+    def get(self, shape: Tuple[int, ...], dtype=None, name: str = '') -> np.ndarray:
+        """Returns an uninitialized array, reusing a previous one of the same shape and dtype.
+
+        Args:
+            shape (Tuple[int, ...]): the shape of the array
+            dtype (optional): the dtype of the array. Defaults to None (float_dtype).
+            name (str, optional): distinguishes arrays that are needed at the same time.
+                Defaults to ''.
+
+        Returns:
+            np.ndarray: the array
+        """
+        if dtype is None:
+            dtype = self.float_dtype
+        key = (name, tuple(shape), np.dtype(dtype))
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buffer
+        return buffer
+
+
+def _apply_to_planes(tasks: list, workers: int, float_dtype):
+    """Applies each transformation in a list of (transformation, plane, output) triples.
+        The scipy interpolation releases the GIL, so planes can be processed by threads.
+        Each thread reuses its own scratch buffers.
+    """
+    if workers is None or workers > 1:
+        local = threading.local()
+
+        def apply(task):
+            if not hasattr(local, 'buffers'):
+                local.buffers = ScratchBuffers(float_dtype)
+            task[0].apply_tranformation(task[1], output=task[2], buffers=local.buffers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() to reraise exceptions of the workers
+            list(executor.map(apply, tasks))
+    else:
+        buffers = ScratchBuffers(float_dtype)
+        for transformation, plane, output in tasks:
+            transformation.apply_tranformation(plane, output=output, buffers=buffers)
+
+
+def _plane_tasks(transformation: 'Transform', stack: np.ndarray, output: np.ndarray) -> list:
+    if output is None and isinstance(transformation, AffineTransform) and \
+            np.allclose(transformation.get_matrix(), np.eye(3)):
+        return []
+    return [(transformation, stack[index], None if output is None else output[index])
+            for index in np.ndindex(stack.shape[:-2])]
+
+
+def apply_transformations_to_stack(stack: np.ndarray,
+                                   transformations: List['Transform'],
+                                   workers: int = 1,
+                                   output: np.ndarray = None,
+                                   float_dtype=np.float32) -> np.ndarray:
+    """Applies one transformation per channel to a stack of images.
+
+    Args:
+        stack (np.ndarray): image data of shape (channels, ..., image_size_y, image_size_x),
+            e.g. (channels, focus_levels, image_size_y, image_size_x)
+        transformations (List[Transform]): one transformation for each channel
+        workers (int, optional): The number of threads the planes are distributed on.
+            None uses the default of ThreadPoolExecutor. Defaults to 1.
+        output (np.ndarray, optional): Preallocated array the result is written to. It has the
+            same leading dimensions as stack, but its dtype and plane size may differ.
+            Defaults to None (the stack is transformed in place).
+        float_dtype (optional): The working precision of the interpolation.
+            Defaults to np.float32.
+
+    Returns:
+        np.ndarray: the transformed stack
+    """
+    tasks = []
+    for channel, transformation in enumerate(transformations):
+        tasks.extend(_plane_tasks(transformation, stack[channel],
+                                  None if output is None else output[channel]))
+    _apply_to_planes(tasks, workers, float_dtype)
+    return stack if output is None else output
 
 
 class Transform:
     """Abstract class representing a transformatio that can be performed on an image.
+        Every transformation can be expressed as a homogeneous matrix, which allows
+        transformations to be composed and applied with a single resampling step.
     """
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def apply_tranformation(self, img: np.ndarray) -> np.ndarray:
+    def apply_tranformation(self,
+                            img: np.ndarray,
+                            output: np.ndarray = None,
+                            dtype=None,
+                            buffers: ScratchBuffers = None) -> np.ndarray:
+        """Applies the transformation to a single plane.
+
+        Args:
+            img (np.ndarray): the plane of shape (image_size_y, image_size_x)
+            output (np.ndarray, optional): Preallocated array the result is written to. It can
+                have a different size than img, e.g. to hold a scaled image (see
+                get_output_shape). Defaults to None.
+            dtype (optional): If given and output is None, a new array of this dtype is returned
+                instead of transforming img in place. Defaults to None.
+            buffers (ScratchBuffers, optional): Temporary arrays to reuse. They also define the
+                working precision. Defaults to None (new float32 buffers).
+
+        Raises:
+            NotImplementedError: This method is abstract and therefore calling
+                it results in an error.
+
+        Returns:
+            np.ndarray: the transformed plane (img itself if neither output nor dtype is given)
+        """
         raise NotImplementedError(
             self.__class__.__name__ + '.apply_transformation')
 
+    @abc.abstractmethod
+    def get_matrix(self) -> np.ndarray:
+        """Returns the transformation as homogeneous matrix.
+
+        Raises:
+            NotImplementedError: This method is abstract and therefore calling
+                it results in an error.
+
+        Returns:
+            np.ndarray: matrix of shape (3, 3) mapping (x, y, 1) coordinates of the transformed
+                image onto the reference.
+        """
+        raise NotImplementedError(
+            self.__class__.__name__ + '.get_matrix')
+
+    def apply_tranformation_to_stack(self,
+                                     stack: np.ndarray,
+                                     workers: int = 1,
+                                     output: np.ndarray = None,
+                                     float_dtype=np.float32) -> np.ndarray:
+        """Applies the transformation to every plane of a stack of images.
 
-class IdentityTransform(Transform):
+        Args:
+            stack (np.ndarray): image data of shape (..., image_size_y, image_size_x),
+                e.g. (focus_levels, image_size_y, image_size_x)
+            workers (int, optional): The number of threads the planes are distributed on.
+                None uses the default of ThreadPoolExecutor. Defaults to 1.
+            output (np.ndarray, optional): Preallocated array the result is written to. It has
+                the same leading dimensions as stack, but its dtype and plane size may differ.
+                Defaults to None (the stack is transformed in place).
+            float_dtype (optional): The working precision of the interpolation.
+                Defaults to np.float32.
+
+        Returns:
+            np.ndarray: the transformed stack
+        """
+        _apply_to_planes(_plane_tasks(self, stack, output), workers, float_dtype)
+        return stack if output is None else output
+
+    def get_output_shape(self, shape: Tuple[int, int]) -> Tuple[int, int]:
+        """Returns the size of a canvas that holds the whole transformed image, e.g. a larger
+            canvas for scale factors above one.
+
+        Args:
+            shape (Tuple[int, int]): the shape (image_size_y, image_size_x) of the input plane
+
+        Returns:
+            Tuple[int, int]: the shape of the canvas starting at the origin
+        """
+        corners = np.array([[0, 0, 1],
+                            [shape[1], 0, 1],
+                            [0, shape[0], 1],
+                            [shape[1], shape[0], 1]], dtype=np.float64)
+        transformed = corners @ self.get_matrix().T
+        size_x, size_y = np.ceil(transformed[:, 0:2].max(axis=0) - 1e-9).astype(int)
+        return (max(int(size_y), 1), max(int(size_x), 1))
+
+    def to_dict(self) -> dict:
+        """Returns a json serializable representation of the transformation
+            (see transform_from_dict).
+
+        Returns:
+            dict: the type and parameters of the transformation
+        """
+        return {'type': self.__class__.__name__,
+                'matrix': self.get_matrix().tolist()}
+
+    def apply_to_points(self, points: np.ndarray) -> np.ndarray:
+        """Applies the transformation to point coordinates, e.g. peaks, instead of pixels.
+
+        Args:
+            points (np.ndarray): The points (x, y) of shape (n, 2).
+
+        Returns:
+            np.ndarray: The transformed points of shape (n, 2).
+        """
+        matrix = self.get_matrix()
+        return points @ matrix[0:2, 0:2].T + matrix[0:2, 2]
+
+    def compose(self, other: 'Transform') -> 'AffineTransform':
+        """Combines this transformation with another one.
+
+        Args:
+            other (Transform): The transformation applied after this one.
+
+        Returns:
+            AffineTransform: A transformation equivalent to applying this transformation first
+                and other afterwards.
+        """
+        return AffineTransform(other.get_matrix() @ self.get_matrix())
+
+
+class AffineTransform(Transform):
+    """A transformation described by an arbitrary homogeneous matrix. The image is resampled
+        once with scipy.ndimage.affine_transform. It inherits from Transform.
+    """
+
+    def __init__(self, matrix: np.ndarray):
+        """Constructor for an affine transformation.
+
+        Args:
+            matrix (np.ndarray): A matrix of shape (3, 3) mapping (x, y, 1) coordinates of the
+                transformed image onto the reference (see Transform.get_matrix).
+        """
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    def get_matrix(self) -> np.ndarray:
+        return self.matrix
+
+    def apply_tranformation(self,
+                            img: np.ndarray,
+                            output: np.ndarray = None,
+                            dtype=None,
+                            buffers: ScratchBuffers = None) -> np.ndarray:
+        if output is None:
+            output = img if dtype is None else np.empty(img.shape, dtype=dtype)
+        matrix = self.get_matrix()
+        if np.allclose(matrix, np.eye(3)) and output.shape == img.shape:
+            if output is not img:
+                np.copyto(output, img, casting='unsafe')
+            return output
+        if buffers is None:
+            buffers = ScratchBuffers()
+
+        # The spline coefficients are computed into a separate buffer, so the
+        # interpolation may write into img itself
+        coefficients = buffers.get(img.shape, name='coefficients')
+        scipy.ndimage.spline_filter(img, order=3, output=coefficients, mode='constant')
+
+        # affine_transform works on (y, x) indices and maps output onto input coordinates
+        inverse = np.linalg.inv(_SWAP_XY @ matrix @ _SWAP_XY)
+        if np.issubdtype(output.dtype, np.integer):
+            # Round and clip instead of letting cubic overshoot wrap around
+            result = buffers.get(output.shape, name='result')
+            scipy.ndimage.affine_transform(coefficients, inverse[0:2, 0:2],
+                                           offset=inverse[0:2, 2], output=result,
+                                           order=3, mode='constant', prefilter=False)
+            info = np.iinfo(output.dtype)
+            np.rint(result, out=result)
+            np.clip(result, info.min, info.max, out=result)
+            np.copyto(output, result, casting='unsafe')
+        else:
+            scipy.ndimage.affine_transform(coefficients, inverse[0:2, 0:2],
+                                           offset=inverse[0:2, 2], output=output,
+                                           order=3, mode='constant', prefilter=False)
+        return output
+
+
+class IdentityTransform(AffineTransform):
     """A transformation that does not change the image.
-        It inherits from Transform.
+        It inherits from AffineTransform.
     """
 
-    def apply_tranformation(self, img: np.ndarray) -> np.ndarray:
-        return img
+    def __init__(self):
+        super().__init__(np.eye(3))
+
+    def to_dict(self) -> dict:
+        return {'type': self.__class__.__name__}
+
+    def apply_tranformation(self,
+                            img: np.ndarray,
+                            output: np.ndarray = None,
+                            dtype=None,
+                            buffers: ScratchBuffers = None) -> np.ndarray:
+        if output is None and dtype is None:
+            return img
+        return super().apply_tranformation(img, output=output, dtype=dtype, buffers=buffers)
 
 
-class RotateTranslateTransform(Transform):
+class RotateTranslateTransform(AffineTransform):
     def __init__(self,
                  transform_matrix: np.ndarray,
                  scale: int = 1,
@@ -43,8 +340,39 @@ class RotateTranslateTransform(Transform):
         self.offset = offset
         self.scale = scale
 
-    def apply_tranformation(self, img: np.ndarray) -> np.ndarray:
-        img[:, :] = scipy.ndimage.affine_transform(
-            img, self.transform_matrix)
-        img[:, :] = scipy.ndimage.zoom(img, self.scale)
-        img[:, :] = scipy.ndimage.shift(img, self.offset)
+    def get_matrix(self) -> np.ndarray:
+        matrix = np.eye(3)
+        matrix[0:2, 0:2] = self.scale * np.asarray(self.transform_matrix)
+        # the offset is stored in (y, x) order
+        matrix[0:2, 2] = np.asarray(self.offset)[[1, 0]]
+        return matrix
+
+    def to_dict(self) -> dict:
+        return {'type': self.__class__.__name__,
+                'transform_matrix': np.asarray(self.transform_matrix).tolist(),
+                'scale': float(self.scale),
+                'offset': np.asarray(self.offset).tolist()}
+
+
+def transform_from_dict(parameters: dict) -> Transform:
+    """Creates a transformation from the output of Transform.to_dict.
+
+    Args:
+        parameters (dict): the type and parameters of the transformation
+
+    Raises:
+        ValueError: if the type of transformation is unknown
+
+    Returns:
+        Transform: the transformation
+    """
+    transform_type = parameters['type']
+    if transform_type == IdentityTransform.__name__:
+        return IdentityTransform()
+    if transform_type == RotateTranslateTransform.__name__:
+        return RotateTranslateTransform(np.array(parameters['transform_matrix']),
+                                        scale=parameters['scale'],
+                                        offset=np.array(parameters['offset']))
+    if transform_type == AffineTransform.__name__:
+        return AffineTransform(np.array(parameters['matrix']))
+    raise ValueError('Unknown transformation type: ' + transform_type)
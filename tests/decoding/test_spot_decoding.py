@@ -0,0 +1,67 @@
+from situr.decoding import Codebook, SpotDecoder
+from situr.image import Tile
+from situr.transformation import RotateTranslateTransform
+
+import numpy as np
+import os
+import tempfile
+import unittest
+
+
+class TestSpotDecoder(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.codebook = Codebook.from_channel_indices(
+            ['a', 'b', 'c'], [[0, 1], [1, 1], [1, 0]], channel_count=2)
+        rng = np.random.default_rng(0)
+        positions = rng.choice(60 * 60, 200, replace=False)
+        self.peaks = np.stack([positions % 60, positions // 60], axis=1) + 2.0
+        self.genes = rng.integers(0, 3, 200)
+
+        # every spot lights up the channels of its barcode, channel 2 is the nucleaus channel
+        data = rng.uniform(0, 5, (2, 3, 64, 64))
+        x, y = self.peaks[:, 0].astype(int), self.peaks[:, 1].astype(int)
+        for round in range(2):
+            for channel in range(2):
+                data[round, channel, y, x] += 100 * self.codebook.barcodes[self.genes, round, channel]
+        self.file_list = []
+        for round in range(2):
+            self.file_list.append([])
+            for channel in range(3):
+                path = os.path.join(self.directory.name, 'r{}_c{}.npy'.format(round, channel))
+                np.save(path, data[round, channel].astype(np.float32))
+                self.file_list[round].append([path])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_decodes_all_spots(self):
+        tile = Tile(self.file_list, nucleaus_channel=2)
+        decoder = SpotDecoder(self.codebook, radius=0)
+        self.assertEqual(decoder.get_channels(tile), [0, 1])
+
+        spots = decoder.decode_tile(tile, self.peaks)
+        self.assertEqual(len(spots), 200)
+        self.assertTrue(np.array_equal(spots['gene'], self.genes))
+        self.assertTrue(np.allclose(spots['x'], self.peaks[:, 0]))
+
+    def test_lazy_transformations_are_applied(self):
+        # round 1 is recorded shifted by 2 pixels in x, its round transformation undoes that
+        for channel in range(3):
+            path = self.file_list[1][channel][0]
+            np.save(path, np.roll(np.load(path), 2, axis=1))
+        tile = Tile(self.file_list, nucleaus_channel=2)
+        tile.set_round_transformation(
+            1, RotateTranslateTransform(np.eye(2), offset=np.array([0, -2])))
+        tile.apply_transformations(lazy=True)
+
+        spots = SpotDecoder(self.codebook, radius=0).decode_tile(tile, self.peaks)
+        self.assertTrue(np.array_equal(spots['gene'], self.genes))
+        self.assertFalse(tile.get_round(1).is_loaded())
+
+    def test_max_distance_rejects_spots(self):
+        decoder = SpotDecoder(self.codebook, max_distance=0.1)
+        intensities = np.array([[[1, 0], [0, 1]], [[1, 1], [1, 1]], [[0, 0], [0, 0]]])
+        genes, distances, _ = decoder.decode(intensities)
+        self.assertTrue(np.array_equal(genes, [0, -1, -1]))
+        self.assertAlmostEqual(distances[0], 0)
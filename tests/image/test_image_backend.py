@@ -0,0 +1,61 @@
+from situr.image import SituImage, MemmapImageBackend, PillowImageBackend
+
+from PIL import Image
+import numpy as np
+import os
+import tempfile
+import unittest
+
+
+class TestMemmapImageBackend(unittest.TestCase):
+    def test_memmap_matches_pillow(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_list = []
+            for channel in range(2):
+                focus_level_list = []
+                for focus_level in range(3):
+                    file = os.path.join(directory, 'c{}_z{}.tif'.format(channel, focus_level))
+                    Image.fromarray(np.random.randint(0, 255, (6, 7), dtype=np.uint8)).save(file)
+                    focus_level_list.append(file)
+                file_list.append(focus_level_list)
+
+            expected = SituImage(file_list).get_data()
+            img = SituImage(file_list, backend=MemmapImageBackend(os.path.join(directory, 'cache')))
+            self.assertIsInstance(img.get_data(), np.memmap)
+            self.assertTrue(np.array_equal(expected, img.get_data()))
+            self.assertTrue(np.array_equal(expected[1, 2], img.get_focus_level(1, 2)))
+            del img
+
+    def test_replaced_file_is_converted_again(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'c0_z0.tif')
+            Image.fromarray(np.zeros((6, 7), dtype=np.uint8)).save(file)
+            backend = MemmapImageBackend(os.path.join(directory, 'cache'))
+            self.assertEqual(backend.load([[file]])[0, 0, 0, 0], 0)
+
+            Image.fromarray(np.ones((6, 7), dtype=np.uint8)).save(file)
+            os.utime(file, ns=(0, 0))
+            self.assertEqual(backend.load([[file]])[0, 0, 0, 0], 1)
+
+
+class TestPillowImageBackend(unittest.TestCase):
+    def test_subset_and_thread_pool_match_serial_loading(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_list = []
+            for channel in range(3):
+                focus_level_list = []
+                for focus_level in range(4):
+                    file = os.path.join(directory, 'c{}_z{}.tif'.format(channel, focus_level))
+                    Image.fromarray(np.random.randint(0, 2**16, (5, 9), dtype=np.uint16)).save(file)
+                    focus_level_list.append(file)
+                file_list.append(focus_level_list)
+
+            serial = PillowImageBackend(workers=1).load(file_list)
+            self.assertEqual(serial.shape, (3, 4, 5, 9))
+            self.assertEqual(serial.dtype, np.uint16)
+            self.assertTrue(np.array_equal(serial, PillowImageBackend(workers=4).load(file_list)))
+
+            img = SituImage(file_list)
+            subset = img.read_planes(channels=[2], focus_levels=[1, 3])
+            self.assertFalse(img.is_loaded())
+            self.assertTrue(np.array_equal(subset, serial[[2]][:, [1, 3]]))
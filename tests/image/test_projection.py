@@ -0,0 +1,50 @@
+from situr.image import SituImage, MaxIntensityProjection, BestFocusProjection
+from situr.image import ExtendedDepthOfFieldProjection
+from situr.registration import PeakFinderDifferenceOfGaussian
+
+import numpy as np
+import scipy.ndimage
+import unittest
+
+
+class TestProjection(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        sharp = np.zeros((64, 64))
+        coordinates = rng.integers(5, 59, (20, 2))
+        sharp[coordinates[:, 0], coordinates[:, 1]] = 1
+        sharp = scipy.ndimage.gaussian_filter(sharp, 1) * 2000
+        # two channels with three focus levels, the second focus level is the sharpest one
+        focus_levels = [scipy.ndimage.gaussian_filter(sharp, 3), sharp,
+                        scipy.ndimage.gaussian_filter(sharp, 5)]
+        self.sharp = sharp.astype(np.uint16)
+        self.stack = np.stack([np.stack(focus_levels), np.stack(focus_levels)]).astype(np.uint16)
+
+    def test_max_intensity(self):
+        projected = MaxIntensityProjection().project(self.stack)
+        self.assertEqual(projected.shape, (2, 64, 64))
+        self.assertTrue(np.array_equal(projected, self.stack.max(axis=1)))
+
+    def test_best_focus(self):
+        projection = BestFocusProjection()
+        self.assertTrue(np.array_equal(projection.get_focus_levels(self.stack), [1, 1]))
+        self.assertTrue(np.array_equal(projection.project(self.stack)[0], self.sharp))
+
+    def test_extended_depth_of_field(self):
+        projected = ExtendedDepthOfFieldProjection().project(self.stack)
+        self.assertEqual(projected.dtype, np.uint16)
+        # the blend follows the sharp focus level closer than the average
+        error = np.abs(projected[0].astype(float) - self.sharp).mean()
+        average_error = np.abs(self.stack[0].mean(axis=0) - self.sharp).mean()
+        self.assertLess(error, average_error)
+
+    def test_project_image_and_peaks(self):
+        img = SituImage([])
+        img.data = self.stack.copy()
+        peak_finder = PeakFinderDifferenceOfGaussian(projection=BestFocusProjection())
+        peaks = peak_finder.get_channel_peaks(img, 0, focus_level=2)
+        expected = PeakFinderDifferenceOfGaussian().find_peaks(self.sharp)
+        self.assertTrue(np.array_equal(peaks, expected))
+
+        img.project(MaxIntensityProjection())
+        self.assertEqual(img.get_focus_level_count(), 1)
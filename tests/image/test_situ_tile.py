@@ -0,0 +1,121 @@
+from situr.image import Tile, MaxIntensityProjection
+from situr.transformation import RotateTranslateTransform
+
+from PIL import Image
+import numpy as np
+import os
+import tempfile
+import unittest
+
+
+class TestTile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_list = []
+        for round in range(3):
+            self.file_list.append([])
+            for channel in range(2):
+                self.file_list[round].append([])
+                for focus_level in range(2):
+                    path = os.path.join(self.directory.name, 'r{}_c{}_z{}.tif'.format(
+                        round, channel, focus_level))
+                    data = np.full((8, 8), round * 100 + channel * 10 + focus_level, np.uint8)
+                    Image.fromarray(data).save(path)
+                    self.file_list[round][channel].append(path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_to_numpy_array_does_not_copy(self):
+        tile = Tile(self.file_list)
+        tile.get_round(1).get_data()
+        data = tile.to_numpy_array()
+        self.assertEqual(data.shape, (3, 2, 2, 8, 8))
+        self.assertEqual(data[2, 1, 1, 0, 0], 211)
+        self.assertIs(tile.to_numpy_array(), data)
+        for round, image in enumerate(tile.images):
+            self.assertTrue(np.shares_memory(image.get_data(), data[round]))
+
+    def test_reloaded_round_stays_in_buffer(self):
+        tile = Tile(self.file_list)
+        data = tile.allocate()
+        image = tile.get_round(2)
+        self.assertIsNone(image.data)
+        image.unload_image()
+        self.assertTrue(np.shares_memory(image.get_data(), data))
+        self.assertEqual(data[2, 0, 1, 0, 0], 201)
+
+    def test_projected_tile_gets_new_buffer(self):
+        tile = Tile(self.file_list)
+        tile.to_numpy_array()
+        tile.project(MaxIntensityProjection())
+        data = tile.to_numpy_array()
+        self.assertEqual(data.shape, (3, 2, 1, 8, 8))
+        self.assertEqual(data[1, 1, 0, 0, 0], 111)
+
+    def test_scaled_tile_is_not_cropped(self):
+        tile = Tile(self.file_list)
+        tile.set_round_transformation(1, RotateTranslateTransform(np.eye(2), scale=2))
+        output = tile.apply_transformations(dtype=np.float32)
+        self.assertEqual(output.shape, (3, 2, 2, 16, 16))
+        self.assertEqual(output.dtype, np.float32)
+        self.assertAlmostEqual(float(output[1, 1, 0, 14, 14]), 110, places=3)
+        self.assertAlmostEqual(float(output[2, 1, 0, 7, 7]), 210, places=3)
+        # the rounds are not changed
+        self.assertEqual(tile.get_round(1).version, 0)
+
+        with self.assertRaises(ValueError):
+            tile.apply_transformations(output=np.empty((3, 2, 2, 8, 8), dtype=np.float32))
+
+
+class TestLazyTransformation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.file_list = []
+        for round in range(2):
+            self.file_list.append([])
+            for channel in range(2):
+                self.file_list[round].append([])
+                for focus_level in range(3):
+                    path = os.path.join(self.directory.name, 'r{}_c{}_z{}.tif'.format(
+                        round, channel, focus_level))
+                    Image.fromarray(rng.integers(0, 255, (16, 16), dtype=np.uint8)).save(path)
+                    self.file_list[round][channel].append(path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def transform(self, tile):
+        tile.get_round(1).set_channel_transformation(
+            1, RotateTranslateTransform(np.eye(2), offset=np.array([1.5, -2])))
+        tile.set_round_transformation(
+            1, RotateTranslateTransform(np.eye(2), offset=np.array([-1, 0.5])))
+
+    def test_lazy_planes_match_eager_transformation(self):
+        eager = Tile(self.file_list)
+        self.transform(eager)
+        eager.apply_transformations()
+
+        lazy = Tile(self.file_list)
+        self.transform(lazy)
+        lazy.apply_transformations(lazy=True)
+        image = lazy.get_round(1)
+        self.assertTrue(np.array_equal(image.get_focus_level(1, 2),
+                                       eager.get_round(1).get_focus_level(1, 2)))
+        self.assertTrue(np.array_equal(image.get_channel(0), eager.get_channel(1, 0)))
+        # only the requested planes were read, the raw data is not loaded
+        self.assertFalse(image.is_loaded())
+        self.assertNotEqual(image.version, 0)
+
+    def test_cache_is_bounded(self):
+        tile = Tile(self.file_list)
+        self.transform(tile)
+        tile.apply_transformations(lazy=True)
+        image = tile.get_round(1)
+        image.max_cached_planes = 2
+        first = image.get_focus_level(0, 0)
+        self.assertIs(image.get_focus_level(0, 0), first)
+        image.get_channel(1)
+        self.assertEqual(len(image._plane_cache), 2)
+        self.assertIsNot(image.get_focus_level(0, 0), first)
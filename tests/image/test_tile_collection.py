@@ -0,0 +1,89 @@
+from situr.image import TileCollection
+from situr.transformation import RotateTranslateTransform
+
+from PIL import Image
+import numpy as np
+import os
+import tempfile
+import unittest
+
+
+class TestTileCollection(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pattern = os.path.join(self.directory.name,
+                                    't{tile}_r{round}_c{channel}_z{focus_level}.tif')
+        for tile in range(3):
+            for round in range(2):
+                for channel in range(2):
+                    data = np.full((8, 8), tile * 10 + round, dtype=np.uint8)
+                    Image.fromarray(data).save(self.pattern.format(
+                        tile=tile, round=round, channel=channel, focus_level=0))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_tiles_are_created_on_demand(self):
+        collection = TileCollection.from_pattern(self.pattern, 3, 2, 2)
+        self.assertEqual(collection.get_tile_count(), 3)
+        self.assertEqual(len(collection.tiles), 0)
+        tile = collection.get_tile(1)
+        self.assertIs(tile, collection.get_tile(1))
+        self.assertEqual(tile.get_channel(1, 0)[0, 0, 0], 11)
+
+    def test_least_recently_used_round_is_evicted(self):
+        # one round is 2 channels * 1 focus level * 8 * 8 bytes
+        collection = TileCollection.from_pattern(self.pattern, 3, 2, 2, max_bytes=2 * 128)
+        first = collection.get_tile(0).get_round(0)
+        first.get_data()
+        collection.get_tile(0).get_round(1).get_data()
+        first.get_data()
+        collection.get_tile(1).get_round(0).get_data()
+
+        self.assertTrue(first.is_loaded())
+        self.assertFalse(collection.get_tile(0).get_round(1).is_loaded())
+        statistics = collection.get_cache_statistics()
+        self.assertEqual(statistics['misses'], 3)
+        self.assertEqual(statistics['hits'], 1)
+        self.assertEqual(statistics['evictions'], 1)
+        self.assertLessEqual(statistics['resident_bytes'], 2 * 128)
+
+    def test_metadata_is_not_an_access(self):
+        collection = TileCollection.from_pattern(self.pattern, 3, 2, 2, max_bytes=2 * 128)
+        first = collection.get_tile(0).get_round(0)
+        self.assertEqual(first.get_channel_count(), 2)
+        self.assertFalse(first.is_loaded())
+        first.get_data()
+        collection.get_tile(0).get_round(1).get_data()
+        self.assertEqual(first.get_focus_level_count(), 1)
+        collection.get_tile(1).get_round(0).get_data()
+
+        # asking for the shape did not make the first round the most recently used one
+        self.assertFalse(first.is_loaded())
+        statistics = collection.get_cache_statistics()
+        self.assertEqual(statistics['misses'], 3)
+        self.assertEqual(statistics['hits'], 0)
+
+    def test_transformed_rounds_are_not_evicted(self):
+        collection = TileCollection.from_pattern(self.pattern, 3, 2, 2, max_bytes=128)
+        tile = collection.get_tile(0)
+        tile.get_round(0).apply_transform_to_whole_image(
+            RotateTranslateTransform(np.eye(2), offset=[0, 2]))
+        tile.get_round(1).get_data()
+        collection.get_tile(1).get_round(0).get_data()
+
+        self.assertTrue(tile.get_round(0).is_loaded())
+        self.assertFalse(tile.get_round(1).is_loaded())
+        # the shift moved the zero padding into the first columns
+        self.assertEqual(tile.get_channel(0, 0)[0, 0, 0], 0)
+
+    def test_tile_buffers_count_against_the_budget(self):
+        collection = TileCollection.from_pattern(self.pattern, 3, 2, 2, max_bytes=128)
+        first = collection.get_tile(0)
+        first.to_numpy_array()
+        second = collection.get_tile(1).to_numpy_array()
+
+        self.assertIsNone(first.data)
+        self.assertFalse(first.get_round(0).is_loaded())
+        self.assertEqual(collection.get_resident_bytes(), second.nbytes)
+        self.assertTrue(np.all(second[1] == 11))
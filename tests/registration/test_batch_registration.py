@@ -0,0 +1,100 @@
+from situr.registration import BatchRegistration, CombinedRegistration, ChannelRegistration
+from situr.registration import RoundRegistration, RegistrationFunction, RegistrationStore
+from situr.registration import PeakFinderDifferenceOfGaussian
+from situr.transformation import RotateTranslateTransform
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.ndimage
+from PIL import Image
+
+
+class IdentityRegistrationFunction(RegistrationFunction):
+    """Registers all peaks with the identity, the test tiles are not shifted.
+    """
+
+    def do_registration(self, data_peaks, reference_peaks, initial_transform=None):
+        return RotateTranslateTransform(np.eye(2), offset=np.zeros(2))
+
+
+class TestBatchRegistration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        spots = np.zeros((64, 64))
+        coordinates = rng.integers(5, 59, (20, 2))
+        spots[coordinates[:, 0], coordinates[:, 1]] = 1
+        spots = scipy.ndimage.gaussian_filter(spots, 1.5)
+        spots = (spots / spots.max() * 255).astype(np.uint8)
+
+        # tile 1 misses its files and fails
+        self.file_lists = []
+        for tile in range(2):
+            self.file_lists.append([])
+            for round in range(2):
+                self.file_lists[tile].append([])
+                for channel in range(2):
+                    path = os.path.join(self.directory.name,
+                                        't{}_r{}_c{}.png'.format(tile, round, channel))
+                    if tile == 0:
+                        Image.fromarray(spots).save(path)
+                    self.file_lists[tile][round].append([path])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_batch(self, **kwargs):
+        registration_function = IdentityRegistrationFunction()
+        peak_finder = PeakFinderDifferenceOfGaussian()
+        return BatchRegistration(
+            CombinedRegistration(RoundRegistration(registration_function, peak_finder),
+                                 ChannelRegistration(registration_function, peak_finder),
+                                 **kwargs),
+            output_pattern=os.path.join(self.directory.name, 'out',
+                                        't{tile}_r{round}_c{channel}_z{focus_level}.tif'),
+            workers=2,
+            nucleaus_channel=2)
+
+    def register(self, batch):
+        results = sorted(batch.do_registration(self.file_lists),
+                         key=lambda result: result.tile_number)
+        self.assertEqual([result.tile_number for result in results], [0, 1])
+        return results
+
+    def test_results_and_errors_per_tile(self):
+        registered, failed = self.register(self.get_batch())
+        self.assertTrue(registered.is_successful())
+        self.assertEqual(len(registered.round_transformations), 2)
+        self.assertEqual(len(registered.channel_transformations[1]), 2)
+        self.assertTrue(all(os.path.exists(file) for round_files in registered.output_files
+                            for channel_files in round_files for file in channel_files))
+        self.assertFalse(failed.is_successful())
+        self.assertIn('t1_r0_c0.png', failed.error)
+
+    def test_rerun_skips_stored_tiles(self):
+        batch = self.get_batch(
+            result_store=RegistrationStore(os.path.join(self.directory.name, 'store')))
+        registered, _ = self.register(batch)
+        self.assertFalse(registered.skipped)
+
+        registered, failed = self.register(batch)
+        self.assertTrue(registered.skipped)
+        self.assertEqual(len(registered.round_transformations), 2)
+        self.assertFalse(failed.is_successful())
+
+        # a changed input file invalidates the stored results of its tile
+        os.utime(self.file_lists[0][1][0][0], ns=(0, 0))
+        registered, _ = self.register(batch)
+        self.assertTrue(registered.is_successful())
+        self.assertFalse(registered.skipped)
+
+    def test_closing_the_results_cancels_pending_tiles(self):
+        batch = self.get_batch()
+        batch.workers = 1
+        results = batch.do_registration([self.file_lists[0]] * 6)
+        next(results)
+        results.close()
+        self.assertFalse(os.path.exists(batch.get_output_files(5, self.file_lists[0])[0][0][0]))
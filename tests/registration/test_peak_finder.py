@@ -0,0 +1,142 @@
+from situr.image import SituImage
+from situr.registration import PeakFinderDifferenceOfGaussian, PeakFinderBlockedDifferenceOfGaussian
+from situr.transformation import RotateTranslateTransform
+
+from PIL import Image
+import numpy as np
+import os
+import scipy.ndimage
+import tempfile
+import unittest
+from unittest import mock
+
+
+def spot_image(size=300, spots=200, seed=0):
+    rng = np.random.default_rng(seed)
+    img = np.zeros((size, size))
+    coordinates = rng.integers(0, size, (spots, 2))
+    img[coordinates[:, 0], coordinates[:, 1]] = 1
+    return (scipy.ndimage.gaussian_filter(img, 1.5) * 60 * 255).clip(0, 255).astype(np.uint8)
+
+
+class TestPeakFinderBlockedDifferenceOfGaussian(unittest.TestCase):
+    def test_blocks_find_same_peaks_as_whole_image(self):
+        img = spot_image()
+        expected = PeakFinderDifferenceOfGaussian(use_cache=False).find_peaks(img)
+        peaks = PeakFinderBlockedDifferenceOfGaussian(block_size=64, workers=2,
+                                                      use_cache=False).find_peaks(img)
+        self.assertEqual(
+            sorted(map(tuple, expected.tolist())),
+            sorted(map(tuple, peaks.tolist())))
+
+
+class TestMaxPeaks(unittest.TestCase):
+    def test_brightest_peaks_are_kept(self):
+        img = SituImage([])
+        img.data = spot_image()[np.newaxis, np.newaxis]
+        peaks = PeakFinderDifferenceOfGaussian(use_cache=False).get_channel_peaks(img, 0)
+        capped = PeakFinderDifferenceOfGaussian(use_cache=False, max_peaks=20).get_channel_peaks(
+            img, 0)
+        brightness = img.data[0, 0][peaks[:, 1].astype(int), peaks[:, 0].astype(int)]
+        capped_brightness = img.data[0, 0][capped[:, 1].astype(int), capped[:, 0].astype(int)]
+        self.assertEqual(len(capped), 20)
+        self.assertGreaterEqual(capped_brightness.min(), np.sort(brightness)[-20])
+
+
+class TestDownsample(unittest.TestCase):
+    def test_peaks_are_in_full_resolution_coordinates(self):
+        rng = np.random.default_rng(0)
+        spots = rng.integers(30, 370, (60, 2))
+        img = np.zeros((400, 400))
+        img[spots[:, 1], spots[:, 0]] = 1
+        situ_image = SituImage([])
+        situ_image.data = (scipy.ndimage.gaussian_filter(img, 1.5) * 60 * 255).clip(
+            0, 255).astype(np.uint8)[np.newaxis, np.newaxis]
+        peak_finder = PeakFinderDifferenceOfGaussian(use_cache=False)
+        for downsample in (2, 4):
+            peaks = peak_finder.get_channel_peaks(situ_image, 0, downsample=downsample)
+            self.assertGreater(len(peaks), 50)
+            # every peak lies in the coarse pixel, i.e. downsample x downsample block, of a spot
+            distances = np.abs(peaks[:, np.newaxis] - spots[np.newaxis]).max(axis=2).min(axis=1)
+            self.assertLessEqual(distances.max(), downsample / 2)
+
+
+class TestPeakCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.directory.name, 'c0_z0.tif')
+        Image.fromarray(spot_image(size=64, spots=20)).save(self.file)
+        self.shift = RotateTranslateTransform(np.eye(2), offset=np.array([2, 3]))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def count_searches(self, peak_finder):
+        return mock.patch.object(peak_finder, 'find_peaks', wraps=peak_finder.find_peaks)
+
+    def test_second_call_is_cached(self):
+        peak_finder = PeakFinderDifferenceOfGaussian()
+        img = SituImage([[self.file]])
+        with self.count_searches(peak_finder) as search:
+            peaks = peak_finder.get_channel_peaks(img, 0)
+            self.assertIs(peak_finder.get_channel_peaks(img, 0), peaks)
+        self.assertEqual(search.call_count, 1)
+
+    def test_in_memory_images_do_not_share_peaks(self):
+        peak_finder = PeakFinderDifferenceOfGaussian()
+        images = []
+        for seed in range(2):
+            img = SituImage([])
+            img.data = spot_image(size=64, spots=20, seed=seed)[np.newaxis, np.newaxis]
+            images.append(img)
+        first, second = [peak_finder.get_channel_peaks(img, 0) for img in images]
+        self.assertFalse(np.array_equal(first, second))
+        uncached = PeakFinderDifferenceOfGaussian(use_cache=False)
+        self.assertTrue(np.array_equal(second, uncached.get_channel_peaks(images[1], 0)))
+
+        # replacing the data of an image replaces its peaks as well
+        images[0].data = images[1].data.copy()
+        self.assertTrue(np.array_equal(peak_finder.get_channel_peaks(images[0], 0), second))
+
+    def test_transformation_misses_the_cache(self):
+        peak_finder = PeakFinderDifferenceOfGaussian()
+        eager, lazy = SituImage([[self.file]]), SituImage([[self.file]])
+        with self.count_searches(peak_finder) as search:
+            peaks = peak_finder.get_channel_peaks(eager, 0)
+            eager.apply_transform_to_whole_image(self.shift)
+            shifted = peak_finder.get_channel_peaks(eager, 0)
+            lazy.set_channel_transformation(0, self.shift)
+            lazy.apply_transformations(lazy=True)
+            lazy_shifted = peak_finder.get_channel_peaks(lazy, 0)
+        self.assertEqual(search.call_count, 3)
+        self.assertFalse(np.array_equal(peaks, shifted))
+        self.assertTrue(np.array_equal(shifted, lazy_shifted))
+        # the peaks of the shifted image replaced those of its previous content
+        self.assertEqual(len(peak_finder.peak_cache), 3)
+        eager.apply_transform_to_whole_image(self.shift)
+        peak_finder.get_channel_peaks(eager, 0)
+        self.assertEqual(len(peak_finder.peak_cache), 3)
+
+    def test_cache_is_bounded(self):
+        peak_finder = PeakFinderDifferenceOfGaussian(max_cached_peaks=2)
+        img = SituImage([[self.file]])
+        for downsample in (1, 2, 4):
+            peak_finder.get_channel_peaks(img, 0, downsample=downsample)
+        self.assertEqual(len(peak_finder.peak_cache), 2)
+
+    def test_disk_cache_is_invalidated_by_modified_files(self):
+        cache_directory = os.path.join(self.directory.name, 'peaks')
+        peaks = PeakFinderDifferenceOfGaussian(cache_directory=cache_directory).get_channel_peaks(
+            SituImage([[self.file]]), 0)
+
+        peak_finder = PeakFinderDifferenceOfGaussian(cache_directory=cache_directory)
+        with self.count_searches(peak_finder) as search:
+            self.assertTrue(np.array_equal(
+                peak_finder.get_channel_peaks(SituImage([[self.file]]), 0), peaks))
+        self.assertEqual(search.call_count, 0)
+
+        os.utime(self.file, ns=(0, 0))
+        peak_finder = PeakFinderDifferenceOfGaussian(cache_directory=cache_directory)
+        with self.count_searches(peak_finder) as search:
+            peak_finder.get_channel_peaks(SituImage([[self.file]]), 0)
+        self.assertEqual(search.call_count, 1)
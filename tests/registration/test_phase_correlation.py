@@ -0,0 +1,98 @@
+from situr.image import Tile
+from situr.registration import phase_correlation, PhaseCorrelationRegistrationFunction
+from situr.registration import PhaseCorrelationRoundRegistration, QualityThresholds
+from situr.registration import Icp2dRegistrationFunction
+
+from PIL import Image
+import numpy as np
+import os
+import scipy.ndimage
+import tempfile
+import unittest
+
+
+class TestPhaseCorrelation(unittest.TestCase):
+    def test_recovers_batched_subpixel_shifts(self):
+        rng = np.random.default_rng(0)
+        reference = scipy.ndimage.gaussian_filter(rng.random((128, 128)), 2)
+        shifts = np.array([[3.5, -5.25], [-10.0, 7.75]])
+        # the moving images are the reference moved by the inverse shift
+        moving = np.stack([scipy.ndimage.shift(reference, -shift, mode='grid-wrap')
+                           for shift in shifts])
+
+        estimated, height = phase_correlation(moving, reference, window=False)
+        self.assertTrue(np.allclose(estimated, shifts, atol=0.2))
+        self.assertEqual(height.shape, (2,))
+
+    def test_registers_peaks(self):
+        rng = np.random.default_rng(0)
+        reference = rng.uniform(0, 500, (300, 2))
+        data = reference - np.array([12.5, -7.0])
+
+        result = PhaseCorrelationRegistrationFunction().register(data, reference)
+        self.assertTrue(np.allclose(result.transformation.offset, [-7.0, 12.5], atol=1.0))
+        # the height of the correlation peak is not a fraction of matched peaks
+        self.assertIsNone(result.fitness)
+        self.assertGreater(result.correlation, 0)
+
+        refined = PhaseCorrelationRegistrationFunction(
+            refine_function=Icp2dRegistrationFunction(max_correspondence_distance=3)).register(
+                data, reference)
+        self.assertTrue(np.allclose(refined.transformation.offset, [-7.0, 12.5], atol=1e-4))
+        self.assertAlmostEqual(refined.fitness, 1.0)
+
+
+class TestPhaseCorrelationRoundRegistration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        spots = np.zeros((128, 128))
+        coordinates = rng.integers(10, 118, (40, 2))
+        spots[coordinates[:, 0], coordinates[:, 1]] = 1
+        spots = scipy.ndimage.gaussian_filter(spots, 1.5)
+        spots = (spots / spots.max() * 255).astype(np.uint8)
+
+        # round 1 is shifted by (2, -3) against round 0
+        self.file_list = []
+        for round, shift in enumerate([(0, 0), (2, -3)]):
+            path = os.path.join(self.directory.name, 'r{}.png'.format(round))
+            Image.fromarray(np.roll(spots, shift, axis=(0, 1))).save(path)
+            self.file_list.append([[path]])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def register(self, **kwargs):
+        tile = Tile(self.file_list, nucleaus_channel=1)
+        PhaseCorrelationRoundRegistration(**kwargs).do_round_registration(tile)
+        return tile.round_registration_results[1]
+
+    def test_results_report_correlation_and_runtime(self):
+        result = self.register()
+        self.assertTrue(np.allclose(result.transformation.offset, [-2, 3], atol=0.5))
+        self.assertIsNone(result.fitness)
+        self.assertGreater(result.correlation, 0)
+        self.assertGreater(result.runtime, 0)
+        self.assertIsNone(result.accepted)
+
+    def test_rejected_correlation_falls_back_to_peaks(self):
+        thresholds = QualityThresholds(min_correlation=1.5)
+        result = self.register(quality_thresholds=thresholds)
+        self.assertFalse(result.accepted)
+
+        registration = PhaseCorrelationRoundRegistration(
+            quality_thresholds=thresholds,
+            fallback_functions=[Icp2dRegistrationFunction(max_correspondence_distance=3)])
+        parameters = registration.get_parameters()
+        self.assertEqual(parameters['quality_thresholds']['min_correlation'], 1.5)
+        self.assertIsNone(parameters['registration_function'])
+        self.assertEqual(parameters['pyramid'], [])
+        self.assertEqual(parameters['phase_correlation_function']['class'],
+                         'PhaseCorrelationRegistrationFunction')
+        tile = Tile(self.file_list, nucleaus_channel=1)
+        registration.do_round_registration(tile)
+        result = tile.round_registration_results[1]
+        self.assertTrue(result.accepted)
+        self.assertEqual(result.fallback, 0)
+        self.assertAlmostEqual(result.fitness, 1.0)
+        self.assertTrue(np.allclose(result.transformation.offset, [-2, 3]))
@@ -0,0 +1,61 @@
+from situr.image import Tile
+from situr.registration import CombinedRegistration, ChannelRegistration, RoundRegistration
+from situr.registration import Icp2dRegistrationFunction, PeakFinderDifferenceOfGaussian
+from situr.registration import Profiler
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.ndimage
+from PIL import Image
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        spots = np.zeros((128, 128))
+        coordinates = rng.integers(10, 118, (40, 2))
+        spots[coordinates[:, 0], coordinates[:, 1]] = 1
+        spots = scipy.ndimage.gaussian_filter(spots, 1.5)
+        spots = (spots / spots.max() * 255).astype(np.uint8)
+
+        self.file_list = []
+        for round, shift in enumerate([(0, 0), (2, -3)]):
+            self.file_list.append([])
+            for channel in range(2):
+                path = os.path.join(self.directory.name, 'r{}_c{}.png'.format(round, channel))
+                Image.fromarray(np.roll(spots, shift, axis=(0, 1))).save(path)
+                self.file_list[round].append([path])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records_stages(self):
+        records = []
+        profiler = Profiler(callback=records.append)
+        registration_function = Icp2dRegistrationFunction(max_correspondence_distance=10)
+        peak_finder = PeakFinderDifferenceOfGaussian()
+        registration = CombinedRegistration(
+            RoundRegistration(registration_function, peak_finder),
+            ChannelRegistration(registration_function, peak_finder))
+        registration.do_registration_and_transform(
+            Tile(self.file_list, nucleaus_channel=2), profiler.bind(tile=7))
+
+        self.assertEqual(records, profiler.records)
+        self.assertTrue(all(record['tile'] == 7 for record in records))
+        stages = profiler.summary()
+        self.assertEqual(stages['_load_image']['count'], 2)
+        self.assertEqual(stages['apply_round_transformations']['count'], 2)
+
+        round_registration = [record for record in records
+                              if record['stage'] == 'do_registration' and 'round' in record
+                              and 'channel' not in record]
+        self.assertEqual([record['round'] for record in round_registration], [1])
+        self.assertAlmostEqual(round_registration[0]['fitness'], 1.0)
+        peaks = [record['peaks'] for record in records if record['stage'] == 'get_channel_peaks']
+        self.assertTrue(all(count > 0 for count in peaks))
+        loaded = [record['bytes'] for record in records if record['stage'] == '_load_image']
+        self.assertTrue(all(count > 0 for count in loaded))
@@ -0,0 +1,147 @@
+from situr.registration import Icp2dRegistrationFunction, TrimmedIcpRegistrationFunction
+from situr.registration import RansacRegistrationFunction, subsample_peaks
+from situr.registration import QualityThresholds, RoundRegistration
+from situr.registration import PeakFinderDifferenceOfGaussian
+from situr.image import SituImage
+
+import numpy as np
+import scipy.ndimage
+import unittest
+
+
+class TestIcp2dRegistrationFunction(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.reference = rng.uniform(0, 1000, (500, 2))
+        angle = np.deg2rad(2)
+        self.rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                                  [np.sin(angle), np.cos(angle)]])
+        self.translation = np.array([7.5, -4.0])
+        # data peaks are the reference peaks moved by the inverse transformation
+        self.data = (self.reference - self.translation) @ self.rotation
+
+    def test_recovers_rigid_transformation(self):
+        result = Icp2dRegistrationFunction(max_correspondence_distance=30).register(
+            self.data, self.reference)
+        transformation = result.transformation
+        self.assertTrue(np.allclose(transformation.transform_matrix, self.rotation, atol=1e-6))
+        self.assertTrue(np.allclose(transformation.offset, self.translation[[1, 0]], atol=1e-4))
+        self.assertAlmostEqual(result.fitness, 1.0)
+        self.assertLess(result.inlier_rmse, 1e-4)
+
+    def test_recovers_scale(self):
+        result = Icp2dRegistrationFunction(max_correspondence_distance=30, with_scale=True).register(
+            self.data / 1.01, self.reference)
+        self.assertAlmostEqual(result.transformation.scale, 1.01, places=5)
+
+
+class TestRobustRegistrationFunction(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.reference = rng.uniform(0, 2000, (3000, 2))
+        angle = np.deg2rad(1.5)
+        self.rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                                  [np.sin(angle), np.cos(angle)]])
+        self.translation = np.array([40.0, -28.0])
+        # 60 percent of the reference peaks with noise and a third as many spurious peaks
+        found = rng.random(len(self.reference)) < 0.6
+        data = (self.reference[found] - self.translation) @ self.rotation
+        data += rng.normal(0, 0.3, data.shape)
+        self.data = np.concatenate([data, rng.uniform(0, 2000, (1000, 2))])
+
+    def test_ransac_recovers_rigid_transformation(self):
+        result = RansacRegistrationFunction(max_correspondence_distance=60, candidates=8).register(
+            self.data, self.reference)
+        transformation = result.transformation
+        self.assertTrue(np.allclose(transformation.transform_matrix, self.rotation, atol=1e-4))
+        self.assertTrue(np.allclose(transformation.offset, self.translation[[1, 0]], atol=0.1))
+        self.assertGreater(result.fitness, 0.5)
+        self.assertLess(result.inlier_rmse, 1)
+
+    def test_trimmed_icp_is_capped_and_repeatable(self):
+        registration_function = TrimmedIcpRegistrationFunction(
+            max_correspondence_distance=10, max_peaks=500)
+        initial = RansacRegistrationFunction(max_correspondence_distance=60, candidates=8).register(
+            self.data, self.reference).transformation
+        result = registration_function.register(self.data, self.reference, initial)
+        self.assertTrue(np.allclose(result.transformation.offset, self.translation[[1, 0]],
+                                    atol=0.5))
+        self.assertLess(result.iterations, registration_function.max_iterations)
+        repeated = registration_function.register(self.data, self.reference, initial)
+        self.assertTrue(np.array_equal(result.transformation.get_matrix(),
+                                       repeated.transformation.get_matrix()))
+
+    def test_subsample_peaks(self):
+        peaks = np.arange(20).reshape(10, 2)
+        self.assertIs(subsample_peaks(peaks, None, np.random.default_rng(0)), peaks)
+        subset = subsample_peaks(peaks, 4, np.random.default_rng(0))
+        self.assertEqual(len(subset), 4)
+        self.assertTrue(np.all(np.diff(subset[:, 0]) > 0))
+
+
+class TestQualityFallback(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.reference = rng.uniform(0, 1000, (500, 2))
+        self.translation = np.array([20.0, -15.0])
+        self.data = self.reference - self.translation
+
+    def register(self, quality_thresholds, fallback_functions):
+        registration = RoundRegistration(Icp2dRegistrationFunction(max_correspondence_distance=3),
+                                         quality_thresholds=quality_thresholds,
+                                         fallback_functions=fallback_functions)
+        return registration._register_peaks(lambda downsample: self.data,
+                                            lambda downsample: self.reference)
+
+    def test_fallback_on_same_peaks(self):
+        result = self.register(QualityThresholds(min_fitness=0.9),
+                               [Icp2dRegistrationFunction(10), RansacRegistrationFunction(40)])
+        self.assertTrue(result.accepted)
+        self.assertEqual(result.fallback, 1)
+        self.assertEqual(result.inlier_count, 500)
+        self.assertGreater(result.runtime, 0)
+        self.assertTrue(np.allclose(result.transformation.offset, self.translation[[1, 0]]))
+
+    def test_best_result_is_kept_if_none_is_accepted(self):
+        result = self.register(QualityThresholds(min_fitness=0.9, min_inlier_count=1000),
+                               [RansacRegistrationFunction(40)])
+        self.assertFalse(result.accepted)
+        self.assertEqual(result.fallback, 0)
+        self.assertEqual(result.fitness, 1.0)
+
+
+class TestPyramid(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        spots = rng.integers(30, 370, (60, 2))
+        self.shift = np.array([12, -9])
+        self.reference = self.spot_image(spots)
+        self.data = self.spot_image(spots - self.shift)
+        self.peak_finder = PeakFinderDifferenceOfGaussian(use_cache=False)
+
+    @staticmethod
+    def spot_image(spots, size=400):
+        img = np.zeros((size, size))
+        img[spots[:, 1], spots[:, 0]] = 1
+        situ_image = SituImage([])
+        situ_image.data = (scipy.ndimage.gaussian_filter(img, 1.5) * 60 * 255).clip(
+            0, 255).astype(np.uint8)[np.newaxis, np.newaxis]
+        return situ_image
+
+    def register(self, pyramid):
+        registration = RoundRegistration(Icp2dRegistrationFunction(max_correspondence_distance=3),
+                                         pyramid=pyramid)
+        return registration._register_peaks(
+            lambda downsample: self.peak_finder.get_channel_peaks(
+                self.data, 0, downsample=downsample),
+            lambda downsample: self.peak_finder.get_channel_peaks(
+                self.reference, 0, downsample=downsample))
+
+    def test_shift_beyond_correspondence_distance_needs_pyramid(self):
+        result = self.register(None)
+        self.assertFalse(np.allclose(result.transformation.offset, self.shift[[1, 0]]))
+        self.assertLess(result.fitness, 0.5)
+
+        result = self.register([(4, Icp2dRegistrationFunction(40))])
+        self.assertTrue(np.allclose(result.transformation.offset, self.shift[[1, 0]]))
+        self.assertAlmostEqual(result.fitness, 1.0)
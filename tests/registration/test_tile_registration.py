@@ -0,0 +1,172 @@
+from situr.image import Tile
+from situr.registration import CombinedRegistration, ChannelRegistration, RoundRegistration
+from situr.registration import AllChannelRoundRegistration, RegistrationStore
+from situr.registration import Icp2dRegistrationFunction, PeakFinderDifferenceOfGaussian
+from situr.registration import RansacRegistrationFunction
+from situr.registration import QualityThresholds, get_tile_quality, write_quality_report
+
+import csv
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import scipy.ndimage
+from PIL import Image
+
+
+class TestCombinedRegistration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        spots = np.zeros((128, 128))
+        coordinates = rng.integers(10, 118, (40, 2))
+        spots[coordinates[:, 0], coordinates[:, 1]] = 1
+        spots = scipy.ndimage.gaussian_filter(spots, 1.5)
+        spots = (spots / spots.max() * 255).astype(np.uint8)
+
+        # channel 1 is shifted by (1, 2) against channel 0, round 1 by (2, -3) and round 2 by
+        # (-1, 2) against round 0
+        self.file_list = []
+        for round, round_shift in enumerate([(0, 0), (2, -3), (-1, 2)]):
+            self.file_list.append([])
+            for channel, channel_shift in enumerate([(0, 0), (1, 2)]):
+                path = os.path.join(self.directory.name, 'r{}_c{}.png'.format(round, channel))
+                shift = np.add(round_shift, channel_shift)
+                Image.fromarray(np.roll(spots, shift, axis=(0, 1))).save(path)
+                self.file_list[round].append([path])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_registration(self, **kwargs):
+        registration_function = Icp2dRegistrationFunction(max_correspondence_distance=10)
+        peak_finder = PeakFinderDifferenceOfGaussian()
+        return CombinedRegistration(
+            RoundRegistration(registration_function, peak_finder),
+            ChannelRegistration(registration_function, peak_finder), **kwargs)
+
+    def register(self, **kwargs):
+        tile = Tile(self.file_list, nucleaus_channel=2)
+        self.get_registration(**kwargs).do_registration_and_transform(tile)
+        return tile
+
+    def test_warped_peaks_match_warped_images(self):
+        tile = self.register()
+        warped = self.register(warp_peaks=True)
+        self.assertTrue(np.allclose(warped.round_transformations[1].get_matrix(),
+                                    tile.round_transformations[1].get_matrix(), atol=1e-6))
+        self.assertTrue(np.allclose(warped.round_transformations[1].offset, [-2, 3]))
+        self.assertTrue(np.allclose(warped.to_numpy_array(), tile.to_numpy_array(), atol=1))
+
+    def test_without_resampling_only_transformations_are_set(self):
+        tile = self.register(warp_peaks=True, resample=False)
+        self.assertEqual(tile.get_round(1).version, 0)
+        self.assertTrue(np.allclose(tile.get_round(1).channel_transformations[1].offset, [-1, -2]))
+
+    def test_added_round_is_registered_alone(self):
+        for warp_peaks in (False, True):
+            registration = self.get_registration(warp_peaks=warp_peaks)
+            tile = Tile(self.file_list[:2], nucleaus_channel=2)
+            registration.do_registration_and_transform(tile)
+            first_result = tile.round_registration_results[1]
+            reference_peaks = dict(registration.round_registration.reference_peak_cache[
+                tile.get_round(0)])
+
+            self.assertEqual(tile.add_round(self.file_list[2]), 2)
+            self.assertEqual(registration.register_added_rounds(tile), [2])
+            self.assertIs(tile.round_registration_results[1], first_result)
+            self.assertTrue(np.allclose(tile.round_transformations[2].offset, [1, -2]))
+            # the reference peaks of the first registration were reused
+            cache = registration.round_registration.reference_peak_cache[tile.get_round(0)]
+            for key, peaks in reference_peaks.items():
+                self.assertIs(cache[key], peaks)
+            self.assertTrue(np.allclose(tile.to_numpy_array(), self.register(
+                warp_peaks=warp_peaks).to_numpy_array(), atol=1))
+            self.assertEqual(registration.register_added_rounds(tile), [])
+
+    def test_added_round_is_registered_by_a_new_registration(self):
+        # every channel has its own spots besides the shared ones, so reference peaks that are
+        # warped twice by the channel transformation no longer match
+        rng = np.random.default_rng(1)
+        shared = rng.integers(10, 118, (20, 2))
+        file_list = []
+        for round, round_shift in enumerate([(0, 0), (2, -3), (-1, 2)]):
+            file_list.append([])
+            for channel, channel_shift in enumerate([(0, 0), (3, 4)]):
+                spots = np.zeros((128, 128))
+                coordinates = np.concatenate(
+                    [shared, np.random.default_rng(channel).integers(10, 118, (40, 2))])
+                spots[coordinates[:, 0], coordinates[:, 1]] = 1
+                spots = scipy.ndimage.gaussian_filter(spots, 1.5)
+                spots = (spots / spots.max() * 255).astype(np.uint8)
+                path = os.path.join(self.directory.name, 'own_r{}_c{}.png'.format(round, channel))
+                shift = np.add(round_shift, channel_shift)
+                Image.fromarray(np.roll(spots, shift, axis=(0, 1))).save(path)
+                file_list[round].append([path])
+
+        def get_registration(result_store):
+            peak_finder = PeakFinderDifferenceOfGaussian()
+            return CombinedRegistration(
+                AllChannelRoundRegistration(Icp2dRegistrationFunction(10), peak_finder),
+                ChannelRegistration(RansacRegistrationFunction(10), peak_finder),
+                result_store=result_store, warp_peaks=True)
+
+        def register(result_store):
+            tile = Tile(file_list[:2], nucleaus_channel=2)
+            get_registration(result_store).do_registration_and_transform(tile)
+            tile.add_round(file_list[2])
+            registration = get_registration(result_store)
+            merged_peaks = mock.patch.object(
+                registration.round_registration, '_get_merged_peaks',
+                wraps=registration.round_registration._get_merged_peaks)
+            with merged_peaks as get_merged_peaks:
+                self.assertEqual(registration.register_added_rounds(tile), [2])
+            self.assertTrue(np.allclose(tile.round_transformations[2].offset, [1, -2], atol=0.1))
+            self.assertAlmostEqual(tile.round_registration_results[2].fitness, 1.0)
+            return get_merged_peaks.call_count
+
+        # without a store the reference peaks are found again on the transformed reference
+        # round, with a store they are restored and only the new round is searched
+        self.assertEqual(register(None), 2)
+        self.assertEqual(register(RegistrationStore(os.path.join(self.directory.name, 'store'))),
+                         1)
+
+    def test_rounds_are_registered_against_the_reference_round(self):
+        registration_function = Icp2dRegistrationFunction(max_correspondence_distance=10)
+        tile = Tile(self.file_list, nucleaus_channel=2)
+        RoundRegistration(registration_function).do_round_registration(
+            tile, reference_round=1, reference_channel=0)
+        self.assertIsNone(tile.round_registration_results[1])
+        self.assertTrue(np.allclose(tile.round_transformations[0].offset, [2, -3]))
+
+    def test_quality_report(self):
+        registration_function = Icp2dRegistrationFunction(max_correspondence_distance=10)
+        peak_finder = PeakFinderDifferenceOfGaussian()
+        thresholds = QualityThresholds(min_fitness=0.8, max_inlier_rmse=1.0)
+        registration = CombinedRegistration(
+            RoundRegistration(registration_function, peak_finder, quality_thresholds=thresholds),
+            ChannelRegistration(registration_function, peak_finder, quality_thresholds=thresholds),
+            warp_peaks=True, resample=False)
+        tile = Tile(self.file_list, nucleaus_channel=2)
+        registration.do_registration_and_transform(tile)
+
+        quality = get_tile_quality(tile, 3)
+        # channel 1 of each round and rounds 1 and 2
+        self.assertEqual(quality['registrations'], 5)
+        self.assertEqual(quality['rejected'], 0)
+        self.assertTrue(quality['accepted'])
+        self.assertGreater(quality['min_inlier_count'], 0)
+
+        csv_path = os.path.join(self.directory.name, 'qc', 'quality.csv')
+        json_path = os.path.join(self.directory.name, 'qc', 'quality.json')
+        write_quality_report([quality, None], csv_path)
+        write_quality_report([quality], json_path)
+        with open(csv_path) as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['tile'], '3')
+        with open(json_path) as file:
+            self.assertEqual(len(json.load(file)[0]['results']), 5)
@@ -0,0 +1,48 @@
+from situr.image import TileCollection
+from situr.stitching import Stitching, grid_positions, write_mosaic
+
+from PIL import Image
+import numpy as np
+import os
+import scipy.ndimage
+import tempfile
+import unittest
+
+
+class TestStitching(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.scene = (scipy.ndimage.gaussian_filter(rng.random((320, 420)), 2) * 60000)
+        self.scene = self.scene.astype(np.uint16)
+        self.nominal = grid_positions(2, 3, (128, 128), overlap=0.25)
+        self.positions = self.nominal + rng.integers(-4, 5, self.nominal.shape)
+        self.positions -= self.positions.min(axis=0)
+        self.pattern = os.path.join(self.directory.name, 't{tile}_r{round}_c{channel}_z{focus_level}.tif')
+        for tile, (y, x) in enumerate(self.positions.astype(int)):
+            Image.fromarray(self.scene[y:y + 128, x:x + 128]).save(
+                self.pattern.format(tile=tile, round=0, channel=0, focus_level=0))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_grid_positions(self):
+        positions = grid_positions(2, 2, (100, 200), overlap=0.1, snake=True)
+        self.assertTrue(np.allclose(positions, [[0, 0], [0, 180], [90, 180], [90, 0]]))
+
+    def test_recovers_positions_and_writes_mosaic(self):
+        collection = TileCollection.from_pattern(self.pattern, 6, 1, 1)
+        positions = Stitching().stitch(collection, self.nominal)
+        positions -= positions[0]
+        self.assertTrue(np.allclose(positions, self.positions - self.positions[0], atol=0.5))
+
+        path = os.path.join(self.directory.name, 'mosaic.npy')
+        shape = write_mosaic(collection, path, block_size=100)
+        mosaic = np.load(path)
+        self.assertEqual(mosaic.shape, shape)
+        covered = np.zeros(shape, dtype=bool)
+        for y, x in self.positions.astype(int):
+            covered[y:y + 128, x:x + 128] = True
+        expected = self.scene[:shape[0], :shape[1]]
+        self.assertTrue(np.array_equal(mosaic[covered], expected[covered]))
+        self.assertFalse(mosaic[~covered].any())
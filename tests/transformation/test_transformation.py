@@ -0,0 +1,104 @@
+from situr.transformation import AffineTransform, IdentityTransform, RotateTranslateTransform
+from situr.transformation import apply_transformations_to_stack, transform_from_dict
+
+import numpy as np
+import scipy.ndimage
+import unittest
+
+
+def rotation(degrees):
+    angle = np.deg2rad(degrees)
+    return np.array([[np.cos(angle), -np.sin(angle)],
+                     [np.sin(angle), np.cos(angle)]])
+
+
+class TestTransformComposition(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.img = scipy.ndimage.gaussian_filter(rng.random((64, 64)), 2)
+
+    def test_identity_does_not_change_image(self):
+        img = np.copy(self.img)
+        IdentityTransform().compose(IdentityTransform()).apply_tranformation(img)
+        self.assertTrue(np.array_equal(img, self.img))
+
+    def test_composed_matrix(self):
+        first = RotateTranslateTransform(rotation(3), offset=np.array([1, 2]))
+        second = RotateTranslateTransform(rotation(-3), offset=np.array([-1, -2]))
+        composed = first.compose(second)
+        self.assertIsInstance(composed, AffineTransform)
+        self.assertTrue(np.allclose(composed.get_matrix(), second.get_matrix() @ first.get_matrix()))
+
+    def test_translation_moves_content(self):
+        img = np.zeros((16, 16))
+        img[5, 3] = 1
+        RotateTranslateTransform(np.eye(2), offset=np.array([2, 4])).apply_tranformation(img)
+        self.assertEqual(np.unravel_index(np.argmax(img), img.shape), (7, 7))
+
+    def test_points_move_like_content(self):
+        img = np.zeros((32, 32))
+        img[5, 3] = 1
+        transformation = RotateTranslateTransform(rotation(10), offset=np.array([2, 4]))
+        transformation.apply_tranformation(img)
+        # points are (x, y), the image is indexed (y, x)
+        x, y = transformation.apply_to_points(np.array([[3.0, 5.0]]))[0]
+        self.assertEqual(np.unravel_index(np.argmax(img), img.shape), (round(y), round(x)))
+
+    def test_composition_matches_sequential_application(self):
+        first = RotateTranslateTransform(rotation(2), offset=np.array([1.5, -2]))
+        second = RotateTranslateTransform(np.eye(2), offset=np.array([-3, 1]))
+        sequential = np.copy(self.img)
+        first.apply_tranformation(sequential)
+        second.apply_tranformation(sequential)
+        composed = np.copy(self.img)
+        first.compose(second).apply_tranformation(composed)
+        self.assertLess(np.abs(sequential - composed)[12:-12, 12:-12].max(), 0.01)
+
+
+class TestStackTransformation(unittest.TestCase):
+    def test_threaded_stack_matches_planes(self):
+        rng = np.random.default_rng(1)
+        stack = rng.random((2, 3, 32, 32))
+        transformations = [IdentityTransform(),
+                           RotateTranslateTransform(rotation(4), offset=np.array([1, -1]))]
+        expected = np.copy(stack)
+        for focus_level in range(3):
+            transformations[1].apply_tranformation(expected[1, focus_level])
+        apply_transformations_to_stack(stack, transformations, workers=4)
+        self.assertTrue(np.array_equal(stack, expected))
+
+
+class TestTransformationOutput(unittest.TestCase):
+    def test_output_keeps_input_and_dtype(self):
+        img = np.zeros((16, 16), dtype=np.uint16)
+        img[4:8, 4:8] = 1000
+        output = np.empty((16, 16), dtype=np.float32)
+        transformation = RotateTranslateTransform(np.eye(2), offset=np.array([2, 2]))
+        transformation.apply_tranformation(img, output=output)
+        self.assertEqual(img[4, 4], 1000)
+        self.assertAlmostEqual(float(output[6, 6]), 1000, places=2)
+
+    def test_integer_output_is_clipped(self):
+        img = np.zeros((16, 16), dtype=np.uint8)
+        img[8, 8] = 255
+        RotateTranslateTransform(np.eye(2), offset=np.array([0.5, 0.5])).apply_tranformation(img)
+        # cubic interpolation overshoots below zero next to the peak, which must not wrap around
+        self.assertEqual(np.count_nonzero(img > 200), 0)
+
+    def test_scaled_image_fits_canvas(self):
+        img = np.ones((10, 20))
+        transformation = RotateTranslateTransform(np.eye(2), scale=2)
+        shape = transformation.get_output_shape(img.shape)
+        self.assertEqual(shape, (20, 40))
+        output = transformation.apply_tranformation(img, output=np.zeros(shape))
+        self.assertAlmostEqual(output[10, 20], 1)
+
+
+class TestTransformSerialization(unittest.TestCase):
+    def test_round_trip(self):
+        for transformation in [IdentityTransform(),
+                               AffineTransform(np.array([[1, 0.1, 2], [0, 1, 3], [0, 0, 1]])),
+                               RotateTranslateTransform(rotation(1), 1.5, np.array([1, 2]))]:
+            restored = transform_from_dict(transformation.to_dict())
+            self.assertIs(type(restored), type(transformation))
+            self.assertTrue(np.allclose(restored.get_matrix(), transformation.get_matrix()))